@@ -1,10 +1,8 @@
-
-import os
-from ij.io import DirectoryChooser
-from ij import IJ, ImagePlus, ImageStack
-from ij.process import ImageProcessor
-from fiji.scripting import Weaver
-from java.lang import Math
+import os, sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.io import ImageJLoader
+from lib.projection import project
+from lib.ui import showStack
 
 
 def run():
@@ -25,53 +23,16 @@ def run():
   #DEBUGGING
   num_timepoints = 100
 
-  java = Weaver.method("""
-    static public final void maxer(final ImagePlus target, final String path) {
-      ImagePlus imp = IJ.openImage(path);
-      ImageStack stack1 = target.getStack();
-      ImageStack stack2 = imp.getStack();
-      ImageProcessor ip1, ip2;
-      for (int i=0; i < stack1.getSize(); ++i) {
-        ip1 = stack1.getProcessor(i+1);
-        ip2 = stack2.getProcessor(i+1);
-        final int count = ip1.getWidth() * ip1.getHeight();
-        for (int k=0; k<count; ++k) {
-          ip1.setf(k, Math.max( ip1.getf(k),
-                                ip2.getf(k) ) );
-        }
-      }
-      stack1 = null;
-      stack2 = null;
-      imp.setIgnoreFlush(false);
-      imp.unlock();
-      imp.flush();
-      imp = null;
-  }
-  """, [IJ, ImagePlus, ImageStack, ImageProcessor, Math])
-
-  max_imp = None
-
-  counter = 0
-
-  for root, dirs, files in os.walk(folder):
-    for filename in files:
-      if filename.endswith(ending):
-        counter += 1
-        path = os.path.join(root, filename)
-        print counter, path
-        
-  
-        # Use the first opened stack as the image stack into which to accumulate max values
-        if max_imp is None:
-          max_imp = IJ.openImage(path)
-        else:
-          java.maxer(max_imp, path)
+  paths = sorted(os.path.join(root, filename)
+                 for root, dirs, files in os.walk(folder)
+                 for filename in files
+                 if filename.endswith(ending))[:num_timepoints]
 
-      num_timepoints -= 1
-      if num_timepoints < 0:
-        break
+  # Volumes are read concurrently and reduced by multiple threads into partial projections,
+  # which are then merged pairwise
+  projections = project(paths, ImageJLoader(), ops=["max"], n_readers=2)
   
   # DONE
-  max_imp.show()
+  showStack(projections["max"], title="max projection of %i time points" % len(paths))
 
-run()
\ No newline at end of file
+run()
@@ -10,18 +10,17 @@
 # 
 # Assumptions:
 # 1. All KLB stacks of the series have the same dimensions and pixel iteration order.
-# 2. All KLB stacks are unsigned 16-bit.
+# 2. All KLB stacks are of the same pixel type.
+#
+# Volumes are read concurrently and reduced by multiple threads into partial projections,
+# which are then merged pairwise: see lib/projection.py
 
 
-import os
-from ij.io import DirectoryChooser
-from org.janelia.simview.klb import KLB
-from net.imagej import ImgPlus
-from net.imglib2 import Cursor
-from net.imglib2.type.numeric.integer import UnsignedShortType
-from fiji.scripting import Weaver
-from java.lang import Math
-from net.imglib2.img.display.imagej import ImageJFunctions as IJF
+import os, sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.io import KLBLoader
+from lib.projection import project
+from lib.ui import showStack
 
 
 def run():
@@ -43,44 +42,14 @@ def run():
   #DEBUGGING
   num_timepoints = 100
 
-  java = Weaver.method("""
-    static public final void maxer(final KLB klb, final ImgPlus target, final String path) throws java.io.IOException {
-      Cursor c1 = target.cursor();
-      Cursor c2 = klb.readFull(path).cursor();
-      while (c1.hasNext()) {
-        c1.next();
-        c2.next();
-        UnsignedShortType s1 = (UnsignedShortType) c1.get();
-        UnsignedShortType s2 = (UnsignedShortType) c2.get();
-        s1.set( (short) Math.max( s1.get(), s2.get() ) );
-      }
-  }
-  """, [KLB, ImgPlus, Cursor, UnsignedShortType])
+  paths = sorted(os.path.join(root, filename)
+                 for root, dirs, files in os.walk(folder)
+                 for filename in files
+                 if filename.endswith(ending))[:num_timepoints]
 
-  max_img = None
-
-  klb = KLB.newInstance()
-
-  counter = 0
-
-  for root, dirs, files in os.walk(folder):
-    for filename in files:
-      if filename.endswith(ending):
-        counter += 1
-        path = os.path.join(root, filename)
-        print counter, path
-  
-        # Use the first opened stack as the image stack into which to accumulate max values
-        if max_img is None:
-          max_img = klb.readFull(path)
-        else:
-          java.maxer(klb, max_img, path)
-
-      num_timepoints -= 1
-      if num_timepoints < 0:
-        break
+  projections = project(paths, KLBLoader(), ops=["max"], n_readers=2)
   
   # DONE
-  IJF.show(max_img)
+  showStack(projections["max"], title="max projection of %i time points" % len(paths))
 
 run()
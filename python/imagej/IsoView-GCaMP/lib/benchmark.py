@@ -0,0 +1,198 @@
+from __future__ import with_statement
+from net.imglib2 import RealPoint
+from net.imglib2.img.planar import PlanarImgs
+from net.imglib2.algorithm.gauss3 import Gauss3
+from net.imglib2.realtransform import AffineTransform3D
+from net.imglib2.view import Views
+from ij.process import FloatProcessor, ImageProcessor
+from java.util import Random
+from java.lang import System, Runtime
+from math import sqrt, sin, cos, pi
+from datetime import datetime
+from jarray import array
+import os, csv, sys
+# local lib functions:
+from util import syncPrint, affine3D
+
+
+def randomNuclei(dimensions, n_nuclei, margin, seed=1):
+  """ Return a list of n_nuclei RealPoint at random positions within the dimensions,
+      keeping away from the borders by margin pixels. """
+  rand = Random(seed)
+  return [RealPoint.wrap(array([margin + rand.nextDouble() * (dim - 2 * margin) for dim in dimensions], 'd'))
+          for _ in xrange(n_nuclei)]
+
+
+def transformPoints(affine, points):
+  """ Return a new list of RealPoint, each transformed by the affine. """
+  transformed = []
+  for p in points:
+    t = RealPoint(p.numDimensions())
+    affine.apply(p, t)
+    transformed.append(t)
+  return transformed
+
+
+def renderNuclei(dimensions, points, sigma, amplitude=100.0, background=10.0, noise_sd=5.0, seed=1):
+  """ Render a synthetic, GCaMP-like 3D volume: a Gaussian blob of peak value amplitude
+      at each point, on top of a constant background with Gaussian noise.
+      Returns a PlanarImg of FloatType. """
+  impulses = PlanarImgs.floats(dimensions)
+  ra = impulses.randomAccess()
+  # Scale the impulse so that, once blurred, the peak reaches the desired amplitude
+  impulse = amplitude * pow(2 * pi, 1.5) * pow(sigma, 3)
+  pos = [0, 0, 0]
+  for p in points:
+    for d in xrange(3):
+      pos[d] = int(p.getDoublePosition(d) + 0.5)
+    if all(0 <= c < dim for c, dim in zip(pos, dimensions)):
+      ra.setPosition(pos)
+      t = ra.get()
+      t.setReal(t.getRealFloat() + impulse)
+  img = PlanarImgs.floats(dimensions)
+  Gauss3.gauss([sigma, sigma, sigma], Views.extendZero(impulses), img)
+  # Add background and noise plane by plane, directly on the native float[] arrays
+  ImageProcessor.setRandomSeed(seed)
+  width, height = dimensions[0], dimensions[1]
+  for z in xrange(dimensions[2]):
+    fp = FloatProcessor(width, height, img.getPlane(z).getCurrentStorageArray())
+    fp.add(background)
+    fp.noise(noise_sd)
+  return img
+
+
+def syntheticAffine(dimensions, angle, translation):
+  """ A rotation by angle (in radians) around the Z axis through the center of the volume,
+      followed by a translation. Returns an AffineTransform3D. """
+  cx, cy = dimensions[0] / 2.0, dimensions[1] / 2.0
+  c, s = cos(angle), sin(angle)
+  tx, ty, tz = translation
+  return affine3D([c, -s, 0.0, cx - c * cx + s * cy + tx,
+                   s,  c, 0.0, cy - s * cx - c * cy + ty,
+                   0.0, 0.0, 1.0, tz])
+
+
+def syntheticSeries(dimensions, n_timepoints, n_nuclei, affine, sigma, margin=None, seed=1, **kwargs):
+  """ Render n_timepoints volumes where the nuclei of each are those of the prior one transformed by affine.
+      Returns the list of images and the list of lists of true nuclei positions, one per timepoint.
+      Additional keyword arguments are passed on to renderNuclei. """
+  if margin is None:
+    margin = max(dimensions) / 8
+  points = randomNuclei(dimensions, n_nuclei, margin, seed=seed)
+  images = []
+  positions = []
+  for t in xrange(n_timepoints):
+    images.append(renderNuclei(dimensions, points, sigma, seed=seed + t, **kwargs))
+    positions.append(points)
+    points = transformPoints(affine, points)
+  return images, positions
+
+
+def cumulativeAffine(affine, n):
+  """ The affine concatenated with itself n times; the identity for n=0. """
+  aff = AffineTransform3D()
+  aff.identity()
+  for _ in xrange(n):
+    aff.preConcatenate(affine)
+  return aff
+
+
+def transformError(matrix, expected, points):
+  """ Compare a 12-value row-packed affine matrix, as returned by e.g. registration.fitModel,
+      with the expected AffineTransform3D, by transforming each point with both.
+      Returns the mean and max distance. """
+  aff = affine3D(matrix)
+  a = RealPoint(3)
+  b = RealPoint(3)
+  distances = []
+  for p in points:
+    aff.apply(p, a)
+    expected.apply(p, b)
+    distances.append(sqrt(sum(pow(a.getDoublePosition(d) - b.getDoublePosition(d), 2) for d in xrange(3))))
+  if 0 == len(distances):
+    return 0.0, 0.0
+  return sum(distances) / len(distances), max(distances)
+
+
+def recall(peaks, points, max_distance):
+  """ Fraction of the true points that have a detected peak within max_distance. """
+  if 0 == len(points):
+    return 1.0
+  max_sq = max_distance * max_distance
+  found = 0
+  for p in points:
+    for peak in peaks:
+      if sum(pow(p.getDoublePosition(d) - peak.getDoublePosition(d), 2) for d in xrange(3)) < max_sq:
+        found += 1
+        break
+  return found / float(len(points))
+
+
+def measure(n_iterations, fn, *args, **kwargs):
+  """ Invoke fn n_iterations times.
+      Returns the result of the last invocation and the list of durations in milliseconds. """
+  times = []
+  result = None
+  for i in xrange(n_iterations):
+    t0 = System.nanoTime()
+    result = fn(*args, **kwargs)
+    t1 = System.nanoTime()
+    times.append((t1 - t0) / 1000000.0)
+  return result, times
+
+
+class BenchmarkReport:
+  """ Collects timings and accuracy measurements as rows of a CSV file.
+      Rows are appended to an existing file, so that consecutive runs
+      can be compared for regression tracking. """
+  columns = ["timestamp", "java", "cpus", "max_heap_mb",
+             "operation", "size", "n_threads", "n_iterations",
+             "min_ms", "max_ms", "mean_ms",
+             "count", "error_mean", "error_max", "passed"]
+
+  def __init__(self, path):
+    self.path = path
+    self.rows = []
+    runtime = Runtime.getRuntime()
+    self.context = {"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "java": System.getProperty("java.version"),
+                    "cpus": runtime.availableProcessors(),
+                    "max_heap_mb": runtime.maxMemory() / (1024 * 1024)}
+
+  def add(self, operation, dimensions, n_threads, times, count="", error_mean="", error_max="", passed=""):
+    row = dict(self.context)
+    row.update({"operation": operation,
+                "size": "x".join("%i" % dim for dim in dimensions),
+                "n_threads": n_threads,
+                "n_iterations": len(times),
+                "min_ms": min(times),
+                "max_ms": max(times),
+                "mean_ms": sum(times) / len(times),
+                "count": count,
+                "error_mean": error_mean,
+                "error_max": error_max,
+                "passed": passed})
+    self.rows.append(row)
+    syncPrint("%s %s threads=%i: min %.2f ms, mean %.2f ms %s" % \
+              (operation, row["size"], n_threads, row["min_ms"], row["mean_ms"],
+               "" if "" == passed else ("PASSED" if passed else "FAILED")))
+    return row
+
+  def write(self):
+    """ Append all rows to the CSV file, writing the header first if the file is new. """
+    exists = os.path.exists(self.path)
+    try:
+      with open(self.path, 'a') as csvfile:
+        w = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        if not exists:
+          w.writerow(BenchmarkReport.columns)
+        for row in self.rows:
+          w.writerow(tuple(row[column] for column in BenchmarkReport.columns))
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    except:
+      syncPrint("Failed to write benchmark report at %s" % self.path)
+      syncPrint(str(sys.exc_info()))
+
+  def failures(self):
+    return [row for row in self.rows if row["passed"] is False]
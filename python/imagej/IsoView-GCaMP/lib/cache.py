@@ -0,0 +1,192 @@
+from java.lang import Runtime, System
+from java.util.concurrent import FutureTask
+from net.imglib2 import RandomAccessibleInterval
+from net.imglib2.util import Intervals
+from net.imagej import ImgPlus
+from ij import ImagePlus
+from collections import OrderedDict
+from synchronize import make_synchronized
+# local lib functions:
+from util import newFixedThreadPool, syncPrint, Task
+
+
+def sizeOfArray(a):
+  """ The size in bytes of a native java array, from its typecode, e.g. 'h' for short[]. """
+  return len(a) * {'b': 1, 'z': 1, 'c': 2, 'h': 2, 'i': 4, 'f': 4, 'l': 8, 'd': 8}.get(a.typecode, 8)
+
+
+def sizeOfImage(img):
+  """ The size in bytes of the pixels of an ImagePlus or an imglib2 image, or of a native java array. """
+  if isinstance(img, ImagePlus):
+    return int(img.getSizeInBytes())
+  if isinstance(img, ImgPlus):
+    img = img.getImg()
+  if isinstance(img, RandomAccessibleInterval):
+    t = img.randomAccess().get()
+    bits = t.getBitsPerPixel() if hasattr(t, "getBitsPerPixel") else 64
+    return Intervals.numElements(img) * bits / 8
+  return sizeOfArray(img)
+
+
+class LRUCache:
+  """ A thread-safe cache that evicts the least recently used entries
+      once the sum of the sizes of its values exceeds a number of bytes. """
+  def __init__(self, max_bytes=0, sizeOf=sizeOfArray):
+    """ max_bytes: defaults to a tenth of the JVM max heap.
+        sizeOf: a function that returns the size in bytes of a value. Defaults to sizeOfArray. """
+    self.max_bytes = max_bytes if max_bytes > 0 else Runtime.getRuntime().maxMemory() / 10
+    self.sizeOf = sizeOf
+    self.entries = OrderedDict() # key vs (value, n_bytes)
+    self.n_bytes = 0
+    self.n_evictions = 0
+
+  @make_synchronized
+  def get(self, key, default=None):
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      return default
+    self.entries[key] = entry # move to the end: most recently used
+    return entry[0]
+
+  @make_synchronized
+  def put(self, key, value):
+    previous = self.entries.pop(key, None)
+    if previous is not None:
+      self.n_bytes -= previous[1]
+    n_bytes = self.sizeOf(value)
+    self.entries[key] = (value, n_bytes)
+    self.n_bytes += n_bytes
+    # Evict the least recently used, but never the entry just added
+    while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+      _, (_, evicted_bytes) = self.entries.popitem(last=False)
+      self.n_bytes -= evicted_bytes
+      self.n_evictions += 1
+
+  @make_synchronized
+  def __contains__(self, key):
+    return key in self.entries
+
+  @make_synchronized
+  def __len__(self):
+    return len(self.entries)
+
+  @make_synchronized
+  def clear(self):
+    self.entries.clear()
+    self.n_bytes = 0
+
+
+class TimePointCache:
+  """ A thread-safe memoizing cache of e.g. the 3D volume of each time point of a 4D series,
+      for use as the loader of a LazyCellImg. Volumes are evicted once their summed size
+      exceeds a number of bytes, rather than a number of entries.
+      Each key is loaded only once even when requested concurrently: other threads
+      asking for the same key wait for that load, while loads of other keys proceed in parallel.
+      When given the ordered list of keys, the keys adjacent to the requested one are loaded
+      in the background, for smooth sequential playback. """
+  def __init__(self, fn, keys=None, max_bytes=0, sizeOf=sizeOfImage, prefetch=0, n_threads=2):
+    """ fn: the function that loads the value of a key, e.g. a volume from a file path.
+        keys: the ordered list of keys, e.g. the file path of each time point. Needed for prefetching.
+        max_bytes: defaults to a tenth of the JVM max heap.
+        sizeOf: a function returning the size in bytes of a value. Defaults to sizeOfImage.
+        prefetch: how many keys to load in advance after and before the requested one, if keys are given.
+        n_threads: for prefetching. """
+    self.fn = fn
+    self.keys = keys
+    self.indices = dict((key, i) for i, key in enumerate(keys)) if keys else {}
+    self.cache = LRUCache(max_bytes=max_bytes, sizeOf=sizeOf)
+    self.prefetch = prefetch if keys else 0
+    self.pending = {} # key vs FutureTask of its load
+    self.exe = newFixedThreadPool(n_threads, name="timepoint-prefetcher") if self.prefetch > 0 else None
+    self.n_hits = 0
+    self.n_misses = 0 # includes waiting on a load that was already in progress
+    self.n_loads = 0
+    self.n_prefetches = 0
+    self.load_ms = 0.0
+
+  def load(self, key):
+    t0 = System.nanoTime()
+    try:
+      value = self.fn(key)
+      self.cache.put(key, value)
+      self.loaded(key, (System.nanoTime() - t0) / 1000000.0)
+      return value
+    finally:
+      self.release(key)
+
+  @make_synchronized
+  def loaded(self, key, ms):
+    self.n_loads += 1
+    self.load_ms += ms
+
+  @make_synchronized
+  def release(self, key):
+    self.pending.pop(key, None)
+
+  @make_synchronized
+  def lookup(self, key):
+    """ Return the cached value of the key if any, and otherwise the FutureTask that loads it,
+        and whether the caller is the one who has to run it. """
+    value = self.cache.get(key)
+    if value is not None:
+      self.n_hits += 1
+      return value, None, False
+    self.n_misses += 1
+    task = self.pending.get(key, None)
+    if task is not None:
+      return None, task, False
+    task = FutureTask(Task(self.load, key))
+    self.pending[key] = task
+    return None, task, True
+
+  @make_synchronized
+  def prefetchAround(self, key):
+    if not self.exe or key not in self.indices:
+      return
+    index = self.indices[key]
+    for i in xrange(1, self.prefetch + 1):
+      for k in (index + i, index - i):
+        if 0 <= k < len(self.keys):
+          neighbor = self.keys[k]
+          if neighbor not in self.pending and neighbor not in self.cache:
+            task = FutureTask(Task(self.load, neighbor))
+            self.pending[neighbor] = task
+            self.n_prefetches += 1
+            self.exe.execute(task)
+
+  def __call__(self, key):
+    value, task, owner = self.lookup(key)
+    if value is None:
+      if owner:
+        task.run() # in this thread
+      value = task.get()
+    self.prefetchAround(key)
+    return value
+
+  def get(self, key):
+    return self(key)
+
+  @make_synchronized
+  def stats(self):
+    """ Return a dictionary with the counts of hits, misses, loads, prefetches and evictions,
+        the mean load time in milliseconds, and the number of entries and of bytes cached. """
+    return {"hits": self.n_hits,
+            "misses": self.n_misses,
+            "loads": self.n_loads,
+            "prefetches": self.n_prefetches,
+            "evictions": self.cache.n_evictions,
+            "mean_load_ms": self.load_ms / self.n_loads if self.n_loads > 0 else 0.0,
+            "entries": len(self.cache),
+            "bytes": self.cache.n_bytes}
+
+  def printStats(self):
+    syncPrint(", ".join("%s: %s" % item for item in sorted(self.stats().iteritems())))
+
+  @make_synchronized
+  def destroy(self):
+    """ Stop prefetching and release the cached values. """
+    if self.exe:
+      self.exe.shutdownNow()
+      self.exe = None
+    self.pending.clear()
+    self.cache.clear()
@@ -1,5 +1,15 @@
 from net.imglib2.algorithm.dog import DogDetection
 from net.imglib2.view import Views
+from net.imglib2.util import Intervals
+from net.imglib2 import RealPoint
+from java.io import RandomAccessFile
+from java.lang import System
+from java.nio import ByteBuffer
+from jarray import zeros
+from synchronize import make_synchronized
+import os
+# local lib functions:
+from util import syncPrint, newFixedThreadPool, Task
 
 
 def createDoG(img, calibration, sigmaSmaller, sigmaLarger, minPeakValue):
@@ -26,3 +36,159 @@ def getDoGPeaks(img, calibration, sigmaSmaller, sigmaLarger, minPeakValue):
       peak.setPosition(peak.getFloatPosition(d) * cal, d)
   return peaks
 
+
+
+class PeaksStore:
+  """ A binary file with the peaks of each time point, for random access by time point index
+      without loading or recomputing them all. Layout, big-endian:
+        header: the magic bytes "DOGP", then int version, int n_timepoints and int n_dimensions,
+                int n_parameters and that many double parameters of the detection (absent in version 1).
+        table: for each time point, the long offset of its peaks, or -1 if not yet stored,
+               and the int number of peaks.
+        data: for each time point, its peaks as a sequence of float coordinates.
+      Time points can be stored in any order, and the table entry of each is written
+      right after its peaks, so that an interrupted batch leaves a valid file. """
+  MAGIC = "DOGP"
+  VERSION = 2
+  ENTRY_SIZE = 12
+
+  def __init__(self, path, n_timepoints=None, n_dimensions=3, parameters=None):
+    """ Open the file at path, or create it if it doesn't exist, in which case n_timepoints is required.
+        parameters: optional list of numbers with which the peaks were detected, such as the calibration,
+                    sigmas and minimum peak value, so that peaks detected with other parameters aren't reused.
+        An existing file with a different number of time points or dimensions is an error,
+        and so is one with different parameters, when given. """
+    exists = os.path.exists(path)
+    if not exists and n_timepoints is None:
+      raise Exception("Can't create a PeaksStore at %s without a number of time points" % path)
+    self.path = path
+    self.ra = RandomAccessFile(path, 'rw')
+    if exists:
+      magic = zeros(4, 'b')
+      self.ra.readFully(magic)
+      if magic.tostring() != PeaksStore.MAGIC:
+        self.ra.close()
+        raise Exception("Not a PeaksStore file: %s" % path)
+      version = self.ra.readInt()
+      self.n_timepoints = self.ra.readInt()
+      self.n_dimensions = self.ra.readInt()
+      if (n_timepoints is not None and n_timepoints != self.n_timepoints) or n_dimensions != self.n_dimensions:
+        self.ra.close()
+        raise Exception("PeaksStore at %s has %i time points of %i dimensions, not %s of %i" % (path, self.n_timepoints, self.n_dimensions, n_timepoints, n_dimensions))
+      self.parameters = [self.ra.readDouble() for i in xrange(self.ra.readInt())] if version > 1 else []
+      if parameters is not None and [float(v) for v in parameters] != self.parameters:
+        self.ra.close()
+        raise Exception("PeaksStore at %s has peaks detected with parameters %s, not %s: delete it or use another path" % (path, self.parameters, list(parameters)))
+      self.header_size = self.ra.getFilePointer()
+      self.offsets = []
+      self.counts = []
+      for t in xrange(self.n_timepoints):
+        self.offsets.append(self.ra.readLong())
+        self.counts.append(self.ra.readInt())
+    else:
+      self.n_timepoints = n_timepoints
+      self.n_dimensions = n_dimensions
+      self.parameters = [float(v) for v in parameters] if parameters is not None else []
+      self.offsets = [-1] * n_timepoints
+      self.counts = [0] * n_timepoints
+      self.ra.writeBytes(PeaksStore.MAGIC)
+      self.ra.writeInt(PeaksStore.VERSION)
+      self.ra.writeInt(n_timepoints)
+      self.ra.writeInt(n_dimensions)
+      self.ra.writeInt(len(self.parameters))
+      for v in self.parameters:
+        self.ra.writeDouble(v)
+      self.header_size = self.ra.getFilePointer()
+      for t in xrange(n_timepoints):
+        self.ra.writeLong(-1)
+        self.ra.writeInt(0)
+
+  def has(self, t):
+    return self.offsets[t] >= 0
+
+  def missing(self):
+    """ The indices of the time points whose peaks are not stored yet. """
+    return [t for t in xrange(self.n_timepoints) if not self.has(t)]
+
+  @make_synchronized
+  def write(self, t, peaks):
+    """ Append the peaks of time point t, given as RealLocalizable instances. """
+    coords = zeros(len(peaks) * self.n_dimensions, 'f')
+    p = zeros(self.n_dimensions, 'f')
+    for i, peak in enumerate(peaks):
+      peak.localize(p)
+      System.arraycopy(p, 0, coords, i * self.n_dimensions, self.n_dimensions)
+    bb = ByteBuffer.allocate(len(coords) * 4)
+    bb.asFloatBuffer().put(coords)
+    offset = self.ra.length()
+    self.ra.seek(offset)
+    self.ra.write(bb.array())
+    # The table entry last
+    self.ra.seek(self.header_size + t * PeaksStore.ENTRY_SIZE)
+    self.ra.writeLong(offset)
+    self.ra.writeInt(len(peaks))
+    self.offsets[t] = offset
+    self.counts[t] = len(peaks)
+
+  @make_synchronized
+  def readCoordinates(self, t):
+    """ Return the peaks of time point t as a flat float array of coordinates, with one seek,
+        or None if not stored. """
+    if not self.has(t):
+      return None
+    bytes = zeros(self.counts[t] * self.n_dimensions * 4, 'b')
+    self.ra.seek(self.offsets[t])
+    self.ra.readFully(bytes)
+    coords = zeros(self.counts[t] * self.n_dimensions, 'f')
+    ByteBuffer.wrap(bytes).asFloatBuffer().get(coords)
+    return coords
+
+  def read(self, t):
+    """ Return the peaks of time point t as a list of RealPoint, or None if not stored. """
+    coords = self.readCoordinates(t)
+    if coords is None:
+      return None
+    n = self.n_dimensions
+    return [RealPoint(coords[i: i + n]) for i in xrange(0, len(coords), n)]
+
+  @make_synchronized
+  def close(self):
+    self.ra.close()
+
+
+def getDoGPeaksForAll(getImg, n_timepoints, path, calibration, sigmaSmaller, sigmaLarger, minPeakValue,
+                      n_threads=0, bytes_per_task=0, verbose=True):
+  """ Detect the peaks of every time point concurrently, storing them in a PeaksStore at path
+      as each time point is done. Time points already in the store are skipped, so that an interrupted
+      batch can be resumed.
+
+      getImg: a function that returns the 3D img of a time point index, e.g. from a cache.
+      n_timepoints: the number of time points.
+      path: the file for the PeaksStore. An existing one whose peaks were detected
+            with other calibration, sigmas or minPeakValue is an error.
+      n_threads: number of time points to process concurrently. Defaults to as many as CPUs,
+                 but no more than fit in the heap (see util.memoryBoundThreadCount).
+      bytes_per_task: the memory needed to process one time point.
+                      Defaults to that of the DoG: 3 floats per voxel of the first img.
+
+      Returns the open PeaksStore. """
+  store = PeaksStore(path, n_timepoints=n_timepoints, n_dimensions=len(calibration),
+                     parameters=list(calibration) + [sigmaSmaller, sigmaLarger, minPeakValue])
+  missing = store.missing()
+  if not missing:
+    return store
+  if 0 == bytes_per_task:
+    bytes_per_task = Intervals.numElements(getImg(missing[0])) * 4 * 3
+  exe = newFixedThreadPool(n_threads, name="dog-peaks", bytes_per_task=bytes_per_task)
+  def detect(t):
+    peaks = getDoGPeaks(getImg(t), calibration, sigmaSmaller, sigmaLarger, minPeakValue)
+    store.write(t, peaks)
+    if verbose:
+      syncPrint("Found %i peaks in time point %i" % (len(peaks), t))
+  try:
+    futures = [exe.submit(Task(detect, t)) for t in missing]
+    for f in futures:
+      f.get()
+  finally:
+    exe.shutdown()
+  return store
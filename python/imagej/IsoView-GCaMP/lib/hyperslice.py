@@ -0,0 +1,198 @@
+from ij import ImagePlus, ImageStack, VirtualStack
+from ij.io import FileInfo, TiffDecoder
+from ij.plugin import FileInfoVirtualStack
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer, ByteOrder
+from java.lang import System
+from java.util.concurrent import ExecutorCompletionService
+from jarray import zeros
+import os
+# local lib functions:
+from util import syncPrint, newFixedThreadPool, Task
+from cache import LRUCache
+
+
+# Pixel types that can be read directly from uncompressed files, as java array typecodes
+_typecodes = {FileInfo.GRAY8: 'b',
+              FileInfo.GRAY16_UNSIGNED: 'h',
+              FileInfo.GRAY32_FLOAT: 'f'}
+
+_bytesPerPixel = {'b': 1, 'h': 2, 'f': 4}
+
+# Typecodes of the pixel arrays of ImagePlus bit depths
+_bitDepthTypecodes = {8: 'b', 16: 'h', 32: 'f'}
+
+
+def readRows(path, fi, plane_index, y0, y1):
+  """ Read only the rows [y0, y1) of a plane of an uncompressed image file.
+      fi: the ij.io.FileInfo describing the file.
+      plane_index: 0-based index of the plane within the file.
+      Returns a native array of bytes, shorts or floats. """
+  typecode = _typecodes[fi.fileType]
+  bpp = _bytesPerPixel[typecode]
+  row_bytes = fi.width * bpp
+  plane_bytes = row_bytes * fi.height
+  offset = fi.getOffset() + plane_index * (plane_bytes + fi.gapBetweenImages) + y0 * row_bytes
+  bytes = zeros((y1 - y0) * row_bytes, 'b')
+  ra = RandomAccessFile(path, 'r')
+  try:
+    ra.seek(offset)
+    ra.readFully(bytes)
+  finally:
+    ra.close()
+  if 'b' == typecode:
+    return bytes
+  bb = ByteBuffer.wrap(bytes).order(ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN)
+  pixels = zeros(len(bytes) / bpp, typecode)
+  if 'h' == typecode:
+    bb.asShortBuffer().get(pixels)
+  else:
+    bb.asFloatBuffer().get(pixels)
+  return pixels
+
+
+def isRangeReadable(fi):
+  return fi is not None \
+     and fi.fileType in _typecodes \
+     and fi.compression in (FileInfo.COMPRESSION_UNKNOWN, FileInfo.COMPRESSION_NONE)
+
+
+class PlaneReader:
+  """ Read rows of the planes of an ImagePlus stack, reading from the file only the rows requested
+      when the stack is virtual and backed by uncompressed TIFF or raw files,
+      and otherwise decoding the whole plane. Rows read are cached for repeated access. """
+  def __init__(self, imp, cache_bytes=0):
+    self.imp = imp
+    self.stack = imp.getStack()
+    self.width = imp.getWidth()
+    self.height = imp.getHeight()
+    self.cache = LRUCache(cache_bytes)
+    self.file_infos = {} # per-plane file path vs FileInfo
+    self.fi = None
+    if isinstance(self.stack, FileInfoVirtualStack):
+      # e.g. a TIFF file opened as a virtual stack
+      fi = imp.getOriginalFileInfo()
+      if isRangeReadable(fi) and fi.nImages >= self.stack.getSize():
+        self.fi = fi
+
+  def fileInfo(self, n):
+    """ Return the path and FileInfo, and the 0-based index of the plane in the file,
+        or None if plane n (1-based) can't be read as a range of bytes. """
+    if self.fi:
+      return os.path.join(self.fi.directory, self.fi.fileName), self.fi, n - 1
+    if isinstance(self.stack, VirtualStack) and not isinstance(self.stack, FileInfoVirtualStack):
+      # e.g. an image sequence: one file per plane
+      directory, filename = self.stack.getDirectory(), self.stack.getFileName(n)
+      if not directory or not filename or not filename.lower().endswith((".tif", ".tiff")):
+        return None
+      path = os.path.join(directory, filename)
+      if path not in self.file_infos:
+        infos = TiffDecoder(directory, filename).getTiffInfo()
+        self.file_infos[path] = infos[0] if infos and isRangeReadable(infos[0]) else None
+      fi = self.file_infos[path]
+      if fi and fi.width == self.width and fi.height == self.height:
+        return path, fi, 0
+    return None
+
+  def read(self, n, y0=0, y1=None):
+    """ Return the pixels of rows [y0, y1) of the plane at stack index n (1-based),
+        as a native array of the ImagePlus pixel type. """
+    y1 = y1 if y1 is not None else self.height
+    key = (n, y0, y1)
+    pixels = self.cache.get(key)
+    if pixels is not None:
+      return pixels
+    source = self.fileInfo(n) if self.stack.isVirtual() else None
+    if source:
+      pixels = readRows(*(source + (y0, y1)))
+    else:
+      # In memory, or for a compressed or unsupported file: decode the whole plane
+      pixels = self.stack.getPixels(n) if not self.stack.isVirtual() else self.stack.getProcessor(n).getPixels()
+      if 0 != y0 or self.height != y1:
+        pixels = pixels[y0 * self.width: y1 * self.width]
+    self.cache.put(key, pixels)
+    return pixels
+
+
+class HyperSlicer:
+  """ Extract a plane at a fixed position across all time points of a 4D ImagePlus,
+      as a new stack with one slice per time point:
+        "XY": the plane at a Z (slice) index.
+        "XZ": the plane at a Y coordinate, with one row per Z.
+        "YZ": the plane at an X coordinate, with one row per Z.
+      Planes are extracted in parallel, and published to the stack in order
+      as soon as each is ready. Source planes are cached across calls. """
+  def __init__(self, imp, cache_bytes=0, n_threads=0):
+    """ imp: the 4D ImagePlus, possibly a virtual hyperstack.
+        cache_bytes: the maximum size of the cache of rows read. Defaults to a tenth of the JVM max heap.
+        n_threads: defaults to as many as CPUs. """
+    self.imp = imp
+    self.reader = PlaneReader(imp, cache_bytes=cache_bytes)
+    self.n_threads = n_threads
+    self.typecode = _bitDepthTypecodes.get(imp.getBitDepth(), None)
+
+  def dimensions(self, axis):
+    """ The width and height of the extracted planes. """
+    w, h, depth = self.imp.getWidth(), self.imp.getHeight(), self.imp.getNSlices()
+    return {"XY": (w, h), "XZ": (w, depth), "YZ": (h, depth)}[axis]
+
+  def plane(self, axis, position, channel, frame):
+    """ Return the pixels of the plane at the 1-based channel and frame. """
+    imp = self.imp
+    if "XY" == axis:
+      # A copy, given that the cached pixels could otherwise be edited
+      return self.reader.read(imp.getStackIndex(channel, position, frame))[:]
+    w, h = self.dimensions(axis)
+    pixels = zeros(w * h, self.typecode)
+    for z in xrange(h):
+      n = imp.getStackIndex(channel, z + 1, frame)
+      if "XZ" == axis:
+        row = self.reader.read(n, position, position + 1)
+      else:
+        row = self.reader.read(n)[position::imp.getWidth()]
+      System.arraycopy(row, 0, pixels, z * w, w)
+    return pixels
+
+  def extract(self, axis="XY", position=None, channel=None, show=True):
+    """ axis: "XY", "XZ" or "YZ".
+        position: the 1-based Z slice for "XY", or the 0-based Y or X coordinate for "XZ" or "YZ".
+                  Defaults to the current slice, or to the center of the image.
+        channel: the 1-based channel. Defaults to the current one.
+        show: whether to show the ImagePlus right away, to watch its slices being filled in.
+
+        Returns the ImagePlus with one slice per time point. """
+    imp = self.imp
+    if axis not in ("XY", "XZ", "YZ"):
+      syncPrint("Unsupported axis: %s" % axis)
+      return None
+    if self.typecode is None:
+      syncPrint("Unsupported bit depth: %i" % imp.getBitDepth())
+      return None
+    if position is None:
+      position = {"XY": imp.getZ(), "XZ": imp.getHeight() / 2, "YZ": imp.getWidth() / 2}[axis]
+    channel = channel if channel else imp.getC()
+    n_frames = imp.getNFrames()
+    w, h = self.dimensions(axis)
+    # Slices start blank, and are filled in as they are extracted
+    stack = ImageStack(w, h)
+    for t in xrange(n_frames):
+      stack.addSlice("t=%i" % (t + 1), zeros(w * h, self.typecode))
+    slicer = ImagePlus("%s hyperslice at %i of %s" % (axis, position, imp.getTitle()), stack)
+    slicer.setCalibration(imp.getCalibration().copy())
+    if show:
+      slicer.show()
+
+    exe = newFixedThreadPool(self.n_threads, name="hyperslicer")
+    try:
+      completion = ExecutorCompletionService(exe)
+      for t in xrange(n_frames):
+        completion.submit(Task(lambda t: (t, self.plane(axis, position, channel, t + 1)), t))
+      for _ in xrange(n_frames):
+        t, pixels = completion.take().get()
+        stack.setPixels(pixels, t + 1)
+        if t + 1 == slicer.getCurrentSlice():
+          slicer.updateAndDraw()
+    finally:
+      exe.shutdownNow()
+    slicer.updateAndDraw()
+    return slicer
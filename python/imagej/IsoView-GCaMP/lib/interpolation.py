@@ -0,0 +1,215 @@
+from net.imglib2.img.array import ArrayImg, ArrayImgs
+from java.lang import Float, Double, Math, Runtime
+from fiji.scripting import Weaver
+from jarray import zeros
+# local lib functions:
+from util import newFixedThreadPool, Task
+from projection import toFloats
+
+
+# Interpolation of binary masks via signed distance transforms,
+# as in ini.trakem2.imaging.BinaryInterpolation2D and vib.BinaryInterpolator:
+# each pixel of a mask is assigned its euclidean distance to the nearest edge pixel of the mask,
+# positive inside and negative outside, and the interpolated mask is wherever
+# the weighted sum of the signed distances of both masks is larger than zero.
+#
+# Edge pixels are the non-zero pixels with at least one zero pixel among their 26 neighbors
+# (8 neighbors in 2D), with pixels outside the image counting as zero.
+# Distances are computed exactly, in linear time, with the separable algorithm of
+# Felzenszwalb & Huttenlocher (2012) "Distance transforms of sampled functions":
+# the squared distance transform of the edges is computed one dimension at a time,
+# in parallel over the lines of pixels along that dimension.
+
+
+# Mark the edge pixels as zero and all others as Float.MAX_VALUE, for the rows [r0, r1),
+# with row r at Y (r % height) and Z (r / height).
+_seedTemplate = """
+  static public final void seedEdges_%(name)s(final %(type)s[] mask, final int width, final int height, final int depth,
+                                              final int r0, final int r1, final float[] f) {
+    final int plane = width * height,
+              dz0 = depth > 1 ? -1 : 0,
+              dz1 = depth > 1 ? 1 : 0;
+    for (int r=r0; r<r1; ++r) {
+      final int y = r %% height,
+                z = r / height;
+      for (int x=0; x<width; ++x) {
+        final int i = z * plane + y * width + x;
+        boolean edge = false;
+        if (0 != mask[i]) {
+          for (int dz=dz0; dz<=dz1 && !edge; ++dz) {
+            final int zz = z + dz;
+            if (zz < 0 || zz >= depth) { edge = true; break; }
+            for (int dy=-1; dy<=1 && !edge; ++dy) {
+              final int yy = y + dy;
+              if (yy < 0 || yy >= height) { edge = true; break; }
+              for (int dx=-1; dx<=1; ++dx) {
+                final int xx = x + dx;
+                if (xx < 0 || xx >= width || 0 == mask[zz * plane + yy * width + xx]) { edge = true; break; }
+              }
+            }
+          }
+        }
+        f[i] = edge ? 0 : Float.MAX_VALUE;
+      }
+    }
+  }
+
+  static public final void sign_%(name)s(final %(type)s[] mask, final float[] f, final int i0, final int i1) {
+    for (int i=i0; i<i1; ++i) {
+      final float d = (float)Math.sqrt(f[i]);
+      f[i] = 0 == mask[i] ? -d : d;
+    }
+  }
+"""
+
+_maskTypes = {'b': ("bytes", "byte"),
+              'f': ("floats", "float")}
+
+kernels = Weaver.method("\n".join(_seedTemplate % {"name": name, "type": jtype}
+                                  for name, jtype in _maskTypes.itervalues()) + """
+  // Squared euclidean distance transform, in place, of the lines [l0, l1) of pixels along one dimension,
+  // where the pixels of a line are stride apart, and a line has length pixels.
+  // Pixels of value Float.MAX_VALUE are at infinite distance.
+  static public final void edt(final float[] f, final int stride, final int length, final int l0, final int l1) {
+    final float[] g = new float[length];
+    final int[] v = new int[length];
+    final double[] z = new double[length + 1];
+    for (int l=l0; l<l1; ++l) {
+      final int start = (l / stride) * stride * length + (l % stride);
+      for (int q=0; q<length; ++q) g[q] = f[start + q * stride];
+      // Lower envelope of the parabolas rooted at the pixels at finite distance
+      int k = -1;
+      for (int q=0; q<length; ++q) {
+        if (Float.MAX_VALUE == g[q]) continue;
+        if (-1 == k) {
+          k = 0;
+          v[0] = q;
+          z[0] = Double.NEGATIVE_INFINITY;
+          z[1] = Double.POSITIVE_INFINITY;
+          continue;
+        }
+        double s = ((g[q] + (double)q * q) - (g[v[k]] + (double)v[k] * v[k])) / (2.0 * (q - v[k]));
+        while (s <= z[k]) {
+          --k;
+          s = ((g[q] + (double)q * q) - (g[v[k]] + (double)v[k] * v[k])) / (2.0 * (q - v[k]));
+        }
+        ++k;
+        v[k] = q;
+        z[k] = s;
+        z[k + 1] = Double.POSITIVE_INFINITY;
+      }
+      if (-1 == k) continue; // no pixels at finite distance along this line
+      k = 0;
+      for (int q=0; q<length; ++q) {
+        while (z[k + 1] < q) ++k;
+        final int d = q - v[k];
+        f[start + q * stride] = (float)(d * d + g[v[k]]);
+      }
+    }
+  }
+
+  static public final void threshold(final float[] d1, final float[] d2, final float weight,
+                                     final byte[] target, final int i0, final int i1) {
+    for (int i=i0; i<i1; ++i) {
+      target[i] = (byte)(weight * d1[i] + (1 - weight) * d2[i] > 0 ? 1 : 0);
+    }
+  }
+""", [Float, Double, Math])
+
+
+def _chunks(n, n_chunks):
+  """ Split the range [0, n) into at most n_chunks contiguous ranges, as (start, end) tuples. """
+  step = max(1, (n + n_chunks - 1) / n_chunks)
+  return [(i, min(n, i + step)) for i in xrange(0, n, step)]
+
+
+def _run(exe, fn, ranges, *args):
+  """ Invoke fn for each (start, end) in ranges with the args, in parallel, and wait for all. """
+  futures = [exe.submit(Task(fn, *(args + (start, end)))) for start, end in ranges]
+  for f in futures:
+    f.get()
+
+
+def signedDistanceTransform(mask, n_threads=0, exe=None):
+  """
+  Compute, for every pixel of a 2D or 3D binary mask, the exact euclidean distance
+  to the nearest edge pixel of the mask, positive inside the mask and negative outside.
+  A mask without any non-zero pixel is at infinite distance everywhere.
+
+  mask: any 2D or 3D image where non-zero pixels are inside. An ArrayImg of bytes, e.g. of UnsignedByteType,
+        is read directly; any other is first copied into a float array.
+  n_threads: defaults to as many as CPUs. Ignored when an exe is given.
+  exe: the ExecutorService to use (optional).
+
+  Returns an ArrayImg of FloatType.
+  """
+  dimensions = [mask.dimension(d) for d in xrange(mask.numDimensions())]
+  width, height = dimensions[0], dimensions[1]
+  depth = dimensions[2] if len(dimensions) > 2 else 1
+  size = width * height * depth
+  pixels = None
+  if isinstance(mask, ArrayImg):
+    pixels = mask.update(None).getCurrentStorageArray()
+    if pixels.typecode not in _maskTypes:
+      pixels = None
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool(n_threads, name="signed-distance-transform")
+  try:
+    if pixels is None:
+      pixels = toFloats(mask, exe=exe)
+    name = _maskTypes[pixels.typecode][0]
+    n_chunks = 4 * Runtime.getRuntime().availableProcessors()
+    f = zeros(size, 'f')
+    _run(exe, getattr(kernels, "seedEdges_" + name), _chunks(height * depth, n_chunks),
+         pixels, width, height, depth)
+    # One pass per dimension, each in parallel over the lines of pixels along it
+    for stride, length in ((1, width), (width, height), (width * height, depth)):
+      if length > 1:
+        _run(exe, kernels.edt, _chunks(size / length, n_chunks), f, stride, length)
+    _run(exe, getattr(kernels, "sign_" + name), _chunks(size, n_chunks), pixels, f)
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return ArrayImgs.floats(f, dimensions)
+
+
+def interpolateFromDistances(sdt1, sdt2, weight, n_threads=0, exe=None):
+  """
+  Return the interpolated binary mask, as an ArrayImg of UnsignedByteType with ones inside,
+  from the signed distance transforms of two masks (see signedDistanceTransform).
+
+  weight: between 0 and 1. A weight of zero means that the first mask is not present at all
+          in the interpolated mask; a weight of one means that the first mask is present exclusively.
+  """
+  d1 = sdt1.update(None).getCurrentStorageArray()
+  d2 = sdt2.update(None).getCurrentStorageArray()
+  target = zeros(len(d1), 'b')
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool(n_threads, name="interpolate-masks")
+  try:
+    _run(exe, kernels.threshold, _chunks(len(d1), 4 * Runtime.getRuntime().availableProcessors()),
+         d1, d2, weight, target)
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return ArrayImgs.unsignedBytes(target, [sdt1.dimension(d) for d in xrange(sdt1.numDimensions())])
+
+
+def interpolateMasks(img1, img2, weights, n_threads=0):
+  """
+  Generate interpolated binary masks between two 2D or 3D binary masks of the same dimensions,
+  computing the signed distance transform of each mask only once for all weights.
+
+  weights: a list of floats between 0 and 1, each the weight of the first mask (see interpolateFromDistances).
+
+  Returns a list of ArrayImg of UnsignedByteType, one per weight, with ones inside.
+  """
+  exe = newFixedThreadPool(n_threads, name="interpolate-masks")
+  try:
+    sdt1 = signedDistanceTransform(img1, exe=exe)
+    sdt2 = signedDistanceTransform(img2, exe=exe)
+    return [interpolateFromDistances(sdt1, sdt2, weight, exe=exe) for weight in weights]
+  finally:
+    exe.shutdown()
@@ -1,5 +1,12 @@
-from java.io import RandomAccessFile
-from net.imglib2.img.array import ArrayImgs
+from java.io import RandomAccessFile, File, FileOutputStream
+from net.imglib2.img.array import ArrayImgs, ArrayImg
+from net.imglib2.img.basictypeaccess.array import ShortArray
+from net.imglib2.type.numeric import RealType
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.util import Intervals
+from net.imglib2 import Cursor
+from net.imagej import ImgPlus
+from fiji.scripting import Weaver
 from jarray import zeros
 from java.nio import ByteBuffer
 import operator
@@ -12,8 +19,10 @@ from net.imglib2.realtransform import RealViews
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
 from ij.io import FileSaver
 from ij import ImagePlus, IJ
+from java.lang import Thread
+import os
 from synchronize import make_synchronized
-from util import syncPrint, newFixedThreadPool
+from util import syncPrint, newFixedThreadPool, Task
 from ui import showStack, showBDV
 try:
   # Needs 'SiMView' Fiji update site enabled
@@ -24,7 +33,7 @@ try:
   from org.janelia.saalfeldlab.n5.imglib2 import N5Utils
 except:
   print "*** n5-imglib2 from github.com/saalfeldlab not installed. ***"
-from org.janelia.saalfeldlab.n5 import N5FSReader, N5FSWriter, GzipCompression
+from org.janelia.saalfeldlab.n5 import N5FSReader, N5FSWriter, GzipCompression, DefaultBlockWriter
 from com.google.gson import GsonBuilder
 
 
@@ -76,6 +85,69 @@ def writeZip(img, path, title=""):
   return imp
 
 
+# Compiled on first use
+_shortCopier = None
+
+def _copyShorts():
+  global _shortCopier
+  if _shortCopier is None:
+    _shortCopier = Weaver.method("""
+      static public final void copy(final Cursor c, final short[] a, final int offset) {
+        int i = offset;
+        while (c.hasNext()) {
+          final Object t = c.next();
+          if (t instanceof UnsignedShortType) a[i++] = (short) ((UnsignedShortType) t).get();
+          else a[i++] = (short) (int) ((RealType) t).getRealFloat();
+        }
+      }
+    """, [Cursor, RealType, UnsignedShortType])
+  return _shortCopier.copy
+
+
+def asShortArray(img, exe=None):
+  """ Return the pixels of img, of any RealType, or of an ImagePlus, as a flat short[] in flat iteration order.
+      An ArrayImg of shorts returns its own backing array. Any other image, e.g. a SCIFIO-wrapped
+      or a transformed one, is copied once, in parallel over the planes of its last dimension,
+      with each plane walked by a compiled cursor loop.
+      Values outside the 16-bit range wrap around.
+      exe: the ExecutorService to use (optional). """
+  if isinstance(img, ImagePlus):
+    img = IL.wrap(img)
+  if isinstance(img, ImgPlus):
+    img = img.getImg()
+  if isinstance(img, ArrayImg):
+    pixels = img.update(None).getCurrentStorageArray()
+    if 'h' == getattr(pixels, "typecode", None):
+      return pixels
+  copy = _copyShorts()
+  pixels = zeros(Intervals.numElements(img), 'h')
+  last = img.numDimensions() - 1
+  if last < 2:
+    copy(Views.flatIterable(img).cursor(), pixels, 0)
+    return pixels
+  plane_size = Intervals.numElements(img) / img.dimension(last)
+  def copyPlane(index):
+    plane = Views.hyperSlice(img, last, img.min(last) + index)
+    copy(Views.flatIterable(plane).cursor(), pixels, index * plane_size)
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool(name="copy-planes")
+  try:
+    futures = [exe.submit(Task(copyPlane, index)) for index in xrange(img.dimension(last))]
+    for f in futures:
+      f.get()
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return pixels
+
+
+def shortAccess(img, exe=None):
+  """ Return a ShortArray data access over the pixels of img, e.g. for the Cell of a LazyCellImg.
+      See asShortArray. """
+  return ShortArray(asShortArray(img, exe=exe))
+
+
 class KLBLoader(CacheLoader):
   def __init__(self):
     self.klb = KLB.newInstance()
@@ -114,17 +186,31 @@ class ImageJLoader(CacheLoader):
     return self.get(path)
 
 
-def readN5(path, dataset_name, show=None):
+class N5TimePointLoader(CacheLoader):
+  """ Load each time point of a 4D N5 dataset as a 3D volume, for use with e.g. projection.project.
+      The time point indices are the keys. """
+  def __init__(self, path, dataset_name):
+    self.img = N5Utils.open(N5FSReader(path, GsonBuilder()), dataset_name)
+  def keys(self):
+    return range(self.img.dimension(self.img.numDimensions() - 1))
+  def get(self, index):
+    return Views.hyperSlice(self.img, self.img.numDimensions() - 1, index)
+  def load(self, index):
+    return self.get(index)
+
+
+def readN5(path, dataset_name, show=None, cached=False):
   """ path: filepath to the folder with N5 data.
       dataset_name: name of the dataset to use (there could be more than one).
       show: defaults to None. "IJ" for virtual stack, "BDV" for BigDataViewer.
+      cached: for "IJ", whether to use a cached, prefetching virtual stack (see ui.showStack).
       
       If "IJ", returns the RandomAccessibleInterval and the ImagePlus.
       If "BDV", returns the RandomAccessibleInterval and the bdv instance. """
   img = N5Utils.open(N5FSReader(path, GsonBuilder()), dataset_name)
   if show:
     if "IJ" == show:
-      return img, showStack(img, title=dataset_name)
+      return img, showStack(img, title=dataset_name, cached=cached)
     elif "BDV" == show:
       return img, showBDV(img, title=dataset_name)
   return img
@@ -139,7 +225,44 @@ def writeN5(img, path, dataset_name, blockSize, gzip_compression_level=4, n_thre
       gzip_compression_level: defaults to 4, ranges from 0 (no compression) to 9 (maximum;
                               see java.util.zip.Deflater for details.).
       n_threads: defaults to as many as CPU cores, for parallel writing. """
-  N5Utils.save(img, N5FSWriter(path, GsonBuilder()),
-               dataset_name, blockSize,
-               GzipCompression(gzip_compression_level),
-               newFixedThreadPool(n_threads))
+  exe = newFixedThreadPool(n_threads)
+  try:
+    N5Utils.save(img, N5FSWriter(path, GsonBuilder()),
+                 dataset_name, blockSize,
+                 GzipCompression(gzip_compression_level),
+                 exe)
+  finally:
+    exe.shutdown()
+
+
+
+def n5BlockPath(path, dataset_name, grid_position):
+  """ The file of a block of an N5 dataset on the filesystem: <path>/<dataset>/<x>/<y>/... """
+  return os.path.join(path, dataset_name, *[str(g) for g in grid_position])
+
+
+def writeN5Block(path, dataset_name, attributes, block):
+  """ Write a DataBlock of an existing N5 dataset, like N5FSWriter.writeBlock,
+      but into a temporary file that is then renamed, so that a block interrupted while
+      being written is never mistaken for a complete one, e.g. when resuming an export
+      by skipping the blocks whose file exists.
+      path: the directory of the N5 container.
+      attributes: the DatasetAttributes of the dataset. """
+  target = n5BlockPath(path, dataset_name, block.getGridPosition())
+  parent = os.path.dirname(target)
+  if not os.path.exists(parent):
+    try:
+      os.makedirs(parent)
+    except OSError:
+      pass # created concurrently
+  tmp = target + ".%i.tmp" % Thread.currentThread().getId()
+  fos = FileOutputStream(tmp)
+  try:
+    DefaultBlockWriter.writeBlock(fos, attributes, block)
+  finally:
+    fos.close()
+  if not File(tmp).renameTo(File(target)):
+    # e.g. when the target exists, on some filesystems
+    if os.path.exists(target):
+      os.remove(target)
+    os.rename(tmp, target)
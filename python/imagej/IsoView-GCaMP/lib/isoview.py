@@ -13,7 +13,7 @@ import os, re, sys
 from pprint import pprint
 from itertools import izip, chain, repeat
 from operator import itemgetter
-from util import newFixedThreadPool, Task, syncPrint, affine3D
+from util import newWorkStealingPool, Task, syncPrint, affine3D
 from io import readFloats, writeZip, KLBLoader, TransformedLoader, ImageJLoader
 from registration import computeOptimizedTransforms, saveMatrices, loadMatrices, asBackwardConcatTransforms, viewTransformed, transformedView
 from deconvolution import multiviewDeconvolution, prepareImgForDeconvolution, transformPSFKernelToView
@@ -62,7 +62,9 @@ def deconvolveTimePoints(srcDir,
      roi: the min and max coordinates for cropping the coarsely registered volumes prior to registration and deconvolution.
      subrange: defaults to None. Can be a list specifying the indices of time points to deconvolve.
      camera_groups: the camera views to fuse and deconvolve together. Defaults to two: ((0, 1), (2, 3))
-     n_threads: number of threads to use. Zero (default) means as many as possible.
+     n_threads: number of threads to use. Zero (default) means as many as possible,
+                fewer if the optional params["bytes_per_task"] doesn't fit them in the heap,
+                though tasks waiting on other tasks may start more (see util.newWorkStealingPool).
   """
   kernel = readFloats(kernel_filepath, [19, 19, 25], header=434)
   klb_loader = KLBLoader()
@@ -73,7 +75,9 @@ def deconvolveTimePoints(srcDir,
   # Regular expression pattern describing KLB files to include
   pattern = re.compile("^SPM00_TM\d+_CM(\d+)_CHN0[01]\.klb$")
 
-  exe = newFixedThreadPool(n_threads=n_threads)
+  # Work-stealing, because tasks (e.g. registration.fitModel -> features.findPointMatches)
+  # submit other tasks to the same pool and wait for them
+  exe = newWorkStealingPool(n_threads=n_threads, bytes_per_task=params.get("bytes_per_task", 0))
 
   # Find all time point folders with pattern TM\d{6} (a TM followed by 6 digits)
   def iterTMs():
@@ -284,7 +288,9 @@ def registerDeconvolvedTimePoints(targetDir,
       targetDir: the directory containing the deconvolved images.
       params: for feature extraction and registration.
       modelclass: the model to use, e.g. Translation3D, AffineTransform3D.
-      exe: the ExecutorService to use (optional).
+      exe: the ExecutorService to use (optional). If None, a work-stealing pool is created,
+           whose parallelism is set by the optional params["bytes_per_task"] to fit in the heap,
+           but not bounded by it (see util.newWorkStealingPool).
       subrange: the range of time point indices to process, as enumerated
                 by the folder name, i.e. the number captured by /TM(\d+)/
       
@@ -324,7 +330,7 @@ def registerDeconvolvedTimePoints(targetDir,
   if not matrices:
     original_exe = exe
     if not exe:
-      exe = newFixedThreadPool()
+      exe = newWorkStealingPool(bytes_per_task=params.get("bytes_per_task", 0))
     try:
       # Deconvolved images are isotropic
       def getCalibration(img_filepath):
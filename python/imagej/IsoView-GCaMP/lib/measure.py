@@ -0,0 +1,191 @@
+from net.imglib2.img.array import ArrayImg
+from java.lang import Double, Float, Math, Runtime
+from fiji.scripting import Weaver
+from jarray import zeros, array
+from math import ceil
+import csv
+# local lib functions:
+from util import newFixedThreadPool, Task
+from projection import toFloats
+
+
+# Measure the pixels within the shape around each peak in [k0, k1), for a 3D image stored as a flat array.
+# When the shape fits within the image, pixels are read via precomputed flat offsets from the center;
+# otherwise, each pixel is checked to be within the image.
+_template = """
+  static public final void measure_%(name)s(final %(type)s[] pixels, final int width, final int height, final int depth,
+      final int[] centers, final int k0, final int k1,
+      final int[] offsets, final int[] dxs, final int[] dys, final int[] dzs, final int[] reach,
+      final double[] sums, final int[] counts, final float[] maxs) {
+    final int plane = width * height;
+    for (int k=k0; k<k1; ++k) {
+      final int x = centers[k * 3],
+                y = centers[k * 3 + 1],
+                z = centers[k * 3 + 2],
+                center = z * plane + y * width + x;
+      double sum = 0;
+      int count = 0;
+      float max = -Float.MAX_VALUE;
+      if (x - reach[0] >= 0 && x + reach[0] < width
+       && y - reach[1] >= 0 && y + reach[1] < height
+       && z - reach[2] >= 0 && z + reach[2] < depth) {
+        for (int i=0; i<offsets.length; ++i) {
+          final float v = %(read)s;
+          sum += v;
+          if (v > max) max = v;
+        }
+        count = offsets.length;
+      } else {
+        for (int i=0; i<offsets.length; ++i) {
+          final int px = x + dxs[i],
+                    py = y + dys[i],
+                    pz = z + dzs[i];
+          if (px < 0 || py < 0 || pz < 0 || px >= width || py >= height || pz >= depth) continue;
+          final float v = %(read)s;
+          sum += v;
+          if (v > max) max = v;
+          ++count;
+        }
+      }
+      sums[k] = sum;
+      counts[k] = count;
+      maxs[k] = 0 == count ? Float.NaN : max;
+    }
+  }
+"""
+
+_readers = {'f': ("floats", "float", "pixels[center + offsets[i]]"),
+            'h': ("shorts", "short", "pixels[center + offsets[i]] & 0xffff"),
+            'b': ("bytes", "byte", "pixels[center + offsets[i]] & 0xff")}
+
+kernels = Weaver.method("\n".join(_template % {"name": name, "type": jtype, "read": read}
+                                  for name, jtype, read in _readers.itervalues()),
+                        [Float])
+
+
+def shapeOffsets(shape, radius, calibration, dimensions):
+  """
+  Return the pixel offsets, relative to the center, of the pixels within the shape,
+  as a tuple of 4 int arrays: the offsets into the flat array of an image of the given dimensions,
+  and the offsets in X, Y and Z. Also return the maximum absolute offset in X, Y and Z.
+
+  shape: "box", "sphere" or "ellipsoid".
+  radius: in calibrated units. For a box, its half side. One number, or one per dimension.
+  calibration: the size of a pixel in each dimension.
+  dimensions: of the image, 2D or 3D.
+  """
+  radii = list(radius) if hasattr(radius, "__iter__") else [radius] * len(dimensions)
+  # In pixels, with a 2D image as a 3D image of depth 1
+  radii = [r / c for r, c in zip(radii, calibration)] + [0] * (3 - len(dimensions))
+  reach = [int(r) for r in radii]
+  width, height = dimensions[0], dimensions[1]
+  offsets, dxs, dys, dzs = [], [], [], []
+  for dz in xrange(-reach[2], reach[2] + 1):
+    for dy in xrange(-reach[1], reach[1] + 1):
+      for dx in xrange(-reach[0], reach[0] + 1):
+        if "box" != shape:
+          d2 = sum(pow(float(d) / r, 2) for d, r in zip((dx, dy, dz), radii) if r > 0)
+          if d2 > 1:
+            continue
+        offsets.append(dz * width * height + dy * width + dx)
+        dxs.append(dx)
+        dys.append(dy)
+        dzs.append(dz)
+  return tuple(array(a, 'i') for a in (offsets, dxs, dys, dzs)), array(reach, 'i')
+
+
+def measurePeaks(img, peaks, shape="sphere", radius=1.0, calibration=None, n_threads=0, exe=None):
+  """
+  Measure the sum, mean, max and count of the pixel values within a shape centered at each peak,
+  for all peaks, with compiled code, in parallel over chunks of peaks.
+  Pixels outside the image are ignored.
+
+  img: a 2D or 3D image. An ArrayImg of bytes, shorts or floats is read directly;
+       any other is first copied into a float array.
+  peaks: a list of RealLocalizable in pixel coordinates, rounded to the nearest pixel.
+  shape: "box", "sphere" or "ellipsoid" (see shapeOffsets).
+  radius: in calibrated units: one number, or one per dimension, e.g. for an ellipsoid.
+  calibration: the size of a pixel in each dimension. Defaults to 1.0 for all.
+  n_threads: defaults to as many as CPUs. Ignored when an exe is given.
+  exe: the ExecutorService to use (optional).
+
+  Returns a dictionary of columns, each a native array with one value per peak:
+  "x", "y", "z" (the pixel centers), "sum", "mean", "max" and "count".
+  """
+  n = img.numDimensions()
+  dimensions = [img.dimension(d) for d in xrange(n)]
+  calibration = calibration if calibration else [1.0] * n
+  (offsets, dxs, dys, dzs), reach = shapeOffsets(shape, radius, calibration, dimensions)
+  width, height = dimensions[0], dimensions[1]
+  depth = dimensions[2] if n > 2 else 1
+  # Pixels as a flat array
+  pixels = None
+  if isinstance(img, ArrayImg):
+    pixels = img.update(None).getCurrentStorageArray()
+    if pixels.typecode not in _readers:
+      pixels = None
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool(n_threads, name="measure-peaks")
+  try:
+    if pixels is None:
+      pixels = toFloats(img, exe=exe)
+    measure = getattr(kernels, "measure_" + _readers[pixels.typecode][0])
+    n_peaks = len(peaks)
+    centers = zeros(n_peaks * 3, 'i')
+    for k, peak in enumerate(peaks):
+      for d in xrange(min(3, n)):
+        centers[k * 3 + d] = int(Math.round(peak.getDoublePosition(d)))
+    sums = zeros(n_peaks, 'd')
+    counts = zeros(n_peaks, 'i')
+    maxs = zeros(n_peaks, 'f')
+    chunk = max(1, int(ceil(n_peaks / float(4 * Runtime.getRuntime().availableProcessors()))))
+    futures = [exe.submit(Task(measure, pixels, width, height, depth, centers, k0, min(n_peaks, k0 + chunk),
+                               offsets, dxs, dys, dzs, reach, sums, counts, maxs))
+               for k0 in xrange(0, n_peaks, chunk)]
+    for f in futures:
+      f.get()
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return {"x": centers[0::3],
+          "y": centers[1::3],
+          "z": centers[2::3],
+          "sum": sums,
+          "mean": array([s / c if c > 0 else Double.NaN for s, c in zip(sums, counts)], 'd'),
+          "max": maxs,
+          "count": counts}
+
+
+def measurePeaksOverTime(getImg, n_timepoints, peaks, columns=("mean",), **kwargs):
+  """
+  Measure the same peaks, e.g. of registered nuclei, in every time point,
+  such as for the fluorescence of each cell over time.
+  getImg: a function that returns the 2D or 3D image of a time point index.
+  columns: the measurements to keep (see measurePeaks).
+  Additional keyword arguments are passed on to measurePeaks.
+
+  Returns a dictionary of column name vs list, one per time point, of native arrays with one value per peak. """
+  if "exe" not in kwargs:
+    kwargs["exe"] = exe = newFixedThreadPool(kwargs.pop("n_threads", 0), name="measure-peaks")
+  else:
+    exe = None
+  try:
+    results = dict((name, []) for name in columns)
+    for t in xrange(n_timepoints):
+      measurements = measurePeaks(getImg(t), peaks, **kwargs)
+      for name in columns:
+        results[name].append(measurements[name])
+    return results
+  finally:
+    if exe:
+      exe.shutdown()
+
+
+def writeMeasurementsCSV(measurements, path, columns=("x", "y", "z", "sum", "mean", "max", "count")):
+  """ Write the columns of measurements (see measurePeaks) into a CSV file, one row per peak. """
+  with open(path, 'wb') as csvfile:
+    w = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+    w.writerow(list(columns))
+    for row in zip(*[measurements[name] for name in columns]):
+      w.writerow(list(row))
@@ -1,8 +1,65 @@
 from ij.gui import Plot
-from roi import roiPoints
-from util import syncPrint
+from ij.plugin.frame import RoiManager
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+from java.awt import Color
+from roi import roiRuns, asImageProcessor
+from util import syncPrint, newFixedThreadPool, Task
 
-def plot2DRoiOverZ(imp, roi=None, show=True, XaxisLabel='Z', YaxisLabel='I', Zscale='1.0'):
+
+def sliceMeans(img, rois_runs):
+  """ Return the mean pixel value within each RunLengthRoi, reading the pixels of img
+      (an ImageProcessor or a 2D imglib2 image) only once for all ROIs. """
+  ip = asImageProcessor(img)
+  if not isinstance(ip, (ByteProcessor, ShortProcessor, FloatProcessor)):
+    # e.g. a ColorProcessor: convert to luminance only once for all ROIs
+    ip = ip.convertToFloatProcessor()
+  return [runs.mean(ip) for runs in rois_runs]
+
+
+def roiIntensities(imp, rois, axis="Z", channel=None, slice=None, frame=None, exe=None):
+  """
+  Measure the mean pixel value within each 2D ROI at every index along an axis of the ImagePlus.
+  Each ROI is rasterised once into runs (see roi.RunLengthRoi), and each stack slice is read only once
+  for all ROIs, with slices processed in parallel.
+
+  imp: the ImagePlus, possibly a hyperstack or a virtual stack.
+  rois: a list of 2D ROIs.
+  axis: "Z" to measure across slices, or "T" to measure across frames (time points).
+  channel, slice, frame: the fixed 1-based indices of the other axes. Default to the current ones.
+  exe: the ExecutorService to use (optional).
+
+  Returns a list with one list of mean values per ROI.
+  """
+  width, height = imp.getWidth(), imp.getHeight()
+  rois_runs = [roiRuns(roi, width, height) for roi in rois]
+  c = channel if channel else imp.getC()
+  z = slice if slice else imp.getZ()
+  t = frame if frame else imp.getT()
+  if "Z" == axis:
+    indices = [imp.getStackIndex(c, i, t) for i in xrange(1, imp.getNSlices() + 1)]
+  elif "T" == axis:
+    indices = [imp.getStackIndex(c, z, i) for i in xrange(1, imp.getNFrames() + 1)]
+  else:
+    syncPrint("Unsupported axis: %s" % axis)
+    return None
+  stack = imp.getStack()
+
+  def meansAt(index):
+    return sliceMeans(stack.getProcessor(index), rois_runs)
+
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool()
+  try:
+    futures = [exe.submit(Task(meansAt, index)) for index in indices]
+    per_slice = [f.get() for f in futures]
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return [[means[i] for means in per_slice] for i in xrange(len(rois_runs))]
+
+
+def plot2DRoiOverZ(imp, roi=None, show=True, XaxisLabel='Z', YaxisLabel='I', Zscale=1.0):
   """
   Take an ImagePlus and a 2D ROI (optional, can be read from the ImagePlus)
   and plot the average value of the 2D ROI in each Z slice.
@@ -14,11 +71,7 @@ def plot2DRoiOverZ(imp, roi=None, show=True, XaxisLabel='Z', YaxisLabel='I', Zsc
   if not roi:
     syncPrint("Set a ROI first.")
     return
-  # List of 2D points from where pixel values are to be read
-  points = roiPoints(roi)
-  stack = imp.getStack()
-  intensity = [sum(stack.getProcessor(slice_index).getf(p.x, p.y) for p in points) / len(points)
-               for slice_index in xrange(1, imp.getNSlices() + 1)]
+  intensity = roiIntensities(imp, [roi], axis="Z")[0]
   xaxis = [z * Zscale for z in range(1, imp.getNSlices() + 1)]
   plot = Plot("Intensity", XaxisLabel, YaxisLabel, xaxis, intensity)
   if show:
@@ -26,3 +79,33 @@ def plot2DRoiOverZ(imp, roi=None, show=True, XaxisLabel='Z', YaxisLabel='I', Zsc
   else:
     win = None
   return intensity, xaxis, plot, win
+
+
+def plot2DRoisOver(imp, rois=None, axis="T", show=True, XaxisLabel='T', YaxisLabel='I', scale=1.0, **kwargs):
+  """
+  Plot the average value of each 2D ROI along the axis ("Z" or "T") of the ImagePlus,
+  one curve per ROI. When rois is None, use all ROIs in the RoiManager.
+  Additional keyword arguments are passed on to roiIntensities.
+
+  Return 4 elements: the list of lists of values for the Y (intensity), the list of X values,
+  and the Plot and PlotWindow instances.
+  """
+  if not rois:
+    manager = RoiManager.getInstance()
+    rois = manager.getRoisAsArray() if manager else None
+  if not rois:
+    syncPrint("Add ROIs to the RoiManager first.")
+    return
+  intensities = roiIntensities(imp, rois, axis=axis, **kwargs)
+  n = imp.getNSlices() if "Z" == axis else imp.getNFrames()
+  xaxis = [i * scale for i in range(1, n + 1)]
+  plot = Plot("Intensity of %i ROIs" % len(rois), XaxisLabel, YaxisLabel)
+  for i, intensity in enumerate(intensities):
+    plot.setColor(Color.getHSBColor(i / float(len(intensities)), 1.0, 0.8))
+    plot.addPoints(xaxis, intensity, Plot.LINE)
+  plot.setLimitsToFit(False)
+  if show:
+    win = plot.show()
+  else:
+    win = None
+  return intensities, xaxis, plot, win
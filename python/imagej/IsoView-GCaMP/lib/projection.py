@@ -0,0 +1,287 @@
+from net.imglib2 import Cursor
+from net.imglib2.type.numeric import RealType
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from net.imglib2.util import Intervals
+from java.util.concurrent import ArrayBlockingQueue, TimeUnit, TimeoutException
+from java.lang import System, Math, Runtime
+from fiji.scripting import Weaver
+from jarray import zeros
+import operator
+from math import ceil
+# local lib functions:
+from util import syncPrint, newFixedThreadPool, memoryBoundThreadCount, Task
+
+
+# Pixel-wise operations on flat float arrays, compiled for speed
+kernels = Weaver.method("""
+  static public final void toFloats(final Cursor c, final float[] a, final int offset) {
+    int i = offset;
+    while (c.hasNext()) {
+      a[i++] = ((RealType) c.next()).getRealFloat();
+    }
+  }
+
+  static public final void max(final float[] acc, final float[] v) {
+    for (int i=0; i<acc.length; ++i) {
+      if (v[i] > acc[i]) acc[i] = v[i];
+    }
+  }
+
+  static public final void min(final float[] acc, final float[] v) {
+    for (int i=0; i<acc.length; ++i) {
+      if (v[i] < acc[i]) acc[i] = v[i];
+    }
+  }
+
+  // n: the count including v
+  static public final void mean(final float[] mean, final float[] v, final int n) {
+    for (int i=0; i<mean.length; ++i) {
+      mean[i] += (v[i] - mean[i]) / n;
+    }
+  }
+
+  // Welford's online algorithm. n: the count including v
+  static public final void welford(final float[] mean, final float[] m2, final float[] v, final int n) {
+    for (int i=0; i<mean.length; ++i) {
+      final float delta = v[i] - mean[i];
+      mean[i] += delta / n;
+      m2[i] += delta * (v[i] - mean[i]);
+    }
+  }
+
+  // Chan et al. pairwise combination of partial means and, if m2A is not null, of sums of squared differences
+  static public final void mergeWelford(final float[] meanA, final float[] m2A, final int nA,
+                                        final float[] meanB, final float[] m2B, final int nB) {
+    final float n = nA + nB,
+                fB = nB / n,
+                fAB = (((float)nA) * nB) / n;
+    for (int i=0; i<meanA.length; ++i) {
+      final float delta = meanB[i] - meanA[i];
+      meanA[i] += delta * fB;
+      if (null != m2A) m2A[i] += m2B[i] + delta * delta * fAB;
+    }
+  }
+
+  static public final float[] scale(final float[] a, final float factor) {
+    final float[] b = new float[a.length];
+    for (int i=0; i<a.length; ++i) {
+      b[i] = a[i] * factor;
+    }
+    return b;
+  }
+
+  // Sample standard deviation from the sums of squared differences
+  static public final float[] std(final float[] m2, final int n) {
+    final float[] b = new float[m2.length];
+    if (n < 2) return b;
+    for (int i=0; i<m2.length; ++i) {
+      b[i] = (float) Math.sqrt(m2[i] / (n - 1));
+    }
+    return b;
+  }
+""", [Cursor, RealType, Math])
+
+
+def toFloats(img, exe=None, n_blocks=0):
+  """ Copy the img, of any RealType, into a new flat float array, in flat iteration order.
+      exe: optional ExecutorService, to copy slabs along the last dimension in parallel,
+           which helps when the img is e.g. a lazily transformed view.
+      n_blocks: the number of slabs. Defaults to 4 per thread of the exe. """
+  a = zeros(Intervals.numElements(img), 'f')
+  if not exe:
+    kernels.toFloats(Views.flatIterable(img).cursor(), a, 0)
+    return a
+  last = img.numDimensions() - 1
+  n_blocks = min(img.dimension(last), n_blocks if n_blocks else 4 * Runtime.getRuntime().availableProcessors())
+  step = int(ceil(img.dimension(last) / float(n_blocks)))
+  slab_size = Intervals.numElements(img) / img.dimension(last)
+  def copySlab(start):
+    minC = [img.min(d) for d in xrange(last)] + [img.min(last) + start]
+    maxC = [img.max(d) for d in xrange(last)] + [min(img.max(last), img.min(last) + start + step - 1)]
+    slab = Views.flatIterable(Views.interval(img, minC, maxC))
+    kernels.toFloats(slab.cursor(), a, start * slab_size)
+  futures = [exe.submit(Task(copySlab, start)) for start in xrange(0, img.dimension(last), step)]
+  for f in futures:
+    f.get()
+  return a
+
+
+class Accumulator:
+  """ Pixel-wise statistics over a sequence of volumes, each a flat float array.
+      The mean, sum and std share the same running mean, computed with Welford's algorithm. """
+  def __init__(self, ops):
+    self.ops = set(ops)
+    self.n = 0
+    self.max = None
+    self.min = None
+    self.mean = None
+    self.m2 = None
+
+  def add(self, values):
+    self.n += 1
+    if 1 == self.n:
+      if "max" in self.ops:
+        self.max = values[:]
+      if "min" in self.ops:
+        self.min = values[:]
+      if self.ops.intersection(["mean", "sum", "std"]):
+        self.mean = values[:]
+      if "std" in self.ops:
+        self.m2 = zeros(len(values), 'f')
+      return
+    if self.max is not None:
+      kernels.max(self.max, values)
+    if self.min is not None:
+      kernels.min(self.min, values)
+    if self.m2 is not None:
+      kernels.welford(self.mean, self.m2, values, self.n)
+    elif self.mean is not None:
+      kernels.mean(self.mean, values, self.n)
+
+  def merge(self, other):
+    """ Fold the other Accumulator into this one, returning this one. """
+    if 0 == other.n:
+      return self
+    if 0 == self.n:
+      return other
+    if self.max is not None:
+      kernels.max(self.max, other.max)
+    if self.min is not None:
+      kernels.min(self.min, other.min)
+    if self.mean is not None:
+      kernels.mergeWelford(self.mean, self.m2, self.n, other.mean, other.m2, other.n)
+    self.n += other.n
+    return self
+
+  def results(self):
+    """ Return a dictionary of operation name vs flat float array. """
+    r = {}
+    if "max" in self.ops:
+      r["max"] = self.max
+    if "min" in self.ops:
+      r["min"] = self.min
+    if "mean" in self.ops:
+      r["mean"] = self.mean
+    if "sum" in self.ops:
+      r["sum"] = kernels.scale(self.mean, self.n)
+    if "std" in self.ops:
+      r["std"] = kernels.std(self.m2, self.n)
+    return r
+
+
+# Marks the end of the queue of volumes for a reducer
+_END = object()
+
+def project(keys, loader, ops=("max",), n_threads=0, n_readers=2, read_ahead=2):
+  """
+  Project a 4D series of 3D volumes along time, pixel-wise, into one 3D volume per operation.
+  Volumes are read concurrently by n_readers threads, with at most read_ahead volumes
+  waiting to be reduced. Each of n_threads reducer threads folds the volumes it takes
+  into its own partial Accumulator, and then the partial accumulators are merged
+  pairwise in a parallel tree. Therefore the projection is bound by I/O rather than by a single core.
+
+  keys: the list of e.g. file paths, one per time point.
+  loader: an object whose get(key) returns the 3D volume as an imglib2 RandomAccessibleInterval of RealType,
+          such as io.KLBLoader, io.ImageJLoader (e.g. for TIFF) or io.N5TimePointLoader.
+          All volumes must have the same dimensions.
+  ops: any of "max", "min", "mean", "sum" and "std".
+  n_threads: number of reducer threads. Zero means as many as CPUs, but no more than fit in the heap,
+             given that each needs its own accumulator arrays.
+  n_readers: number of threads for loading volumes concurrently.
+  read_ahead: maximum number of loaded volumes waiting to be reduced.
+
+  Returns a dictionary of operation name vs 3D ArrayImg of FloatType.
+  """
+  ops = set(ops)
+  unknown = ops.difference(["max", "min", "mean", "sum", "std"])
+  if unknown:
+    syncPrint("Unsupported projection operations: %s" % ", ".join(unknown))
+    return None
+  first = loader.get(keys[0])
+  dimensions = Intervals.dimensionsAsLongArray(first)
+  size = reduce(operator.mul, dimensions)
+  first = None
+  # Floats per voxel for each partial accumulator, plus the volume being reduced
+  n_arrays = 1 + len(ops.intersection(["max", "min"])) \
+               + (1 if ops.intersection(["mean", "sum", "std"]) else 0) \
+               + (1 if "std" in ops else 0)
+  n_threads = memoryBoundThreadCount(n_threads, bytes_per_task=size * 4 * n_arrays)
+
+  queue = ArrayBlockingQueue(max(1, read_ahead))
+  reducing = []
+  n_ends = [0] # number of _END put into the queue
+
+  def reducersFailed():
+    # Each reducer returns only after taking an _END: any more done than _END put have failed
+    return sum(1 for f in reducing if f.isDone()) > n_ends[0]
+
+  def raiseReducerError():
+    for f in reducing:
+      if f.isDone():
+        f.get() # raises the reducer's error
+    raise Exception("Projection reducers failed") # e.g. cancelled
+
+  def put(item):
+    """ Add the item to the queue, waiting while it is full, unless the reducers
+        that drain it have failed. Returns whether the item was added. """
+    while not queue.offer(item, 100, TimeUnit.MILLISECONDS):
+      if reducersFailed():
+        return False
+    return True
+
+  def read(key):
+    img = loader.get(key)
+    if Intervals.numElements(img) != size:
+      raise Exception("Dimensions of %s differ from those of %s" % (str(key), str(keys[0])))
+    if not put(toFloats(img)):
+      raise Exception("Projection reducers failed: not reading %s" % str(key))
+
+  def reduceQueue():
+    acc = Accumulator(ops)
+    while True:
+      values = queue.take()
+      if values is _END:
+        return acc
+      acc.add(values)
+
+  readers = newFixedThreadPool(n_readers, name="projection-reader")
+  reducers = newFixedThreadPool(n_threads, name="projection-reducer")
+  try:
+    t0 = System.nanoTime()
+    reducing.extend(reducers.submit(Task(reduceQueue)) for _ in xrange(n_threads))
+    reading = [readers.submit(Task(read, key)) for key in keys]
+    try:
+      # Wait for the readers, but stop as soon as a reducer fails, re-raising its error
+      for f in reading:
+        while True:
+          try:
+            f.get(100, TimeUnit.MILLISECONDS)
+            break
+          except TimeoutException:
+            if reducersFailed():
+              raiseReducerError()
+    except:
+      for f in reading:
+        f.cancel(True)
+      raise
+    finally:
+      # Signal the end even on error, so that reducers return, unless they failed already
+      for _ in xrange(n_threads):
+        if not put(_END):
+          break
+        n_ends[0] += 1
+    if n_ends[0] < n_threads:
+      raiseReducerError()
+    partials = [f.get() for f in reducing]
+    # Merge partial accumulators pairwise in a tree
+    while len(partials) > 1:
+      merging = [reducers.submit(Task(a.merge, b)) for a, b in zip(partials[0::2], partials[1::2])]
+      odd = [partials[-1]] if 1 == len(partials) % 2 else []
+      partials = [f.get() for f in merging] + odd
+    syncPrint("Projected %i volumes in %.2f s" % (partials[0].n, (System.nanoTime() - t0) / 1000000000.0))
+    return {op: ArrayImgs.floats(values, dimensions)
+            for op, values in partials[0].results().iteritems()}
+  finally:
+    readers.shutdownNow()
+    reducers.shutdownNow()
@@ -0,0 +1,157 @@
+from ij.process import ByteProcessor, ColorProcessor
+from fiji.scripting import Weaver
+from jarray import zeros
+# local lib functions:
+from util import Task
+
+
+# A summed-area table (integral image) has one more row and column than the image, with zeros
+# in the first row and column, so that the sum of any box is read from its 4 corners.
+_integralTemplate = """
+  static public final double[] integral_%(name)s(final %(type)s[] pixels, final int width, final int height) {
+    final int w1 = width + 1;
+    final double[] sat = new double[w1 * (height + 1)];
+    for (int y=0; y<height; ++y) {
+      double row = 0;
+      final int offset = y * width,
+                o1 = (y + 1) * w1;
+      for (int x=0; x<width; ++x) {
+        row += %(read)s;
+        sat[o1 + x + 1] = sat[o1 - w1 + x + 1] + row;
+      }
+    }
+    return sat;
+  }
+"""
+
+_readers = {'b': ("bytes", "byte", "pixels[offset + x] & 0xff"),
+            'h': ("shorts", "short", "pixels[offset + x] & 0xffff"),
+            'f': ("floats", "float", "pixels[offset + x]")}
+
+kernels = Weaver.method("\n".join(_integralTemplate % {"name": name, "type": jtype, "read": read}
+                                  for name, jtype, read in _readers.itervalues()) + """
+  // The mean of each box of factor x factor pixels, mapped to 8-bit as (mean - min) * scale,
+  // into a new image of (width / factor) x (height / factor) pixels.
+  static public final byte[] boxMeans(final double[] sat, final int width, final int height, final int factor,
+                                      final double min, final double scale) {
+    final int w1 = width + 1,
+              tw = width / factor,
+              th = height / factor;
+    final double area = factor * factor;
+    final byte[] target = new byte[tw * th];
+    for (int y=0; y<th; ++y) {
+      final int r0 = y * factor * w1,
+                r1 = (y + 1) * factor * w1;
+      for (int x=0; x<tw; ++x) {
+        final int c0 = x * factor,
+                  c1 = c0 + factor;
+        final double sum = sat[r1 + c1] - sat[r1 + c0] - sat[r0 + c1] + sat[r0 + c0];
+        final double v = (sum / area - min) * scale + 0.5;
+        target[y * tw + x] = (byte)(v < 0 ? 0 : (v > 255 ? 255 : (int)v));
+      }
+    }
+    return target;
+  }
+
+  // Set the alpha to zero where any pixel of a box of the binary (0 or 255) outside mask is zero.
+  static public final void applyOutside(final double[] sat, final int width, final int height, final int factor,
+                                        final byte[] alpha) {
+    final int w1 = width + 1,
+              tw = width / factor,
+              th = height / factor;
+    final double full = 255.0 * factor * factor;
+    for (int y=0; y<th; ++y) {
+      final int r0 = y * factor * w1,
+                r1 = (y + 1) * factor * w1;
+      for (int x=0; x<tw; ++x) {
+        final int c0 = x * factor,
+                  c1 = c0 + factor;
+        if (sat[r1 + c1] - sat[r1 + c0] - sat[r0 + c1] + sat[r0 + c0] < full) alpha[y * tw + x] = 0;
+      }
+    }
+  }
+""", [])
+
+
+def integral(pixels, width, height):
+  """ Return the summed-area table, as a double[] of (width + 1) * (height + 1),
+      of a byte[], short[] (both read as unsigned) or float[] image. """
+  return getattr(kernels, "integral_" + _readers[pixels.typecode][0])(pixels, width, height)
+
+
+def _channels(ip):
+  """ Return the pixel arrays of each channel of the ImageProcessor, and the min and scale
+      that map its values into 8-bit, as its display range does. """
+  if isinstance(ip, ColorProcessor):
+    n = ip.getWidth() * ip.getHeight()
+    r, g, b = zeros(n, 'b'), zeros(n, 'b'), zeros(n, 'b')
+    ip.getRGB(r, g, b)
+    return [r, g, b], 0.0, 1.0
+  if isinstance(ip, ByteProcessor):
+    return [ip.getPixels()], 0.0, 1.0
+  mn, mx = ip.getMin(), ip.getMax()
+  return [ip.getPixels()], mn, (255.0 / (mx - mn) if mx > mn else 1.0)
+
+
+def levelDimensions(width, height, min_size=32):
+  """ The width, height and downsampling factor of each level of a mipmap pyramid,
+      halving the dimensions (rounding down) until the largest is smaller than min_size,
+      like the cascade of 2x2 averages of ini.trakem2.persistence.DownsamplerMipMaps. """
+  levels = []
+  factor = 1
+  while True:
+    w, h = width / factor, height / factor
+    if 0 == w or 0 == h:
+      break
+    levels.append((w, h, factor))
+    if max(w, h) < min_size:
+      break
+    factor *= 2
+  return levels
+
+
+def integralPyramid(ip, mask=None, outside=None, min_size=32, exe=None):
+  """
+  Generate all levels of a mipmap pyramid of an image from a single summed-area table per channel,
+  with each pixel of level k being the mean of the 2^k x 2^k box of original pixels it covers,
+  rather than from a cascade of 2x2 averages of the previous level.
+
+  ip: the ImageProcessor, e.g. of the transformed image of a TrakEM2 Patch (see Patch.createTransformedImage).
+      8-bit, 16-bit, 32-bit or RGB. 16-bit and 32-bit images are mapped into 8-bit by their display range.
+  mask: optional ByteProcessor with the alpha mask of the image (0 is transparent, 255 opaque).
+  outside: optional ByteProcessor with 0 where pixels are outside of the image, and 255 inside.
+           A pixel of any level is outside if any of the pixels it covers is.
+  min_size: stop when both dimensions of a level are smaller.
+  exe: optional ExecutorService, to compute the summed-area tables, and then the levels, in parallel.
+
+  Returns a list of levels, each a tuple of width, height, the list of byte[] of each channel,
+  and the byte[] of the alpha channel, or None when there is neither mask nor outside.
+  """
+  width, height = ip.getWidth(), ip.getHeight()
+  channels, mn, scale = _channels(ip)
+  sources = channels + [p.getPixels() for p in (mask, outside) if p is not None]
+  if exe:
+    futures = [exe.submit(Task(integral, pixels, width, height)) for pixels in sources]
+    sats = [f.get() for f in futures]
+  else:
+    sats = [integral(pixels, width, height) for pixels in sources]
+  channel_sats = sats[0:len(channels)]
+  mask_sat = sats[len(channels)] if mask is not None else None
+  outside_sat = sats[-1] if outside is not None else None
+
+  def level(w, h, factor):
+    pixels = [kernels.boxMeans(sat, width, height, factor, mn, scale) for sat in channel_sats]
+    alpha = None
+    if mask_sat is not None:
+      alpha = kernels.boxMeans(mask_sat, width, height, factor, 0.0, 1.0)
+    if outside_sat is not None:
+      if alpha is None:
+        alpha = kernels.boxMeans(outside_sat, width, height, factor, 0.0, 1.0)
+      kernels.applyOutside(outside_sat, width, height, factor, alpha)
+    return w, h, pixels, alpha
+
+  dims = levelDimensions(width, height, min_size=min_size)
+  if exe:
+    futures = [exe.submit(Task(level, w, h, factor)) for w, h, factor in dims]
+    return [f.get() for f in futures]
+  return [level(w, h, factor) for w, h, factor in dims]
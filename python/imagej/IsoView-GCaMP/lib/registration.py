@@ -8,7 +8,7 @@ from itertools import izip, imap, islice, combinations
 import os, sys, csv
 from os.path import basename
 # local lib functions:
-from util import syncPrint, Task, nativeArray, newFixedThreadPool
+from util import syncPrint, Task, nativeArray, newWorkStealingPool
 from features import findPointMatches, ensureFeaturesForAll
 
 
@@ -269,12 +269,14 @@ def transformedView(img, transform, interval=None):
 def registeredView(img_filenames, img_loader, getCalibration, csv_dir, modelclass, params, exe=None):
   """ img_filenames: a list of file names
       csv_dir: directory for CSV files
-      exe: an ExecutorService for concurrent execution of tasks
+      exe: an ExecutorService for concurrent execution of tasks.
+           If None, a work-stealing pool is created, whose parallelism is set by the optional
+           params["bytes_per_task"], but not bounded by it (see util.newWorkStealingPool).
       params: dictionary of parameters
       returns a stack view of all registered images, e.g. 3D volumes as a 4D. """
   original_exe = exe
   if not exe:
-    exe = newFixedThreadPool()
+    exe = newWorkStealingPool(bytes_per_task=params.get("bytes_per_task", 0))
   try:
     matrices = computeForwardTransforms(img_filenames, img_loader, getCalibration, csv_dir, exe, modelclass, params)
     affines = asBackwardConcatTransforms(matrices)
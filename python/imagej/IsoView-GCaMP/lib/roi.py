@@ -1,20 +1,200 @@
 from ij.gui import PointRoi
-from java.awt import Point
+from ij.process import ImageProcessor, ByteProcessor, ShortProcessor, FloatProcessor
+from java.awt import Point, Rectangle
+from net.imglib2.img.array import ArrayImg
+from net.imglib2.img.display.imagej import ImageJFunctions as IL
+from fiji.scripting import Weaver
+from jarray import array
+from itertools import imap, repeat
+from operator import and_
+import re
+
+
+# Runs of non-zero bytes in a row of a mask
+_nonzero = re.compile(r'[^\x00]+')
+
+# Bit masks for reading signed java bytes and shorts as unsigned
+_unsigned = {'b': 0xff, 'h': 0xffff}
+
+# Reductions over the pixels of runs given as a flat int[] of y, xstart, xend
+_reduceTemplate = """
+  static public final %(acc)s sum_%(name)s(final %(type)s[] pixels, final int width, final int[] runs) {
+    %(acc)s s = 0;
+    for (int i=0; i<runs.length; i+=3) {
+      final int offset = runs[i] * width;
+      for (int k=offset + runs[i+1], end=offset + runs[i+2]; k<end; ++k) s += %(read)s;
+    }
+    return s;
+  }
+
+  static public final %(acc)s max_%(name)s(final %(type)s[] pixels, final int width, final int[] runs) {
+    %(acc)s m = %(lowest)s;
+    for (int i=0; i<runs.length; i+=3) {
+      final int offset = runs[i] * width;
+      for (int k=offset + runs[i+1], end=offset + runs[i+2]; k<end; ++k) {
+        final %(acc)s v = %(read)s;
+        if (v > m) m = v;
+      }
+    }
+    return m;
+  }
+"""
+
+_readers = {'b': ("bytes", "byte", "long", "pixels[k] & 0xff", "Long.MIN_VALUE"),
+            'h': ("shorts", "short", "long", "pixels[k] & 0xffff", "Long.MIN_VALUE"),
+            'f': ("floats", "float", "double", "pixels[k]", "Double.NEGATIVE_INFINITY")}
+
+# Compiled on first use
+_kernels = None
+
+def _reduce(op, pixels, width, runs):
+  """ Apply the compiled reduction op, "sum" or "max", to the pixels of the runs. """
+  global _kernels
+  if _kernels is None:
+    _kernels = Weaver.method("\n".join(_reduceTemplate % {"name": name, "type": jtype, "acc": acc, "read": read, "lowest": lowest}
+                                       for name, jtype, acc, read, lowest in _readers.itervalues()), [])
+  return getattr(_kernels, op + "_" + _readers[pixels.typecode][0])(pixels, width, runs)
+
+
+def asImageProcessor(img):
+  """ Return an ImageProcessor for reading the pixels of img, which can be an ImageProcessor
+      or a 2D imglib2 RandomAccessibleInterval such as a hyperSlice of a 3D or 4D image.
+      A 2D ArrayImg of bytes, shorts or floats is wrapped without copying its pixels;
+      any other is rendered into a new ImageProcessor. """
+  if isinstance(img, ImageProcessor):
+    return img
+  if isinstance(img, ArrayImg) and 2 == img.numDimensions():
+    pixels = img.update(None).getCurrentStorageArray()
+    width, height = img.dimension(0), img.dimension(1)
+    if 'b' == pixels.typecode:
+      return ByteProcessor(width, height, pixels, None)
+    if 'h' == pixels.typecode:
+      return ShortProcessor(width, height, pixels, None)
+    if 'f' == pixels.typecode:
+      return FloatProcessor(width, height, pixels, None)
+  return IL.wrap(img, "").getProcessor()
+
+
+def nativePixels(ip):
+  """ Return the native pixel array of the ImageProcessor and the bit mask
+      with which to read its values as unsigned, or None when not needed.
+      For e.g. a ColorProcessor, returns the pixels of its luminance. """
+  if not isinstance(ip, (ByteProcessor, ShortProcessor, FloatProcessor)):
+    ip = ip.convertToFloatProcessor()
+  pixels = ip.getPixels()
+  return pixels, _unsigned.get(pixels.typecode, None)
+
+
+class RunLengthRoi:
+  """ A 2D ROI as a list of runs of pixels, one (y, xstart, xend) tuple per run
+      within a row, with xend being exclusive.
+      Reductions (sum, mean, max) read the runs directly from the native pixel array
+      with compiled code, so that the loop over pixels runs in java rather than in jython. """
+  def __init__(self, runs):
+    self.runs = runs
+    self.n_pixels = sum(x1 - x0 for _, x0, x1 in runs)
+    # The runs as a flat int[] of y, xstart, xend, for the compiled reductions
+    self.flat = array([v for run in runs for v in run], 'i')
+
+  @staticmethod
+  def fromRoi(roi, width=None, height=None):
+    """ roi: an ImageJ ROI, whose mask is scanned once, a whole row at a time.
+        width, height: optional, the dimensions of the image, to clip the runs to it. """
+    if isinstance(roi, PointRoi):
+      runs = [(p.y, p.x, p.x + 1) for p in roi.getContainedPoints()]
+    else:
+      bounds = roi.getBounds()
+      mask = roi.getMask()
+      x, y, w, h = bounds.x, bounds.y, bounds.width, bounds.height
+      if mask:
+        pixels = mask.getPixels()
+        runs = [(y + row, x + m.start(), x + m.end())
+                for row in xrange(h)
+                for m in _nonzero.finditer(pixels[row * w: (row + 1) * w].tostring())]
+      else:
+        # Else, e.g. Rectangle ROI
+        runs = [(y + row, x, x + w) for row in xrange(h)]
+    if width is not None or height is not None:
+      # Clip to the image bounds
+      width = width if width is not None else float('inf')
+      height = height if height is not None else float('inf')
+      runs = [(y, max(0, x0), min(width, x1))
+              for y, x0, x1 in runs
+              if 0 <= y < height and x0 < width and x1 > 0]
+    return RunLengthRoi(runs)
+
+  def __len__(self):
+    """ The number of pixels. """
+    return self.n_pixels
+
+  def __iter__(self):
+    """ Iterate the runs as (y, xstart, xend) tuples. """
+    return iter(self.runs)
+
+  def iterPoints(self):
+    """ Iterate the pixel coordinates as (x, y) tuples. """
+    for y, x0, x1 in self.runs:
+      for x in xrange(x0, x1):
+        yield x, y
+
+  def getBounds(self):
+    """ Return the bounding box as a java.awt.Rectangle. """
+    if not self.runs:
+      return Rectangle()
+    minX = min(x0 for _, x0, _ in self.runs)
+    maxX = max(x1 for _, _, x1 in self.runs)
+    minY = min(y for y, _, _ in self.runs)
+    maxY = max(y for y, _, _ in self.runs)
+    return Rectangle(minX, minY, maxX - minX, maxY - minY + 1)
+
+  def iterRuns(self, img):
+    """ Iterate the pixel values of each run, as sequences of numbers, read in jython:
+        prefer sum, mean and max for reductions.
+        img: an ImageProcessor or a 2D imglib2 RandomAccessibleInterval (see asImageProcessor). """
+    ip = asImageProcessor(img)
+    pixels, mask = nativePixels(ip)
+    width = ip.getWidth()
+    for y, x0, x1 in self.runs:
+      offset = y * width
+      row = pixels[offset + x0: offset + x1]
+      yield imap(and_, row, repeat(mask)) if mask else row
+
+  def reduce(self, op, img):
+    ip = asImageProcessor(img)
+    pixels, _ = nativePixels(ip)
+    return _reduce(op, pixels, ip.getWidth(), self.flat)
+
+  def sum(self, img):
+    """ The sum of all pixel values within the ROI. """
+    return self.reduce("sum", img)
+
+  def mean(self, img):
+    """ The mean pixel value within the ROI, or zero if it has no pixels. """
+    if 0 == self.n_pixels:
+      return 0.0
+    return self.sum(img) / float(self.n_pixels)
+
+  def max(self, img):
+    """ The maximum pixel value within the ROI, or None if it has no pixels. """
+    if 0 == self.n_pixels:
+      return None
+    return self.reduce("max", img)
+
+
+def roiRuns(roi, width=None, height=None):
+  """ Return the RunLengthRoi for the ImageJ roi. See RunLengthRoi.fromRoi. """
+  return RunLengthRoi.fromRoi(roi, width=width, height=height)
+
+
+def roiSpans(roi, width=None, height=None):
+  """ Return the list of row spans of pixels inside the ROI, as (y, xstart, xend) tuples.
+      Same as the runs of roiRuns, which also measures them. """
+  return roiRuns(roi, width=width, height=height).runs
+
 
 def roiPoints(roi):
-  """ Return the list of 2D coordinates for pixels inside the ROI. """
+  """ Return the list of 2D coordinates for pixels inside the ROI.
+      Prefer roiRuns, which doesn't create one object per pixel. """
   if isinstance(roi, PointRoi):
     return roi.getContainedPoints()
-  # Else, one Point per non-zero pixel in the mask
-  bounds = roi.getBounds()
-  mask = roi.getMask()
-  x, y, width, height = bounds.x, bounds.y, bounds.width, bounds.height
-  if mask:
-    return [Point(x + i % width,
-                  y + i / width)
-            for i, v in enumerate(mask.getPixels())
-            if 0 != v]
-  # Else, e.g. Rectangle ROI
-  return [Point(x + i % width,
-                y + i / width)
-          for i in xrange(width * height)]
+  return [Point(x, y) for x, y in roiRuns(roi).iterPoints()]
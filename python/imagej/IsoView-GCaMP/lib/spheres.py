@@ -0,0 +1,151 @@
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.img.cell import LazyCellImg, CellGrid, Cell
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from java.util import Arrays
+from java.lang import Math, Runtime
+from fiji.scripting import Weaver
+from jarray import zeros, array
+# local lib functions:
+from util import newFixedThreadPool, Task
+from cache import TimePointCache
+
+
+# Paint ellipsoids into the Z slab [z0, z1) of a flat short[] volume.
+# Where ellipsoids overlap, each voxel takes the value of the peak whose center is nearest,
+# in units of the radii, as would a nearest neighbor search on a KDTree.
+kernels = Weaver.method("""
+  static public final void paint(final short[] pixels, final int width, final int height,
+                                 final int z0, final int z1,
+                                 final float[] coords, final short[] values, final double[] radii) {
+    final int plane = width * height;
+    final float[] best = new float[plane * (z1 - z0)];
+    Arrays.fill(best, 1.0f);
+    final double rx = radii[0], ry = radii[1], rz = radii[2];
+    for (int k=0; k<values.length; ++k) {
+      final double cx = coords[k * 3],
+                   cy = coords[k * 3 + 1],
+                   cz = coords[k * 3 + 2];
+      final int minZ = Math.max(z0, (int)Math.ceil(cz - rz)),
+                maxZ = Math.min(z1 - 1, (int)Math.floor(cz + rz));
+      if (minZ > maxZ) continue;
+      final int minY = Math.max(0, (int)Math.ceil(cy - ry)),
+                maxY = Math.min(height - 1, (int)Math.floor(cy + ry)),
+                minX = Math.max(0, (int)Math.ceil(cx - rx)),
+                maxX = Math.min(width - 1, (int)Math.floor(cx + rx));
+      for (int z=minZ; z<=maxZ; ++z) {
+        final double dz = (z - cz) / rz,
+                     dz2 = dz * dz;
+        for (int y=minY; y<=maxY; ++y) {
+          final double dy = (y - cy) / ry,
+                       dzy2 = dz2 + dy * dy;
+          if (dzy2 >= 1) continue;
+          final int offset = (z - z0) * plane + y * width;
+          for (int x=minX; x<=maxX; ++x) {
+            final double dx = (x - cx) / rx,
+                         d2 = dzy2 + dx * dx;
+            final int i = offset + x;
+            if (d2 < best[i]) {
+              best[i] = (float)d2;
+              pixels[z0 * plane + i] = values[k];
+            }
+          }
+        }
+      }
+    }
+  }
+""", [Arrays, Math])
+
+
+def _asShort(value):
+  """ The signed short with the bits of the unsigned 16-bit value. """
+  value = int(value) & 0xffff
+  return value - 0x10000 if value > 0x7fff else value
+
+
+def asCoordinates3D(peaks):
+  """ Return the peaks, RealLocalizable instances of 2 or 3 dimensions, as a flat float array
+      of x, y, z coordinates, with z being zero for 2D peaks. """
+  coords = zeros(len(peaks) * 3, 'f')
+  for i, peak in enumerate(peaks):
+    for d in xrange(min(3, peak.numDimensions())):
+      coords[i * 3 + d] = peak.getFloatPosition(d)
+  return coords
+
+
+def renderSpheres(peaks, dimensions, radius, value=None, n_threads=0, exe=None):
+  """
+  Paint a sphere for every peak into a new 16-bit image, in parallel by slabs of Z,
+  with each peak visiting only the pixels within its bounding box.
+
+  peaks: a list of 2D or 3D RealLocalizable, e.g. the peaks of a DoG detection,
+         in pixel coordinates.
+  dimensions: the dimensions of the image, 2D or 3D.
+  radius: in pixels, one number for all dimensions, or one per dimension for ellipsoids,
+          such as for anisotropic calibration.
+  value: the value of pixels inside spheres. When None, each sphere is painted with the label
+         of its peak: its index in the list plus one (wrapping around after 65535).
+  n_threads: defaults to as many as CPUs. Ignored when an exe is given.
+  exe: the ExecutorService to use (optional).
+
+  Returns an ArrayImg of UnsignedShortType, with zero outside spheres.
+  """
+  radii = list(radius) if hasattr(radius, "__iter__") else [radius] * len(dimensions)
+  radii = array((radii + [1.0])[0:3], 'd') # a 2D image is a single slab of depth 1
+  width, height = dimensions[0], dimensions[1]
+  depth = dimensions[2] if len(dimensions) > 2 else 1
+  coords = asCoordinates3D(peaks)
+  if value is None:
+    values = array([_asShort(i + 1) for i in xrange(len(peaks))], 'h')
+  else:
+    values = array([_asShort(value)] * len(peaks), 'h')
+  pixels = zeros(width * height * depth, 'h')
+  original_exe = exe
+  if not exe:
+    exe = newFixedThreadPool(n_threads, name="render-spheres")
+  try:
+    n_slabs = min(depth, 2 * Runtime.getRuntime().availableProcessors())
+    step = (depth + n_slabs - 1) / n_slabs
+    futures = [exe.submit(Task(kernels.paint, pixels, width, height, z0, min(depth, z0 + step),
+                               coords, values, radii))
+               for z0 in xrange(0, depth, step)]
+    for f in futures:
+      f.get()
+  finally:
+    if not original_exe:
+      exe.shutdown()
+  return ArrayImgs.unsignedShorts(pixels, dimensions)
+
+
+class SpheresGet(LazyCellImg.Get):
+  """ Provide the rendered spheres of each time point as a Cell of a 4D LazyCellImg. """
+  def __init__(self, cache, dimensions3d):
+    self.cache = cache
+    self.cell_dimensions = list(dimensions3d) + [1]
+  def get(self, index):
+    img = self.cache(index)
+    return Cell(self.cell_dimensions, [0, 0, 0, index], img.update(None))
+
+
+def lazySpheres4D(getPeaks, n_timepoints, dimensions3d, radius, value=None, max_bytes=0, prefetch=1):
+  """
+  A 4D image of the spheres of each time point, rendered with renderSpheres
+  the first time a time point is accessed, and kept in a byte-bounded cache (see cache.TimePointCache),
+  for use e.g. as an overlay channel in ImageJ (see ui.Stack4D) or in the BigDataViewer.
+
+  getPeaks: a function returning the list of peaks of a time point index,
+            e.g. the read method of a dogpeaks.PeaksStore.
+  n_timepoints: the number of time points.
+  dimensions3d: the dimensions of each time point volume.
+  radius, value: see renderSpheres.
+  max_bytes: of the cache. Defaults to a tenth of the JVM max heap.
+  prefetch: number of time points to render in advance before and after the one being accessed.
+
+  Returns a LazyCellImg of UnsignedShortType.
+  """
+  dimensions3d = list(dimensions3d)
+  def render(t):
+    return renderSpheres(getPeaks(t) or [], dimensions3d, radius, value=value)
+  cache = TimePointCache(render, keys=range(n_timepoints), max_bytes=max_bytes, prefetch=prefetch)
+  dimensions = dimensions3d + [n_timepoints]
+  grid = CellGrid(dimensions, dimensions3d + [1])
+  return LazyCellImg(grid, UnsignedShortType(), SpheresGet(cache, dimensions3d))
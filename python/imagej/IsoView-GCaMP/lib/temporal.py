@@ -0,0 +1,173 @@
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from net.imglib2.util import Intervals
+from java.lang import System, Integer
+from fiji.scripting import Weaver
+from jarray import zeros
+import os
+# local lib functions:
+from util import syncPrint, newFixedThreadPool, Task
+from projection import toFloats
+from io import writeZip
+
+
+# Per-voxel operations over a window of time points, for a block [start, end) of voxels.
+# The window is stored voxel-major: the W values of voxel i are at ring[i*W : (i+1)*W].
+kernels = Weaver.method("""
+  static public final void insert(final float[] ring, final int W, final int slot,
+                                  final float[] v, final int start, final int end) {
+    for (int i=start; i<end; ++i) {
+      ring[i * W + slot] = v[i];
+    }
+  }
+
+  static public final void mean(final float[] ring, final int W, final float[] f0,
+                                final int start, final int end) {
+    for (int i=start; i<end; ++i) {
+      final int k = i * W;
+      double sum = 0;
+      for (int w=0; w<W; ++w) sum += ring[k + w];
+      f0[i] = (float)(sum / W);
+    }
+  }
+
+  // Quickselect of the k-th smallest value among the first n of the scratch array
+  static private final float select(final float[] a, final int n, final int k) {
+    int left = 0,
+        right = n - 1;
+    while (left < right) {
+      final float pivot = a[(left + right) >>> 1];
+      int i = left,
+          j = right;
+      while (i <= j) {
+        while (a[i] < pivot) ++i;
+        while (a[j] > pivot) --j;
+        if (i <= j) {
+          final float tmp = a[i];
+          a[i] = a[j];
+          a[j] = tmp;
+          ++i;
+          --j;
+        }
+      }
+      if (k <= j) right = j;
+      else if (k >= i) left = i;
+      else break;
+    }
+    return a[k];
+  }
+
+  // percentile: from 0 to 100
+  static public final void percentile(final float[] ring, final int W, final float[] f0,
+                                      final double percentile, final int start, final int end) {
+    final float[] scratch = new float[W];
+    final int k = Math.min(W - 1, (int)Math.round(percentile / 100.0 * (W - 1)));
+    for (int i=start; i<end; ++i) {
+      System.arraycopy(ring, i * W, scratch, 0, W);
+      f0[i] = select(scratch, W, k);
+    }
+  }
+
+  // (F - F0) / F0, or zero where F0 is not positive
+  static public final void deltaF(final float[] ring, final int W, final int slot, final float[] f0,
+                                  final float[] out, final int start, final int end) {
+    for (int i=start; i<end; ++i) {
+      final float b = f0[i];
+      out[i] = b > 0 ? (ring[i * W + slot] - b) / b : 0;
+    }
+  }
+""", [System])
+
+
+def deltaFOverF(img4D, window=20, baseline="percentile", percentile=10, n_threads=0, n_blocks=0):
+  """
+  Compute the dF/F of each time point of a 4D series, streaming: time points are read in order,
+  one at a time, and only a window of time points is held in memory, as one float array
+  of window * voxels_per_time_point. Each voxel's baseline F0 is the mean or a percentile
+  of its values in the window centered on the time point (shifted to fit at the start and end
+  of the series). Each volume is computed in parallel, in blocks of voxels,
+  while the next time point is being read.
+
+  img4D: a 4D RandomAccessibleInterval of RealType, e.g. the lazy img of isoview.registerDeconvolvedTimePoints.
+  window: number of time points for computing the baseline.
+  baseline: "percentile" or "mean".
+  percentile: from 0 to 100, when the baseline is "percentile".
+  n_threads: defaults to as many as CPUs.
+  n_blocks: the number of blocks of voxels, defaults to 4 per thread.
+
+  A generator of (time point index, 3D ArrayImg of FloatType with the dF/F) tuples, in time order.
+  """
+  if baseline not in ("percentile", "mean"):
+    syncPrint("Unsupported baseline: %s" % baseline)
+    return
+  n_timepoints = img4D.dimension(3)
+  W = int(min(window, n_timepoints))
+  half = W / 2
+  dimensions = Intervals.dimensionsAsLongArray(Views.hyperSlice(img4D, 3, img4D.min(3)))
+  size = Intervals.numElements(dimensions)
+  if size * W > Integer.MAX_VALUE:
+    raise Exception("A window of %i time points of %i voxels doesn't fit in a java array: use a smaller window" % (W, size))
+  # The window of values of every voxel, and the baseline
+  ring = zeros(size * W, 'f')
+  f0 = zeros(size, 'f')
+  # Each thread of the percentile baseline needs a scratch array of W floats
+  exe = newFixedThreadPool(n_threads, name="deltaF", bytes_per_task=W * 4)
+  n_blocks = n_blocks if n_blocks else 4 * exe.getMaximumPoolSize()
+  step = max(1, (size + n_blocks - 1) / n_blocks)
+  blocks = [(start, min(size, start + step)) for start in xrange(0, size, step)]
+
+  def inParallel(fn, *args):
+    futures = [exe.submit(Task(fn, *(args + block))) for block in blocks]
+    for f in futures:
+      f.get()
+
+  def read(t):
+    # Lazily transformed volumes are read in parallel slabs
+    return toFloats(Views.hyperSlice(img4D, 3, img4D.min(3) + t), exe=exe)
+
+  def emit(t):
+    out = zeros(size, 'f')
+    inParallel(kernels.deltaF, ring, W, t % W, f0, out)
+    return t, ArrayImgs.floats(out, dimensions)
+
+  reader = newFixedThreadPool(1, name="deltaF-reader")
+  try:
+    next_volume = reader.submit(Task(read, 0))
+    for t in xrange(n_timepoints):
+      t0 = System.nanoTime()
+      values = next_volume.get()
+      if t + 1 < n_timepoints:
+        next_volume = reader.submit(Task(read, t + 1))
+      inParallel(kernels.insert, ring, W, t % W, values)
+      values = None
+      if t < W - 1:
+        continue
+      # The window [t - W + 1, t] is complete
+      if "mean" == baseline:
+        inParallel(kernels.mean, ring, W, f0)
+      else:
+        inParallel(kernels.percentile, ring, W, f0, float(percentile))
+      # Emit the time points whose window this is
+      first = 0 if t == W - 1 else t - W + 1 + half
+      last = n_timepoints - 1 if t == n_timepoints - 1 else t - W + 1 + half
+      for k in xrange(first, last + 1):
+        yield emit(k)
+      syncPrint("dF/F up to time point %i in %.2f s" % (last, (System.nanoTime() - t0) / 1000000000.0))
+  finally:
+    reader.shutdownNow()
+    exe.shutdownNow()
+
+
+def writeDeltaFOverF(img4D, targetDir, prefix="TM", **kwargs):
+  """ Save each dF/F volume (see deltaFOverF) to targetDir as a ZIP-compressed float TIFF stack,
+      named by the prefix and the time point index, e.g. TM000012-dff.zip.
+      Additional keyword arguments are passed on to deltaFOverF.
+      Returns the list of file paths. """
+  if not os.path.exists(targetDir):
+    os.makedirs(targetDir)
+  paths = []
+  for t, img in deltaFOverF(img4D, **kwargs):
+    path = os.path.join(targetDir, "%s%06i-dff.zip" % (prefix, t))
+    writeZip(img, path, title=os.path.basename(path))
+    paths.append(path)
+  return paths
@@ -0,0 +1,152 @@
+from java.io import File, FileInputStream, FileOutputStream
+from java.security import MessageDigest, DigestInputStream
+from java.lang import Thread
+from synchronize import make_synchronized
+from jarray import zeros
+import os
+import csv
+import traceback
+# local lib functions:
+from util import newFixedThreadPool, syncPrint, Task
+
+
+def copyWithChecksum(source, target, algorithm="MD5"):
+  """ Copy the source file into the target path, creating its parent directories if needed,
+      and return the hex checksum of the bytes copied, computed while copying.
+      The copy is first written to a temporary file and then renamed,
+      so that the target is never a partial copy. """
+  parent = os.path.dirname(target)
+  if parent and not os.path.exists(parent):
+    try:
+      os.makedirs(parent)
+    except OSError:
+      pass # created concurrently
+  tmp = target + ".%i.tmp" % Thread.currentThread().getId()
+  digest = MessageDigest.getInstance(algorithm)
+  fis = DigestInputStream(FileInputStream(source), digest)
+  fos = FileOutputStream(tmp)
+  try:
+    buf = zeros(1024 * 1024, 'b')
+    n = fis.read(buf)
+    while -1 != n:
+      fos.write(buf, 0, n)
+      n = fis.read(buf)
+  finally:
+    fis.close()
+    fos.close()
+  if not File(tmp).renameTo(File(target)):
+    # e.g. when the target exists, on some filesystems
+    if os.path.exists(target):
+      os.remove(target)
+    os.rename(tmp, target)
+  return "".join("%02x" % (b & 0xff) for b in digest.digest())
+
+
+class FileTransfer:
+  """ A batch of file operations, e.g. to copy or symlink the image files of a TrakEM2 project:
+      operations are gathered first and deduplicated by their target path, then run concurrently
+      with bounded parallelism and retries, which matters on network filesystems where each
+      operation is latency-bound.
+      Each operation done is recorded in a CSV manifest, with the size, modification time and checksum
+      of the source file for copies, so that re-running skips operations whose source didn't change. """
+  def __init__(self, manifest_path=None, n_threads=8, n_retries=3):
+    """ manifest_path: the CSV file to record operations done into, and read from when re-running. Optional.
+        n_threads: the number of concurrent operations.
+        n_retries: the number of times to retry a failed operation, waiting longer each time. """
+    self.manifest_path = manifest_path
+    self.n_threads = n_threads
+    self.n_retries = n_retries
+    self.operations = {} # target path vs (kind, source path)
+    self.manifest = {} # target path vs (kind, source, size, mtime, checksum)
+    if manifest_path and os.path.exists(manifest_path):
+      with open(manifest_path, 'r') as f:
+        for kind, source, target, size, mtime, checksum in csv.reader(f):
+          self.manifest[target] = (kind, source, long(size), long(mtime), checksum)
+    self.n_done = 0
+    self.n_skipped = 0
+    self.failed = []
+
+  def add(self, kind, source, target):
+    """ Add an operation: kind is "copy" or "symlink", for the target to be a copy of, or a symbolic link to,
+        the source. Adding again the same operation has no effect, and a different operation
+        for a target already added is rejected, printing a warning. """
+    if kind not in ("copy", "symlink"):
+      raise Exception("Unsupported file operation: " + kind)
+    existing = self.operations.get(target, None)
+    if existing and existing != (kind, source):
+      syncPrint("WARNING: ignoring %s of %s into %s, already a %s of %s" % (kind, source, target, existing[0], existing[1]))
+      return
+    self.operations[target] = (kind, source)
+
+  def isDone(self, kind, source, target):
+    """ Whether the operation was done already and its source hasn't changed since.
+        An existing file that isn't a symbolic link is never replaced by one. """
+    if "symlink" == kind:
+      if os.path.islink(target):
+        return os.readlink(target) == source
+      return os.path.exists(target)
+    entry = self.manifest.get(target, None)
+    if entry is None or not os.path.exists(target):
+      return False
+    f = File(source)
+    return entry[0:4] == (kind, source, f.length(), f.lastModified()) \
+       and os.path.getsize(target) == f.length()
+
+  @make_synchronized
+  def record(self, kind, source, target, checksum):
+    self.n_done += 1
+    f = File(source)
+    self.manifest[target] = (kind, source, f.length(), f.lastModified(), checksum)
+    if self.manifest_path:
+      with open(self.manifest_path, 'a') as mf:
+        csv.writer(mf).writerow([kind, source, target, f.length(), f.lastModified(), checksum])
+
+  @make_synchronized
+  def skipped(self):
+    self.n_skipped += 1
+
+  @make_synchronized
+  def fail(self, kind, source, target):
+    self.failed.append((kind, source, target))
+
+  def execute(self, kind, source, target):
+    if self.isDone(kind, source, target):
+      self.skipped()
+      return
+    for attempt in xrange(self.n_retries + 1):
+      try:
+        if "copy" == kind:
+          checksum = copyWithChecksum(source, target)
+        else:
+          parent = os.path.dirname(target)
+          if parent and not os.path.exists(parent):
+            try:
+              os.makedirs(parent)
+            except OSError:
+              pass # created concurrently
+          if os.path.lexists(target):
+            os.remove(target)
+          os.symlink(source, target)
+          checksum = ""
+        self.record(kind, source, target, checksum)
+        return
+      except:
+        if attempt == self.n_retries:
+          syncPrint("Failed to %s %s into %s:\n%s" % (kind, source, target, traceback.format_exc()))
+          self.fail(kind, source, target)
+        else:
+          Thread.sleep(100 * pow(2, attempt))
+
+  def run(self):
+    """ Run all operations added, concurrently, and return the list of (kind, source, target) that failed. """
+    exe = newFixedThreadPool(self.n_threads, name="file-transfer")
+    try:
+      futures = [exe.submit(Task(self.execute, kind, source, target))
+                 for target, (kind, source) in self.operations.iteritems()]
+      for f in futures:
+        f.get()
+    finally:
+      exe.shutdown()
+    syncPrint("File operations: %i done, %i skipped as unchanged, %i failed"
+              % (self.n_done, self.n_skipped, len(self.failed)))
+    return self.failed
@@ -1,11 +1,26 @@
 from net.imglib2.img.display.imagej import ImageJFunctions as IL, ImageJVirtualStackUnsignedShort
 from net.imglib2.view import Views
+from net.imglib2.img.array import ArrayImg
+from net.imglib2.img.planar import PlanarImg
+from net.imglib2.img.cell import AbstractCellImg
+from net.imglib2 import Cursor
+from net.imglib2.type.numeric import RealType
+from fiji.scripting import Weaver
 from bdv.util import BdvFunctions, Bdv
-from ij import ImagePlus, CompositeImage
+from ij import ImagePlus, CompositeImage, VirtualStack, ImageListener
+from ij.process import ShortProcessor
+from java.lang import Runtime, System
+from java.util import Arrays
+from java.util.concurrent import CancellationException, ExecutionException
+from collections import OrderedDict
+from itertools import izip
+from jarray import zeros
+from synchronize import make_synchronized
+from util import newFixedThreadPool, Task
 
 
 def wrap(img, title="", n_channels=1):
-  """ Like ImageJFunctions.wrap but properly choosing the number of channels, slices and frames. """ 
+  """ Like ImageJFunctions.wrap but properly choosing the number of channels, slices and frames. """
   stack = ImageJVirtualStackUnsignedShort.wrap(img)
   imp = ImagePlus(title, stack)
   n = img.numDimensions()
@@ -13,7 +28,272 @@ def wrap(img, title="", n_channels=1):
   n_frames = img.dimension(3) if n > 3 else 1
   imp.setDimensions(n_channels, n_slices, n_frames)
   return imp
-  
+
+
+class CachedVirtualStack(VirtualStack):
+  """ A VirtualStack that renders each plane of an imglib2 img only once,
+      keeping the most recently viewed planes in an LRU cache,
+      and prefetching, in background threads, the planes adjacent in Z and in T
+      to the plane being viewed. Planes are served as 16-bit.
+      Prefetches that are no longer adjacent to the viewed plane are cancelled,
+      so that scrolling quickly doesn't queue up work. """
+  def __init__(self, img, n_channels=1, cache_bytes=0, prefetch=1, n_threads=2, downsample=1):
+    """ img: a 2D, 3D or 4D imglib2 RandomAccessibleInterval.
+        n_channels: interleaved in the 3rd dimension, as in wrap.
+        cache_bytes: the maximum size of the cache. Defaults to a tenth of the JVM max heap.
+        prefetch: how many planes to prefetch on either side, in Z and in T.
+        n_threads: for rendering planes in the background.
+        downsample: an integer larger than 1 serves each plane downsampled in X and Y by that factor,
+                    each pixel being the mean of a box of downsample x downsample pixels,
+                    for e.g. fast scrubbing through time. """
+    self.source = ImageJVirtualStackUnsignedShort.wrap(img)
+    self.downsample = max(1, downsample)
+    self.width = self.source.getWidth() / self.downsample
+    self.height = self.source.getHeight() / self.downsample
+    self.n_planes = self.source.getSize()
+    super(VirtualStack, self).__init__(self.width, self.height, self.n_planes)
+    self.n_channels = n_channels
+    # Number of planes per time point
+    self.frame_size = img.dimension(2) if img.numDimensions() > 2 else 1
+    if 0 == cache_bytes:
+      cache_bytes = Runtime.getRuntime().maxMemory() / 10
+    self.max_planes = max(1, cache_bytes / (self.width * self.height * 2))
+    self.prefetch = prefetch
+    self.cache = OrderedDict() # plane index vs short[] pixels
+    self.pending = {} # plane index vs Future
+    self.exe = newFixedThreadPool(n_threads, name="stack-prefetcher")
+
+  @make_synchronized
+  def lookup(self, n):
+    """ Return the pixels of plane n if cached, and otherwise the Future of its pending rendering, if any. """
+    pixels = self.cache.pop(n, None)
+    if pixels is not None:
+      self.cache[n] = pixels # move to the end: most recently used
+      return pixels, None
+    return None, self.pending.get(n, None)
+
+  @make_synchronized
+  def store(self, n, pixels):
+    self.cache[n] = pixels
+    self.pending.pop(n, None)
+    while len(self.cache) > self.max_planes:
+      self.cache.popitem(last=False) # the least recently used
+
+  def render(self, n):
+    pixels = self.source.getProcessor(n).getPixels()
+    if self.downsample > 1:
+      pixels = _boxMeans()(pixels, self.source.getWidth(), self.source.getHeight(), self.downsample)
+    self.store(n, pixels)
+    return pixels
+
+  def neighbors(self, n):
+    """ Planes of the same channel adjacent to n in Z within the same time point,
+        and at the same Z in adjacent time points. """
+    t0 = (n - 1) / self.frame_size * self.frame_size # first plane of the time point, 0-based
+    for i in xrange(1, self.prefetch + 1):
+      for m in (n + i * self.n_channels, n - i * self.n_channels):
+        if t0 < m <= t0 + self.frame_size:
+          yield m
+      for m in (n + i * self.frame_size, n - i * self.frame_size):
+        if 0 < m <= self.n_planes:
+          yield m
+
+  @make_synchronized
+  def prefetchAround(self, n):
+    if not self.exe:
+      return
+    wanted = set(self.neighbors(n))
+    # Cancel prefetching of planes that are no longer adjacent
+    for m, future in self.pending.items():
+      if m not in wanted and m != n and future.cancel(False):
+        del self.pending[m]
+    for m in wanted:
+      if m not in self.cache and m not in self.pending:
+        self.pending[m] = self.exe.submit(Task(self.render, m))
+
+  def getPixels(self, n):
+    # n is 1-based
+    pixels, future = self.lookup(n)
+    if pixels is None and future:
+      try:
+        pixels = future.get()
+      except (CancellationException, ExecutionException):
+        pixels = None # render it below
+    if pixels is None:
+      pixels = self.render(n)
+    self.prefetchAround(n)
+    # Return a copy: ImageJ may edit the pixels
+    return pixels[:]
+
+  def getProcessor(self, n):
+    return ShortProcessor(self.width, self.height, self.getPixels(n), None)
+
+  @make_synchronized
+  def destroy(self):
+    """ Stop prefetching and release the cached planes. """
+    if self.exe:
+      self.exe.shutdownNow()
+      self.exe = None
+    self.pending.clear()
+    self.cache.clear()
+
+
+# Compiled on first use
+_planeCopier = None
+_planeDownsampler = None
+
+def _boxMeans():
+  global _planeDownsampler
+  if _planeDownsampler is None:
+    _planeDownsampler = Weaver.method("""
+      // The mean of each box of factor x factor unsigned 16-bit pixels,
+      // into a new plane of (width / factor) x (height / factor) pixels.
+      static public final short[] boxMeans(final short[] pixels, final int width, final int height, final int factor) {
+        final int tw = width / factor,
+                  th = height / factor,
+                  area = factor * factor;
+        final long[] sums = new long[tw];
+        final short[] target = new short[tw * th];
+        for (int y=0; y<th; ++y) {
+          Arrays.fill(sums, 0);
+          for (int row=y*factor, end=row+factor; row<end; ++row) {
+            final int offset = row * width;
+            for (int x=0; x<tw * factor; ++x) {
+              sums[x / factor] += pixels[offset + x] & 0xffff;
+            }
+          }
+          for (int x=0; x<tw; ++x) {
+            target[y * tw + x] = (short)((sums[x] + area / 2) / area);
+          }
+        }
+        return target;
+      }
+    """, [Arrays])
+  return _planeDownsampler.boxMeans
+
+def _copyPlane():
+  global _planeCopier
+  if _planeCopier is None:
+    _planeCopier = Weaver.method("""
+      static public final void copy(final Cursor c, final short[] a) {
+        int i = 0;
+        while (c.hasNext()) {
+          a[i++] = (short) (int) ((RealType) c.next()).getRealFloat();
+        }
+      }
+    """, [Cursor, RealType])
+  return _planeCopier.copy
+
+
+class Stack4D(VirtualStack):
+  """ A 16-bit VirtualStack over a 3D or 4D imglib2 img, with the planes of each time point in sequence.
+      The pixels of a plane are obtained, from fastest to slowest:
+       - PlanarImg of shorts: the plane's own short[], without copying,
+         so that editing it in ImageJ edits the img.
+       - ArrayImg of shorts: System.arraycopy of the plane's contiguous run.
+       - Cell img (e.g. a LazyCellImg) whose cells span whole XY planes and hold a short[]:
+         System.arraycopy from the cell's array, such as one cell per time point.
+       - Any other: a compiled cursor loop over the plane.
+      By default copies are made into a new array for each plane, so that planes held by the caller,
+      such as by ImageJ's duplicate, z-projection or montage, remain valid.
+      With n_buffers larger than zero, copies are made instead into a ring of n_buffers reused plane
+      arrays, avoiding the allocation of a new array for each plane while scrolling: a plane's pixels
+      are then overwritten after n_buffers further planes are requested, so use it only when
+      the caller consumes each plane right away. """
+  def __init__(self, img4d, n_buffers=0):
+    self.width = img4d.dimension(0)
+    self.height = img4d.dimension(1)
+    self.nZ = img4d.dimension(2) if img4d.numDimensions() > 2 else 1
+    nT = img4d.dimension(3) if img4d.numDimensions() > 3 else 1
+    super(VirtualStack, self).__init__(self.width, self.height, self.nZ * nT)
+    self.img4d = img4d
+    self.plane_size = self.width * self.height
+    self.buffers = [None] * n_buffers
+    self.next_buffer = 0
+    self.cells = None
+    if isinstance(img4d, AbstractCellImg):
+      grid = img4d.getCellGrid()
+      if grid.cellDimension(0) == self.width and grid.cellDimension(1) == self.height:
+        self.cells = img4d.getCells()
+
+  @make_synchronized
+  def buffer(self):
+    """ Return the next plane array of the ring. """
+    if 0 == len(self.buffers):
+      return zeros(self.plane_size, 'h')
+    i = self.next_buffer
+    self.next_buffer = (i + 1) % len(self.buffers)
+    if self.buffers[i] is None:
+      self.buffers[i] = zeros(self.plane_size, 'h')
+    return self.buffers[i]
+
+  def copyRun(self, source, offset):
+    pixels = self.buffer()
+    System.arraycopy(source, offset, pixels, 0, self.plane_size)
+    return pixels
+
+  def getPixels(self, n):
+    # 'n' is 1-based
+    index = n - 1 # of the plane in the whole series
+    z, t = index % self.nZ, index / self.nZ
+    img = self.img4d
+    if isinstance(img, PlanarImg):
+      pixels = img.getPlane(index).getCurrentStorageArray()
+      if 'h' == pixels.typecode:
+        return pixels
+    elif isinstance(img, ArrayImg):
+      pixels = img.update(None).getCurrentStorageArray()
+      if 'h' == pixels.typecode:
+        return self.copyRun(pixels, index * self.plane_size)
+    elif self.cells:
+      ra = self.cells.randomAccess() # not thread-safe: one per call
+      grid = img.getCellGrid()
+      position = [0, 0] + [z / grid.cellDimension(2)] + ([t / grid.cellDimension(3)] if img.numDimensions() > 3 else [])
+      ra.setPosition(position)
+      cell = ra.get()
+      pixels = cell.getData().getCurrentStorageArray() if hasattr(cell.getData(), "getCurrentStorageArray") else None
+      if pixels is not None and 'h' == pixels.typecode:
+        local_index = z - cell.min(2)
+        if img.numDimensions() > 3:
+          local_index += (t - cell.min(3)) * cell.dimension(2)
+        return self.copyRun(pixels, local_index * self.plane_size)
+    # Generic: walk the plane
+    plane = Views.hyperSlice(img, 3, t) if img.numDimensions() > 3 else img
+    if img.numDimensions() > 2:
+      plane = Views.hyperSlice(plane, 2, z)
+    pixels = self.buffer()
+    _copyPlane()(Views.flatIterable(plane).cursor(), pixels)
+    return pixels
+
+  def getProcessor(self, n):
+    return ShortProcessor(self.width, self.height, self.getPixels(n), None)
+
+
+class DestroyOnClose(ImageListener):
+  """ Destroy the CachedVirtualStack when its ImagePlus is closed. """
+  def __init__(self, imp, stack):
+    self.imp = imp
+    self.stack = stack
+  def imageOpened(self, imp):
+    pass
+  def imageUpdated(self, imp):
+    pass
+  def imageClosed(self, imp):
+    if imp == self.imp:
+      self.stack.destroy()
+      ImagePlus.removeImageListener(self)
+
+
+def wrapCached(img, title="", n_channels=1, **kwargs):
+  """ Like wrap, but with a CachedVirtualStack.
+      Additional keyword arguments, such as downsample, are passed on to CachedVirtualStack. """
+  imp = ImagePlus(title, CachedVirtualStack(img, n_channels=n_channels, **kwargs))
+  n = img.numDimensions()
+  n_slices = img.dimension(2) / n_channels if n > 2 else 1
+  n_frames = img.dimension(3) if n > 3 else 1
+  imp.setDimensions(n_channels, n_slices, n_frames)
+  return imp
+
 
 def showAsStack(images, title=None, show=True):
   if not title:
@@ -36,7 +316,10 @@ def showInBDV(images, names=None, bdv=None):
   return bdv
 
 
-def showStack(img, title="", proper=True, n_channels=1):
+def showStack(img, title="", proper=True, n_channels=1, cached=False, downsample=1):
+  """ cached: use a CachedVirtualStack (see wrapCached), which is destroyed when the window is closed,
+          for browsing large or expensive to compute imgs. Defaults to False.
+      downsample: only when cached, see CachedVirtualStack. """
   # IL.wrap fails: shows slices as channels, and channels as frames
   if not proper:
     imp = IL.wrap(img, title)
@@ -44,8 +327,13 @@ def showStack(img, title="", proper=True, n_channels=1):
     return imp
   print "io.showStack: ", title
   # Proper sorting of slices, channels and frames
-  imp = wrap(img, title=title, n_channels=n_channels)
+  if cached:
+    imp = wrapCached(img, title=title, n_channels=n_channels, downsample=downsample)
+  else:
+    imp = wrap(img, title=title, n_channels=n_channels)
   comp = CompositeImage(imp, CompositeImage.GRAYSCALE if 1 == n_channels else CompositeImage.COLOR)
+  if cached:
+    ImagePlus.addImageListener(DestroyOnClose(comp, imp.getStack()))
   comp.show()
   return comp
 
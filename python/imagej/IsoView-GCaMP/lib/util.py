@@ -1,5 +1,5 @@
 from synchronize import make_synchronized
-from java.util.concurrent import Callable, Future, Executors, ThreadFactory
+from java.util.concurrent import Callable, Future, Executors, ThreadFactory, ForkJoinPool, ExecutorCompletionService
 from java.util.concurrent.atomic import AtomicInteger
 from java.lang.reflect.Array import newInstance as newArray
 from java.lang import Runtime, Thread, Double, Float, Byte, Short, Integer, Long, Boolean, Character, System
@@ -87,19 +87,62 @@ class ThreadFactorySameGroup(ThreadFactory):
     t.setPriority(Thread.NORM_PRIORITY)
     return t
 
-def newFixedThreadPool(n_threads=0, name="jython-worker"):
+class ForkJoinThreadFactory(ForkJoinPool.ForkJoinWorkerThreadFactory):
+  def __init__(self, name):
+    self.name = name
+    self.counter = AtomicInteger(0)
+  def newThread(self, pool):
+    t = ForkJoinPool.defaultForkJoinWorkerThreadFactory.newThread(pool)
+    t.setName("%s-%i" % (self.name, self.counter.incrementAndGet()))
+    return t
+
+
+def memoryBoundThreadCount(n_threads=0, bytes_per_task=0, heap_fraction=0.8):
+  """ Return the number of threads to use, so that as many tasks as threads,
+      each needing bytes_per_task, fit within the heap_fraction of the JVM max heap
+      that isn't already in use.
+      n_threads: as in newFixedThreadPool.
+      bytes_per_task: estimated memory footprint of each task. If zero, memory isn't considered.
+      heap_fraction: defaults to 0.8 of the max heap, leaving room for everything else. """
+  runtime = Runtime.getRuntime()
+  if n_threads <= 0:
+    n_threads = max(1, runtime.availableProcessors() + n_threads)
+  if bytes_per_task <= 0:
+    return n_threads
+  used = runtime.totalMemory() - runtime.freeMemory()
+  available = runtime.maxMemory() * heap_fraction - used
+  return max(1, min(n_threads, int(available / bytes_per_task)))
+
+
+def newFixedThreadPool(n_threads=0, name="jython-worker", bytes_per_task=0):
   """ Return an ExecutorService whose Thread instances belong
       to the same group as the caller's Thread, and therefore will
       be interrupted when the caller is.
       n_threads: number of threads to use.
                  If zero, use as many as available CPUs.
                  If negative, use as many as available CPUs minus that number,
-                 but at least one. """
-  if n_threads <= 0:
-    n_threads = max(1, Runtime.getRuntime().availableProcessors() + n_threads)
+                 but at least one.
+      bytes_per_task: if larger than zero, reduce the number of threads
+                      so that concurrent tasks fit in the heap (see memoryBoundThreadCount). """
+  n_threads = memoryBoundThreadCount(n_threads, bytes_per_task)
   return Executors.newFixedThreadPool(n_threads, ThreadFactorySameGroup(name))
 
 
+def newWorkStealingPool(n_threads=0, name="jython-fj-worker", bytes_per_task=0):
+  """ Return a ForkJoinPool, a work-stealing ExecutorService.
+      Use it when tasks submit other tasks to the same pool and wait for them,
+      such as registration.fitModel -> features.findPointMatches -> makeFeatures,
+      which can deadlock a fixed thread pool once all its threads wait.
+      A thread of the pool that waits on a Future.get() of another task of the pool
+      may run that task itself, but mostly the pool starts a compensating thread
+      to keep n_threads running, so it doesn't deadlock.
+      n_threads, bytes_per_task: as in newFixedThreadPool, but only as the target parallelism:
+      with compensating threads, more tasks than n_threads can run at once, so the memory
+      bound of bytes_per_task is not enforced when tasks wait on other tasks. """
+  n_threads = memoryBoundThreadCount(n_threads, bytes_per_task)
+  return ForkJoinPool(n_threads, ForkJoinThreadFactory(name), None, False)
+
+
 class ParallelTasks:
   def __init__(self, name, exe=None):
     self.exe = exe if exe else newFixedThreadPool()
@@ -131,6 +174,96 @@ class ParallelTasks:
     self.futures = None
 
 
+class BoundedScheduler:
+  """ Submit tasks to a thread pool, blocking the submitting thread while as many tasks
+      are in flight as threads plus a queue of the same length, or as fit in the free heap
+      given the estimated memory footprint of each task, whichever is fewer.
+      Before waiting for a task to complete for lack of memory, asks a cache to release memory
+      (e.g. the releaseToFit method of a TrakEM2 Loader), rather than relying on eviction
+      triggered by an OutOfMemoryError. Reports throughput and the estimated time to completion. """
+  def __init__(self, n_threads=0, bytes_per_task=0, n_tasks=0, release=None,
+               name="bounded-scheduler", heap_fraction=0.8, report_interval=30):
+    """ n_threads: as in newFixedThreadPool.
+        bytes_per_task: estimated memory footprint of each task. If zero, memory isn't considered.
+        n_tasks: the total number of tasks that will be submitted, for the estimated time to completion.
+        release: a function that, given a number of bytes, frees that much memory from caches. Optional.
+        heap_fraction: of the JVM max heap that tasks may use (see memoryBoundThreadCount).
+        report_interval: minimum number of seconds between progress reports. Zero to never report. """
+    self.n_threads = memoryBoundThreadCount(n_threads, bytes_per_task, heap_fraction)
+    self.exe = newFixedThreadPool(self.n_threads, name=name)
+    self.completion = ExecutorCompletionService(self.exe)
+    self.name = name
+    self.bytes_per_task = bytes_per_task
+    self.n_tasks = n_tasks
+    self.release = release
+    self.heap_fraction = heap_fraction
+    self.report_interval = report_interval
+    self.n_in_flight = 0
+    self.n_submitted = 0
+    self.n_done = 0
+    self.t0 = System.nanoTime()
+    self.last_report = self.t0
+
+  def hasRoom(self):
+    """ Whether another task can be submitted without exceeding the queue length or the heap. """
+    if self.n_in_flight >= 2 * self.n_threads:
+      return False
+    if self.bytes_per_task <= 0:
+      return True
+    runtime = Runtime.getRuntime()
+    available = runtime.maxMemory() * self.heap_fraction - (runtime.totalMemory() - runtime.freeMemory())
+    return available >= self.bytes_per_task
+
+  def completed(self, future):
+    self.n_in_flight -= 1
+    self.n_done += 1
+    self.report()
+    return future
+
+  def drain(self):
+    """ Account for the tasks that completed, without waiting. """
+    future = self.completion.poll()
+    while future:
+      self.completed(future)
+      future = self.completion.poll()
+
+  def submit(self, fn, *args, **kwargs):
+    """ Submit fn to be invoked with args and kwargs, waiting first for room if necessary.
+        Returns the Future of the task. """
+    self.drain()
+    while self.n_in_flight > 0 and not self.hasRoom():
+      if self.release and self.bytes_per_task > 0:
+        self.release(self.bytes_per_task)
+        if self.hasRoom():
+          break
+      # Wait for a task to complete. Its result remains available from its Future.
+      self.completed(self.completion.take())
+    self.n_in_flight += 1
+    self.n_submitted += 1
+    return self.completion.submit(Task(fn, *args, **kwargs))
+
+  def awaitAll(self):
+    """ Wait until all submitted tasks complete, and report. """
+    while self.n_in_flight > 0:
+      self.completed(self.completion.take())
+    self.report(force=True)
+
+  def report(self, force=False):
+    now = System.nanoTime()
+    if not force and (self.report_interval <= 0 or (now - self.last_report) / 1000000000.0 < self.report_interval):
+      return
+    self.last_report = now
+    elapsed = (now - self.t0) / 1000000000.0
+    rate = self.n_done / elapsed if elapsed > 0 else 0
+    msg = "%s: %i tasks done in %.1f s, %.2f tasks/s" % (self.name, self.n_done, elapsed, rate)
+    if self.n_tasks > 0 and rate > 0:
+      msg += ", %i of %i, ETA %.1f min" % (self.n_done, self.n_tasks, (self.n_tasks - self.n_done) / rate / 60.0)
+    syncPrint(msg)
+
+  def shutdown(self):
+    self.exe.shutdown()
+
+
 def timeit(n_iterations, fn, *args, **kwargs):
   times = []
   for i in xrange(n_iterations):
@@ -0,0 +1,226 @@
+# Headless benchmark of the IsoView-GCaMP lib on synthetic GCaMP-like volumes.
+# Each timepoint contains the nuclei of the prior one transformed by a known affine,
+# which is then used to check the accuracy of the registration.
+# Results are appended to a CSV file for regression tracking.
+# Run e.g.:
+# $ ./ImageJ-linux64 --headless tests/benchmark_lib_synthetic.py
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.benchmark import syntheticSeries, syntheticAffine, cumulativeAffine, transformError, recall, measure, BenchmarkReport
+from lib.dogpeaks import getDoGPeaks
+from lib.features import makeRadiusSearch, extractFeatures, PointMatches
+from lib.registration import fit, computeOptimizedTransforms
+from lib.converter import convert, createConverter
+from lib.io import readFloats, writeN5
+from lib.util import newFixedThreadPool, nativeArray
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.util import ImgUtil
+from net.imglib2.type.numeric.real import FloatType
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from mpicbg.models import RigidModel3D
+from java.io import RandomAccessFile
+from java.nio import ByteBuffer
+import os, tempfile, shutil
+
+
+report_path = "/tmp/benchmark_lib_synthetic.csv"
+
+sizes = [[128, 128, 64],
+         [256, 256, 128]]
+thread_counts = [1, 2, 4, 0] # 0 means as many as CPUs
+n_iterations = 3
+n_warmup = 1 # untimed iterations to let the JIT compile
+
+n_timepoints = 3
+nuclei_density = 1 / 4000.0 # nuclei per voxel
+somaDiameter = 8.0
+sigma = somaDiameter / 4.0 # of the rendered Gaussian nuclei
+
+# The known transform from each timepoint to the next
+angle = 0.05 # radians
+translation = [3.0, -2.0, 1.5]
+
+# Accuracy thresholds, in pixels
+max_mean_error = 1.0
+min_recall = 0.9
+
+params = {
+  # DoG
+  "minPeakValue": 30,
+  "sigmaSmaller": somaDiameter / 4.0,
+  "sigmaLarger": somaDiameter / 2.0,
+  # Features
+  "radius": somaDiameter * 5,
+  "min_angle": 0.25,
+  "max_per_peak": 20,
+  # PointMatches
+  "angle_epsilon": 0.02,
+  "len_epsilon_sq": pow(somaDiameter, 2),
+  "pointmatches_nearby": 1,
+  "pointmatches_search_radius": somaDiameter * 2,
+  # RANSAC
+  "maxEpsilon": somaDiameter / 2.0,
+  "minInlierRatio": 0.0000001,
+  "minNumInliers": 5,
+  "n_iterations": 2000,
+  "maxTrust": 4,
+  # TileConfiguration
+  "n_adjacent": n_timepoints,
+  "fixed_tile_indices": [0],
+  "maxAllowedError": 0,
+  "maxPlateauwidth": 200,
+  "maxIterations": 1000,
+  "damp": 1.0,
+}
+
+calibration = [1.0, 1.0, 1.0]
+
+
+def timed(fn, *args, **kwargs):
+  """ Run n_warmup untimed iterations, then n_iterations timed ones. """
+  measure(n_warmup, fn, *args, **kwargs)
+  return measure(n_iterations, fn, *args, **kwargs)
+
+
+class SyntheticLoader():
+  def __init__(self, images):
+    self.images = images
+  def load(self, img_filename):
+    return self.images[int(img_filename[2:])] # e.g. "TM2"
+  def get(self, img_filename):
+    return self.load(img_filename)
+
+
+def getCalibration(img_filename):
+  return calibration
+
+
+def writeRawFloats(img, path):
+  """ Write the img as big-endian floats, as expected by io.readFloats. """
+  imgA = ArrayImgs.floats([img.dimension(d) for d in xrange(img.numDimensions())])
+  ImgUtil.copy(img, imgA)
+  floats = imgA.update(None).getCurrentStorageArray()
+  bb = ByteBuffer.allocate(len(floats) * 4)
+  bb.asFloatBuffer().put(floats)
+  ra = RandomAccessFile(path, 'rw')
+  try:
+    ra.write(bb.array())
+  finally:
+    ra.close()
+
+
+def benchmark(dimensions, report, tmp_dir):
+  n_nuclei = int(reduce(lambda a, b: a * b, dimensions) * nuclei_density)
+  affine = syntheticAffine(dimensions, angle, translation)
+  images, positions = syntheticSeries(dimensions, n_timepoints, n_nuclei, affine, sigma)
+  img1, img2 = images[0], images[1]
+
+  # DoG peaks
+  peaks1, times = timed(getDoGPeaks, img1, calibration, params["sigmaSmaller"],
+                        params["sigmaLarger"], params["minPeakValue"])
+  # Accuracy as the fraction of nuclei missed
+  r = recall(peaks1, positions[0], sigma)
+  report.add("getDoGPeaks", dimensions, 1, times, count=len(peaks1),
+             error_mean=1.0 - r, passed=r >= min_recall)
+  peaks2 = getDoGPeaks(img2, calibration, params["sigmaSmaller"],
+                       params["sigmaLarger"], params["minPeakValue"])
+
+  # Constellation features
+  features1, times = timed(extractFeatures, peaks1, makeRadiusSearch(peaks1),
+                           params["radius"], params["min_angle"], params["max_per_peak"])
+  report.add("extractFeatures", dimensions, 1, times, count=len(features1))
+  features2 = extractFeatures(peaks2, makeRadiusSearch(peaks2),
+                              params["radius"], params["min_angle"], params["max_per_peak"])
+
+  # PointMatches, each mode
+  modes = [("PointMatches.fromFeatures", PointMatches.fromFeatures, []),
+           ("PointMatches.fromNearbyFeatures", PointMatches.fromNearbyFeatures, [params["pointmatches_search_radius"]]),
+           ("PointMatches.fromFeaturesScaleInvariant", PointMatches.fromFeaturesScaleInvariant, [])]
+  for name, method, extra_args in modes:
+    args = extra_args + [features1, features2, params["angle_epsilon"], params["len_epsilon_sq"]]
+    pm, times = timed(method, *args)
+    pointmatches = pm.pointmatches
+    report.add(name, dimensions, 1, times, count=len(pointmatches))
+
+    # RANSAC fit of the pointmatches of each mode
+    def fitRigid():
+      model = RigidModel3D()
+      modelFound, inliers = fit(model, pointmatches, params["n_iterations"], params["maxEpsilon"],
+                                params["minInlierRatio"], params["minNumInliers"], params["maxTrust"])
+      return model, modelFound, inliers
+    (model, modelFound, inliers), times = timed(fitRigid)
+    if modelFound:
+      a = nativeArray('d', [3, 4])
+      model.toMatrix(a)
+      error_mean, error_max = transformError(a[0] + a[1] + a[2], affine, positions[0])
+    else:
+      error_mean, error_max = "", ""
+    report.add("fit " + name.split(".")[-1], dimensions, 1, times, count=len(inliers),
+               error_mean=error_mean, error_max=error_max,
+               passed=modelFound and error_mean < max_mean_error)
+
+  # Joint optimization across all timepoints, at each thread count
+  img_filenames = ["TM%i" % t for t in xrange(n_timepoints)]
+  loader = SyntheticLoader(images)
+  for n_threads in thread_counts:
+    def optimize():
+      # A fresh CSV directory each time, so that no features or pointmatches are reused
+      csv_dir = tempfile.mkdtemp(dir=tmp_dir)
+      exe = newFixedThreadPool(n_threads)
+      try:
+        return computeOptimizedTransforms(img_filenames, loader, getCalibration, csv_dir,
+                                          exe, RigidModel3D, params, verbose=False)
+      finally:
+        exe.shutdownNow()
+        shutil.rmtree(csv_dir, True)
+    matrices, times = timed(optimize)
+    # Each tile model maps its timepoint onto the fixed first timepoint
+    errors = [transformError(matrix, cumulativeAffine(affine, t).inverse(), positions[t])
+              for t, matrix in enumerate(matrices)]
+    error_mean = max(e[0] for e in errors)
+    report.add("computeOptimizedTransforms", dimensions, n_threads, times, count=len(matrices),
+               error_mean=error_mean, error_max=max(e[1] for e in errors),
+               passed=error_mean < max_mean_error)
+
+  # Conversion from FloatType to UnsignedShortType, copied into an ArrayImg to realize it
+  converter = createConverter(FloatType, UnsignedShortType)
+  def convertAndCopy():
+    target = ArrayImgs.unsignedShorts(dimensions)
+    ImgUtil.copy(convert(img1, converter, UnsignedShortType), target)
+    return target
+  _, times = timed(convertAndCopy)
+  report.add("convert", dimensions, 1, times)
+
+  # Reading raw floats
+  raw_path = os.path.join(tmp_dir, "img1.raw")
+  writeRawFloats(img1, raw_path)
+  imgR, times = timed(readFloats, raw_path, dimensions)
+  same = all(imgR.dimension(d) == dim for d, dim in enumerate(dimensions))
+  report.add("readFloats", dimensions, 1, times, passed=same)
+
+  # Writing N5, at each thread count
+  for n_threads in thread_counts:
+    n5_dir = os.path.join(tmp_dir, "n5-%i" % n_threads)
+    def write():
+      shutil.rmtree(n5_dir, True)
+      writeN5(img1, n5_dir, "img1", [64, 64, 32], n_threads=n_threads)
+    _, times = timed(write)
+    report.add("writeN5", dimensions, n_threads, times)
+    shutil.rmtree(n5_dir, True)
+
+
+report = BenchmarkReport(report_path)
+tmp_dir = tempfile.mkdtemp(prefix="benchmark_lib_")
+try:
+  for dimensions in sizes:
+    benchmark(dimensions, report, tmp_dir)
+finally:
+  report.write()
+  shutil.rmtree(tmp_dir, True)
+
+failures = report.failures()
+print "Wrote %i rows to %s" % (len(report.rows), report_path)
+if failures:
+  print "FAILED accuracy checks:"
+  for row in failures:
+    print "  ", row["operation"], row["size"], "threads:", row["n_threads"]
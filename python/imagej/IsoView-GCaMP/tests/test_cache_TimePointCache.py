@@ -0,0 +1,40 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.cache import TimePointCache, sizeOfImage
+from lib.util import newFixedThreadPool, Task
+from net.imglib2.img.array import ArrayImgs
+from java.lang import Thread
+from collections import defaultdict
+
+n_loads = defaultdict(int)
+
+def load(t):
+  n_loads[t] += 1 # only ever by one thread per key
+  Thread.sleep(50) # pretend to read from disk
+  return ArrayImgs.unsignedShorts([64, 64, 8]) # 64 KB each
+
+keys = range(20)
+# Room for 4 volumes
+cache = TimePointCache(load, keys=keys, max_bytes=4 * 64 * 64 * 8 * 2, prefetch=1)
+print "size of one volume:", sizeOfImage(load(-1))
+
+# Many threads requesting the same few keys concurrently: each loaded only once
+exe = newFixedThreadPool(8)
+try:
+  futures = [exe.submit(Task(cache, t % 3)) for t in xrange(24)]
+  for f in futures:
+    f.get()
+finally:
+  exe.shutdown()
+print "Loaded once per key:", "OK" if all(1 == n_loads[t] for t in xrange(3)) else "FAILED: %s" % dict(n_loads)
+
+# Sequential playback: neighbors are prefetched
+for t in keys:
+  cache(t)
+  Thread.sleep(60)
+cache.printStats()
+stats = cache.stats()
+print "Byte budget respected:", "OK" if stats["bytes"] <= cache.cache.max_bytes else "FAILED"
+print "Prefetching hits:", "OK" if stats["hits"] > len(keys) / 2 else "FAILED"
+cache.destroy()
@@ -0,0 +1,35 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.dogpeaks import PeaksStore
+from net.imglib2 import RealPoint
+import os, tempfile
+
+path = os.path.join(tempfile.mkdtemp(), "peaks.bin")
+peaks = {t: [RealPoint([t + i * 0.5, i * 1.25, -i]) for i in xrange(t * 3)] for t in xrange(5)}
+
+store = PeaksStore(path, n_timepoints=5, parameters=[1.0, 1.0, 1.0, 2.5, 5, 100])
+# Out of order, and with one time point missing
+for t in [3, 0, 4, 1]:
+  store.write(t, peaks[t])
+store.close()
+
+store = PeaksStore(path)
+print "Missing:", "OK" if [2] == store.missing() else "FAILED: %s" % store.missing()
+for t in [4, 1, 0, 3]:
+  read = store.read(t)
+  ok = len(read) == len(peaks[t]) and all(a.getFloatPosition(d) == b.getFloatPosition(d)
+                                          for a, b in zip(read, peaks[t]) for d in xrange(3))
+  print t, "OK" if ok else "FAILED"
+print "Not stored:", "OK" if store.read(2) is None else "FAILED"
+store.close()
+
+# Peaks detected with other parameters are not reused
+store = PeaksStore(path, parameters=[1.0, 1.0, 1.0, 2.5, 5, 100])
+print "Same parameters:", "OK" if [3, 0, 4, 1] == [t for t in [3, 0, 4, 1] if store.has(t)] else "FAILED"
+store.close()
+try:
+  PeaksStore(path, parameters=[1.0, 1.0, 1.0, 2.5, 5, 120])
+  print "Different parameters: FAILED"
+except Exception:
+  print "Different parameters: OK"
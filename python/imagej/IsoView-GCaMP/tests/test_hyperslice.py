@@ -0,0 +1,45 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.hyperslice import HyperSlicer
+from ij import IJ, ImagePlus, ImageStack
+from ij.io import FileSaver
+from ij.process import ShortProcessor
+from jarray import array
+import os, tempfile
+
+# A 4D 16-bit hyperstack whose pixel values encode their x, y, z, t coordinates
+width, height, depth, n_frames = 16, 12, 5, 4
+stack = ImageStack(width, height)
+for t in xrange(n_frames):
+  for z in xrange(depth):
+    pixels = array([x + 16 * y + 256 * z + 2048 * t for y in xrange(height) for x in xrange(width)], 'h')
+    stack.addSlice(ShortProcessor(width, height, pixels, None))
+imp = ImagePlus("4D", stack)
+imp.setDimensions(1, depth, n_frames)
+
+path = os.path.join(tempfile.mkdtemp(), "4D.tif")
+FileSaver(imp).saveAsTiffStack(path)
+# Opened as a FileInfoVirtualStack: rows are read directly from the file
+virtual = IJ.openVirtual(path)
+virtual.setDimensions(1, depth, n_frames)
+
+def expected(axis, position, t, i, j):
+  """ The value at column i and row j of the extracted plane of time point t. """
+  if "XY" == axis:
+    return i + 16 * j + 256 * (position - 1) + 2048 * t
+  if "XZ" == axis:
+    return i + 16 * position + 256 * j + 2048 * t
+  return position + 16 * i + 256 * j + 2048 * t
+
+for source in [imp, virtual]:
+  slicer = HyperSlicer(source, n_threads=3)
+  for axis, position in [("XY", 2), ("XZ", 7), ("YZ", 3), ("XZ", 7)]: # the last one from the cache
+    result = slicer.extract(axis=axis, position=position, channel=1, show=False)
+    w, h = result.getWidth(), result.getHeight()
+    ok = result.getStackSize() == n_frames
+    for t in xrange(n_frames):
+      pixels = result.getStack().getPixels(t + 1)
+      ok = ok and all(pixels[j * w + i] == expected(axis, position, t, i, j)
+                      for j in xrange(h) for i in xrange(w))
+    print source.getStack().isVirtual(), axis, position, "OK" if ok else "FAILED"
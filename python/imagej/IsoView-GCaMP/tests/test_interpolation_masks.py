@@ -0,0 +1,57 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.interpolation import signedDistanceTransform, interpolateMasks
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from net.imglib2 import KDTree, RealPoint
+from net.imglib2.neighborsearch import NearestNeighborSearchOnKDTree
+from jarray import zeros
+
+# Compare with a KDTree search of the edge pixels, as in the original pure python implementation
+dimensions = [40, 30, 20]
+sphere = ArrayImgs.unsignedBytes(dimensions)
+c = sphere.cursor()
+pos = zeros(3, 'l')
+while c.hasNext():
+  t = c.next()
+  c.localize(pos)
+  if sum(pow(p - d / 2.0, 2) for p, d in zip(pos, dimensions)) < 64:
+    t.setOne()
+cube = ArrayImgs.unsignedBytes(dimensions)
+for t in Views.interval(cube, [5, 5, 5], [25, 20, 15]):
+  t.setOne()
+
+def edgePixels(img):
+  edges = []
+  c = img.cursor()
+  while c.hasNext():
+    if 0 == c.next().get():
+      continue
+    c.localize(pos)
+    if 0 in [t.get() for t in Views.interval(Views.extendZero(img), [p - 1 for p in pos], [p + 1 for p in pos])]:
+      edges.append(RealPoint([float(p) for p in pos]))
+  return edges
+
+for name, mask in (("sphere", sphere), ("cube", cube)):
+  sdt = signedDistanceTransform(mask, n_threads=3)
+  edges = edgePixels(mask)
+  search = NearestNeighborSearchOnKDTree(KDTree(edges, edges))
+  cm, cs = mask.cursor(), sdt.cursor()
+  n_mismatches = 0
+  while cm.hasNext():
+    inside = 0 != cm.next().get()
+    d = cs.next().get()
+    search.search(cm)
+    expected = search.getDistance() * (1 if inside else -1)
+    if abs(expected - d) > 0.001:
+      n_mismatches += 1
+  print name, "SDT:", "OK" if 0 == n_mismatches else "FAILED: %i mismatches" % n_mismatches
+
+# A weight of 1 reproduces the first mask and of 0 the second, except for their edge pixels,
+# whose distance is zero, as in the original implementation
+first, second = interpolateMasks(sphere, cube, [1.0, 0.0])
+def count(img):
+  return sum(t.get() for t in img)
+print "Extremes:", "OK" if count(first) == count(sphere) - len(edgePixels(sphere)) \
+                      and count(second) == count(cube) - len(edgePixels(cube)) else "FAILED"
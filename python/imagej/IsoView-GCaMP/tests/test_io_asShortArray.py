@@ -0,0 +1,26 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.io import asShortArray
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from java.lang import System
+
+dimensions = [256, 200, 60]
+img = ArrayImgs.unsignedShorts(dimensions)
+for i, v in enumerate(img):
+  v.set(i % 65536)
+
+# Array-backed: no copy
+print "Same array:", "OK" if asShortArray(img) is img.update(None).getCurrentStorageArray() else "FAILED"
+
+# Not array-backed: copied in flat iteration order
+views = [("permuted", Views.zeroMin(Views.permute(img, 0, 1))),
+         ("interval", Views.zeroMin(Views.interval(img, [10, 20, 5], [99, 149, 44]))),
+         ("floats", Views.interval(Views.stack([ArrayImgs.floats([4, 3]) for _ in xrange(2)]), [0, 0, 0], [3, 2, 1]))]
+for name, view in views:
+  t0 = System.nanoTime()
+  pixels = asShortArray(view)
+  ms = (System.nanoTime() - t0) / 1000000.0
+  ok = all((pixels[i] & 0xffff) == int(v.getRealFloat()) for i, v in enumerate(Views.flatIterable(view)))
+  print name, "OK" if ok else "FAILED", "in %.1f ms" % ms
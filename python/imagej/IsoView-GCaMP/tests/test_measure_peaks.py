@@ -0,0 +1,53 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.measure import measurePeaks, measurePeaksOverTime
+from net.imglib2 import Point
+from net.imglib2.algorithm.neighborhood import HyperSphereShape
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from java.util import Random
+
+# Compare with a HyperSphereShape neighborhood, for peaks within the image and at its borders
+dimensions = [64, 48, 32]
+rng = Random(42)
+img = ArrayImgs.unsignedShorts(dimensions)
+for t in img:
+  t.setInteger(rng.nextInt(4096))
+peaks = [Point([rng.nextInt(d) for d in dimensions]) for _ in xrange(200)]
+
+m = measurePeaks(img, peaks, shape="sphere", radius=3, n_threads=3)
+
+access = HyperSphereShape(3).neighborhoodsRandomAccessible(Views.extendValue(img, img.firstElement().createVariable())).randomAccess()
+n_mismatches = 0
+for k, peak in enumerate(peaks):
+  access.setPosition(peak)
+  # Count only the pixels within the image
+  pos = [0, 0, 0]
+  c = access.get().localizingCursor()
+  s, count, mx = 0, 0, 0
+  while c.hasNext():
+    v = c.next().getInteger()
+    c.localize(pos)
+    if all(0 <= p < d for p, d in zip(pos, dimensions)):
+      s += v
+      count += 1
+      mx = max(mx, v)
+  if s != m["sum"][k] or count != m["count"][k] or mx != m["max"][k]:
+    n_mismatches += 1
+print "Sphere:", "OK" if 0 == n_mismatches else "FAILED: %i mismatches" % n_mismatches
+
+# Box, on a view, which is copied into floats first
+box = measurePeaks(Views.interval(img, [0, 0, 0], [d - 1 for d in dimensions]), [Point([10, 10, 10])],
+                   shape="box", radius=[2, 1, 1])
+expected = sum(t.getInteger() for t in Views.interval(img, [8, 9, 9], [12, 11, 11]))
+print "Box:", "OK" if 45 == box["count"][0] and expected == box["sum"][0] else "FAILED"
+
+# Ellipsoid with anisotropic calibration: 2 pixels in X and Y, 1 in Z
+e = measurePeaks(img, [Point([20, 20, 20])], shape="ellipsoid", radius=1.0, calibration=[0.5, 0.5, 1.0])
+# 13 pixels within a circle of radius 2 at the center, plus one above and one below
+print "Ellipsoid:", "OK" if 15 == e["count"][0] else "FAILED: %i" % e["count"][0]
+
+# Over time
+series = measurePeaksOverTime(lambda t: img, 3, peaks, columns=("mean", "max"), radius=3)
+print "Over time:", "OK" if 3 == len(series["mean"]) and list(series["max"][2]) == list(m["max"]) else "FAILED"
@@ -0,0 +1,44 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.projection import project
+from net.imglib2.img.array import ArrayImgs
+from math import sqrt
+
+# Each volume has all its voxels set to the index of the time point
+dimensions = [8, 4, 3]
+n_timepoints = 11
+
+class FilledLoader():
+  def get(self, t):
+    img = ArrayImgs.unsignedShorts(dimensions)
+    for v in img:
+      v.setReal(t)
+    return img
+
+expected = {"max": n_timepoints - 1,
+            "min": 0,
+            "mean": (n_timepoints - 1) / 2.0,
+            "sum": sum(xrange(n_timepoints)),
+            "std": sqrt(sum(pow(t - (n_timepoints - 1) / 2.0, 2) for t in xrange(n_timepoints)) / (n_timepoints - 1))}
+
+# With more reducer threads than volumes, some partial projections are empty
+for n_threads in [1, 3, 16]:
+  projections = project(range(n_timepoints), FilledLoader(), ops=expected.keys(), n_threads=n_threads)
+  for op, value in expected.iteritems():
+    errors = [abs(v.getRealFloat() - value) for v in projections[op]]
+    print n_threads, op, "OK" if max(errors) < 0.001 else "FAILED: expected %f" % value
+
+# A reducer that fails must not leave the readers blocked on the full queue
+import lib.projection
+add = lib.projection.Accumulator.add
+def failingAdd(self, values):
+  raise Exception("Simulated failure to reduce")
+lib.projection.Accumulator.add = failingAdd
+try:
+  project(range(n_timepoints), FilledLoader(), ops=["max"], n_threads=1, read_ahead=1)
+  print "Reducer failure: FAILED, no error"
+except Exception:
+  print "Reducer failure: OK"
+finally:
+  lib.projection.Accumulator.add = add
@@ -0,0 +1,35 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.roi import roiRuns, roiPoints
+from ij.gui import OvalRoi, Roi, PointRoi
+from ij.process import ShortProcessor
+from net.imglib2.img.array import ArrayImgs
+
+# A 16-bit image with values above 32767, which are negative as java shorts
+ip = ShortProcessor(64, 48)
+for y in xrange(48):
+  for x in xrange(64):
+    ip.set(x, y, 40000 + x + y)
+
+for roi in [Roi(10, 5, 20, 8), OvalRoi(-5, 20, 30, 40), PointRoi([3, 7, 60], [2, 9, 47], 3)]:
+  runs = roiRuns(roi, ip.getWidth(), ip.getHeight())
+  points = [p for p in roiPoints(roi) if 0 <= p.x < 64 and 0 <= p.y < 48]
+  expected_sum = sum(ip.get(p.x, p.y) for p in points)
+  expected_max = max(ip.get(p.x, p.y) for p in points)
+  print type(roi).__name__, "runs:", len(runs.runs), "pixels:", len(runs)
+  print "  count:", len(runs) == len(points)
+  print "  sum:", runs.sum(ip) == expected_sum
+  print "  max:", runs.max(ip) == expected_max
+  print "  mean:", abs(runs.mean(ip) - expected_sum / float(len(points))) < 0.0001
+
+# Same, on an imglib2 ArrayImg, wrapped without copying
+img = ArrayImgs.unsignedShorts(ip.getPixels(), [64, 48])
+runs = roiRuns(Roi(10, 5, 20, 8))
+print "ArrayImg sum:", runs.sum(img) == runs.sum(ip)
+
+# Same, on 8-bit and 32-bit images, reduced with the compiled kernels of each pixel type
+for other in [ip.convertToByteProcessor(False), ip.convertToFloatProcessor()]:
+  runs = roiRuns(OvalRoi(-5, 20, 30, 40), 64, 48)
+  points = [(x, y) for x, y in runs.iterPoints()]
+  print type(other).__name__, "sum:", runs.sum(other) == sum(other.getf(x, y) for x, y in points), \
+        "max:", runs.max(other) == max(other.getf(x, y) for x, y in points)
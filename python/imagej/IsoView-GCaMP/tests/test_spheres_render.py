@@ -0,0 +1,39 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.spheres import renderSpheres, lazySpheres4D
+from net.imglib2 import RealPoint, KDTree
+from net.imglib2.neighborsearch import NearestNeighborSearchOnKDTree
+from net.imglib2.view import Views
+from java.util import Random
+
+# Compare with a nearest neighbor search on a KDTree, at every voxel
+dimensions = [64, 48, 32]
+radius = 5.0
+rng = Random(42)
+peaks = [RealPoint([rng.nextFloat() * (d - 1) for d in dimensions]) for _ in xrange(60)]
+labels = range(1, len(peaks) + 1)
+
+img = renderSpheres(peaks, dimensions, radius, n_threads=3)
+
+search = NearestNeighborSearchOnKDTree(KDTree(labels, peaks))
+c = img.cursor()
+pos = RealPoint(3)
+n_mismatches = 0
+while c.hasNext():
+  v = c.next().get()
+  pos.setPosition(c)
+  search.search(pos)
+  expected = search.getSampler().get() if search.getSquareDistance() < radius * radius else 0
+  if v != expected:
+    n_mismatches += 1
+# Ties in distance, at most, could differ
+print "Labels:", "OK" if n_mismatches < 5 else "FAILED: %i mismatches" % n_mismatches
+
+# 2D, constant value
+img2D = renderSpheres([RealPoint([10.0, 10.0])], [32, 32], 3, value=65535)
+print "2D:", "OK" if 65535 == img2D.randomAccess().setPositionAndGet([10, 12]).get() else "FAILED"
+
+# Lazy 4D, one cell per time point
+spheres4d = lazySpheres4D(lambda t: peaks[t * 10: (t + 1) * 10], 6, dimensions, radius)
+print "4D:", "OK" if sum(1 for t in Views.iterable(spheres4d) if t.get() > 0) > 0 else "FAILED"
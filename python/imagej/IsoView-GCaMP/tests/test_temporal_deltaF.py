@@ -0,0 +1,38 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.temporal import deltaFOverF
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+
+# A 4D series where every voxel of time point t has the value series[t]
+dimensions = [6, 5, 4]
+series = [10, 12, 11, 30, 10, 9, 13, 10, 25, 11, 10, 12]
+volumes = []
+for value in series:
+  img = ArrayImgs.floats(dimensions)
+  for v in img:
+    v.setReal(value)
+  volumes.append(img)
+img4D = Views.stack(volumes)
+
+def expectedBaseline(t, window, baseline, percentile):
+  # The window centered on t, shifted to fit within the series
+  W = min(window, len(series))
+  start = min(max(0, t - W / 2), len(series) - W)
+  values = sorted(series[start: start + W])
+  if "mean" == baseline:
+    return sum(values) / float(W)
+  return values[min(W - 1, int(round(percentile / 100.0 * (W - 1))))]
+
+for baseline in ["mean", "percentile"]:
+  for window in [1, 5, 20]:
+    count = 0
+    for t, img in deltaFOverF(img4D, window=window, baseline=baseline, percentile=20, n_blocks=7):
+      f0 = expectedBaseline(t, window, baseline, 20)
+      expected = (series[t] - f0) / f0
+      errors = [abs(v.getRealFloat() - expected) for v in img]
+      if t != count or max(errors) > 0.0001:
+        print "FAILED:", baseline, window, t, expected
+      count += 1
+    print baseline, window, "OK" if count == len(series) else "FAILED: emitted %i of %i" % (count, len(series))
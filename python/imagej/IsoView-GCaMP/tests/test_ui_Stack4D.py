@@ -0,0 +1,44 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from lib.ui import Stack4D
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.img.planar import PlanarImgs
+from net.imglib2.img.cell import CellImgFactory
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.view import Views
+from net.imglib2.util import ImgUtil
+from java.lang import System
+
+dimensions = [128, 96, 10, 5]
+source = ArrayImgs.unsignedShorts(dimensions)
+for i, v in enumerate(source):
+  v.set(i % 65536)
+
+def copyOf(img):
+  ImgUtil.copy(source, img)
+  return img
+
+cell_factory = CellImgFactory(UnsignedShortType(), [128, 96, 10, 1]) # one cell per time point
+images = [("array", source),
+          ("planar", copyOf(PlanarImgs.unsignedShorts(dimensions))),
+          ("cells", copyOf(cell_factory.create(dimensions))),
+          ("view", Views.zeroMin(Views.interval(source, [0, 0, 0, 0], [127, 95, 9, 4])))]
+
+plane_size = dimensions[0] * dimensions[1]
+for name, img in images:
+  stack = Stack4D(img)
+  t0 = System.nanoTime()
+  ok = stack.getSize() == dimensions[2] * dimensions[3]
+  for n in xrange(1, stack.getSize() + 1):
+    pixels = stack.getPixels(n)
+    first = (n - 1) * plane_size
+    ok = ok and all((pixels[i] & 0xffff) == (first + i) % 65536 for i in (0, 1, plane_size / 2, plane_size - 1))
+  print name, "OK" if ok else "FAILED", "in %.1f ms" % ((System.nanoTime() - t0) / 1000000.0)
+
+# Planes held by the caller, e.g. the processors of a duplicated or z-projected stack, remain valid
+for name, img in images:
+  stack = Stack4D(img)
+  processors = [stack.getProcessor(n) for n in xrange(1, 6)] # more planes than a ring of 4 buffers
+  ok = all((ip.getPixels()[0] & 0xffff) == (n * plane_size) % 65536 for n, ip in enumerate(processors))
+  print name, "holding 5 planes:", "OK" if ok else "FAILED"
@@ -0,0 +1,30 @@
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+
+from java.lang import Runtime
+from lib.util import newWorkStealingPool, memoryBoundThreadCount, Task
+
+# With a single thread, a task that submits another task to the same pool
+# and waits for it would deadlock in a fixed thread pool.
+exe = newWorkStealingPool(1)
+
+def inner(number):
+  return number + 10
+
+def outer(number):
+  return exe.submit(Task(inner, number)).get() * 2
+
+print "parallelism:", exe.getParallelism()
+
+try:
+  futures = [exe.submit(Task(outer, i)) for i in xrange(10)]
+
+  for f in futures:
+    print f.get()
+finally:
+  exe.shutdown()
+
+# Memory-aware sizing: tasks of a quarter of the max heap each
+bytes_per_task = Runtime.getRuntime().maxMemory() / 4
+print "available CPUs:", Runtime.getRuntime().availableProcessors()
+print "n_threads for %i MB per task:" % (bytes_per_task / (1024 * 1024)), memoryBoundThreadCount(0, bytes_per_task)
@@ -1,6 +1,24 @@
 package plugins;
 
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
 import java.io.FileInputStream;
+import java.io.InputStream;
+import java.io.RandomAccessFile;
+import java.nio.ByteBuffer;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+import java.nio.file.Files;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Comparator;
+import java.util.List;
+import java.util.concurrent.Callable;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.Future;
+import java.util.concurrent.ThreadFactory;
 import org.apache.commons.compress.compressors.bzip2.BZip2CompressorInputStream;
 import ij.ImagePlus;
 import ij.process.ShortProcessor;
@@ -61,6 +79,198 @@ public class MRCBZIP2 {
  	return null;
  }
 
+	/** Decompress the bzip2-compressed MRC file at path, in parallel when it consists of
+	 *  several concatenated bzip2 streams (as written by parallel compressors like pbzip2),
+	 *  and cache the decoded 16-bit plane as a raw file in cacheDir, from which later loads
+	 *  of the same file are memory-mapped rather than decompressed again.
+	 *  The least recently used cached planes are deleted once the cache exceeds maxBytes.
+	 *  Failing to read from or write to the cache doesn't fail the decompression. */
+	public static ImagePlus decompress16bitCached(final String path, final String cacheDir, final long maxBytes) {
+		final File source = new File(path);
+		final File cached = new File(cacheDir, source.getName() + "-" + Integer.toHexString(path.hashCode())
+				+ "-" + source.length() + "-" + source.lastModified() + ".raw");
+		try {
+			if (cached.exists()) {
+				final ImagePlus imp = readCached(cached);
+				if (null != imp) {
+					cached.setLastModified(System.currentTimeMillis()); // most recently used
+					return new ImagePlus(path, imp.getProcessor());
+				}
+			}
+		} catch (Exception e) {
+			System.out.println("Failed to read cached plane: " + cached);
+			e.printStackTrace();
+		}
+		ImagePlus imp = null;
+		try {
+			imp = decode16bit(path, decompress(Files.readAllBytes(source.toPath())));
+		} catch (Exception e) {
+			System.out.println("Failed to decompress: " + path);
+			e.printStackTrace();
+			return null;
+		}
+		if (null != imp) {
+			try {
+				writeCached(cached, (ShortProcessor) imp.getProcessor());
+				evict(new File(cacheDir), maxBytes);
+			} catch (Exception e) {
+				// e.g. a full or unwritable cache directory: the decoded plane is returned regardless
+				System.out.println("Failed to cache the decompressed plane of " + path + " at " + cached + ": " + e);
+			}
+		}
+		return imp;
+	}
+
+	static private ExecutorService exe = null;
+
+	static private synchronized final ExecutorService executor() {
+		if (null == exe) {
+			exe = Executors.newFixedThreadPool(Runtime.getRuntime().availableProcessors(), new ThreadFactory() {
+				public Thread newThread(final Runnable r) {
+					final Thread t = new Thread(r, "MRCBZIP2-decompressor");
+					t.setDaemon(true);
+					return t;
+				}
+			});
+		}
+		return exe;
+	}
+
+	/** Return the offsets of the bzip2 streams concatenated in data: each starts with "BZh",
+	 *  the block size from '1' to '9', and the magic number of its first block. */
+	static public final int[] findStreams(final byte[] data) {
+		final ArrayList<Integer> offsets = new ArrayList<Integer>();
+		for (int i=0; i<data.length - 10; ++i) {
+			if ('B' == data[i] && 'Z' == data[i+1] && 'h' == data[i+2] && data[i+3] >= '1' && data[i+3] <= '9'
+			 && 0x31 == data[i+4] && 0x41 == data[i+5] && 0x59 == data[i+6]
+			 && 0x26 == data[i+7] && 0x53 == data[i+8] && 0x59 == data[i+9]) {
+				offsets.add(i);
+			}
+		}
+		final int[] a = new int[offsets.size()];
+		for (int i=0; i<a.length; ++i) a[i] = offsets.get(i);
+		return a;
+	}
+
+	static private final byte[] readAll(final InputStream in) throws Exception {
+		final ByteArrayOutputStream out = new ByteArrayOutputStream();
+		final byte[] buf = new byte[65536];
+		for (int n = in.read(buf); -1 != n; n = in.read(buf)) out.write(buf, 0, n);
+		in.close();
+		return out.toByteArray();
+	}
+
+	/** Decompress concatenated bzip2 streams in parallel, one per thread,
+	 *  or sequentially when there's a single stream. */
+	static public final byte[] decompress(final byte[] data) throws Exception {
+		final int[] offsets = findStreams(data);
+		if (offsets.length > 1) {
+			try {
+				final List<Future<byte[]>> futures = new ArrayList<Future<byte[]>>();
+				for (int i=0; i<offsets.length; ++i) {
+					final int start = offsets[i],
+					          end = i + 1 < offsets.length ? offsets[i+1] : data.length;
+					futures.add(executor().submit(new Callable<byte[]>() {
+						public byte[] call() throws Exception {
+							return readAll(new BZip2CompressorInputStream(new ByteArrayInputStream(data, start, end - start), false));
+						}
+					}));
+				}
+				final ByteArrayOutputStream out = new ByteArrayOutputStream();
+				for (final Future<byte[]> f : futures) out.write(f.get());
+				return out.toByteArray();
+			} catch (Exception e) {
+				// A match of the stream header within compressed data: decompress sequentially
+			}
+		}
+		return readAll(new BZip2CompressorInputStream(new ByteArrayInputStream(data), true));
+	}
+
+	/** Decode the first image of an uncompressed MRC file as 16-bit. */
+	static public final ImagePlus decode16bit(final String path, final byte[] data) {
+		final boolean bigEndian = (readInt(data, 0xd0, false) == 0x2050414d) && data[0xd4] == 17;
+		final int width = readInt(data, 0, bigEndian);
+		final int height = readInt(data, 4, bigEndian);
+		if (readInt(data, 8, bigEndian) > 1) {
+			System.out.println("WARNING: ignoring images beyond the first at " + path);
+		}
+		final int start = 1024 + readInt(data, 0x5c, bigEndian);
+		final short[] shorts = new short[width * height];
+		if (bigEndian) {
+			for (int i=0, j=start; i<shorts.length; ++i, j+=2) {
+				shorts[i] = (short)(((data[j] & 0xff) << 8) | (data[j+1] & 0xff));
+			}
+		} else {
+			for (int i=0, j=start; i<shorts.length; ++i, j+=2) {
+				shorts[i] = (short)((data[j] & 0xff) | ((data[j+1] & 0xff) << 8));
+			}
+		}
+		return new ImagePlus(path, new ShortProcessor(width, height, shorts, null));
+	}
+
+	/** Cached planes are stored as the width and height, as ints, followed by the pixels. */
+	static private final ImagePlus readCached(final File file) {
+		RandomAccessFile ra = null;
+		try {
+			ra = new RandomAccessFile(file, "r");
+			final FileChannel channel = ra.getChannel();
+			final MappedByteBuffer mb = channel.map(FileChannel.MapMode.READ_ONLY, 0, channel.size());
+			final int width = mb.getInt(0),
+			          height = mb.getInt(4);
+			if (channel.size() != 8 + 2L * width * height) return null; // incomplete
+			final short[] shorts = new short[width * height];
+			mb.position(8);
+			mb.asShortBuffer().get(shorts);
+			return new ImagePlus(file.getName(), new ShortProcessor(width, height, shorts, null));
+		} catch (Exception e) {
+			e.printStackTrace();
+			return null;
+		} finally {
+			if (null != ra) try { ra.close(); } catch (Exception e) {}
+		}
+	}
+
+	static private final void writeCached(final File file, final ShortProcessor sp) throws Exception {
+		file.getParentFile().mkdirs();
+		final ByteBuffer bb = ByteBuffer.allocate(8 + 2 * sp.getWidth() * sp.getHeight());
+		bb.putInt(sp.getWidth()).putInt(sp.getHeight());
+		bb.asShortBuffer().put((short[]) sp.getPixels());
+		// Write to a temporary file first, so that concurrent loads never read a partial file
+		final File tmp = new File(file.getParentFile(), file.getName() + "." + Thread.currentThread().getId() + ".tmp");
+		try {
+			final RandomAccessFile ra = new RandomAccessFile(tmp, "rw");
+			try {
+				ra.write(bb.array());
+			} finally {
+				ra.close();
+			}
+			if (!tmp.renameTo(file)) tmp.delete();
+		} catch (Exception e) {
+			tmp.delete(); // partially written, e.g. on a full disk
+			throw e;
+		}
+	}
+
+	/** Delete the least recently used cached planes until the cache is within maxBytes. */
+	static private synchronized final void evict(final File dir, final long maxBytes) {
+		final File[] files = dir.listFiles();
+		if (null == files) return;
+		long sum = 0;
+		for (final File f : files) sum += f.length();
+		if (sum <= maxBytes) return;
+		Arrays.sort(files, new Comparator<File>() {
+			public int compare(final File f1, final File f2) {
+				return Long.compare(f1.lastModified(), f2.lastModified());
+			}
+		});
+		for (final File f : files) {
+			if (sum <= maxBytes) break;
+			if (!f.getName().endsWith(".raw")) continue;
+			final long length = f.length();
+			if (f.delete()) sum -= length;
+		}
+	}
+
 	static private final int readInt(final byte[] buf, final int start, final boolean bigEndian) {
 		int b0 = buf[start] & 0xff;
 		int b1 = buf[start + 1] & 0xff;
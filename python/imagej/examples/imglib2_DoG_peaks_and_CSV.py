@@ -45,59 +45,32 @@ for peak in peaks:
 
 imp.setRoi(roi)
 
-# Now, iterate each peak, defining a small interval centered at each peak,
-# and measure the sum of total pixel intensity,
+# Now, measure the sum of total pixel intensity in a small box centered at each peak,
+# for all peaks at once with compiled code, in parallel over chunks of peaks,
 # and display the results in an ImageJ ResultTable.
+# (sigmaSmaller is half the radius of the embryo)
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.measure import measurePeaks, writeMeasurementsCSV
+
+measurements = measurePeaks(img, peaks, shape="box", radius=sigmaSmaller, calibration=calibration)
+
 table = ResultsTable()
 
-for peak in peaks:
-  # Read peak coordinates into an array of integers
-  peak.localize(p)
-  # Define limits of the interval around the peak:
-  # (sigmaSmaller is half the radius of the embryo)
-  minC = [p[i] - sigmaSmaller for i in range(img.numDimensions())]
-  maxC = [p[i] + sigmaSmaller for i in range(img.numDimensions())]
-  # View the interval around the peak, as a flat iterable (like an array)
-  fov = Views.flatIterable(Views.interval(img, minC, maxC))
-  # Compute sum of pixel intensity values of the interval
-  # (The t is the Type that mediates access to the pixels, via its get* methods)
-  s = sum(t.getInteger() for t in fov)
+for x, y, s in zip(measurements["x"], measurements["y"], measurements["sum"]):
   # Add to results table
   table.incrementCounter()
-  table.addValue("x", p[0])
-  table.addValue("y", p[1])
+  table.addValue("x", x)
+  table.addValue("y", y)
   table.addValue("sum", s)
 
 table.show("Embryo intensities at peaks")
 
 
-from operator import add
 import csv
 
-# The minumum and maximum coordinates, for each image dimension, 
-# defining an interval within which pixel values will be summed.
-minC = [-sigmaSmaller for i in xrange(img.numDimensions())]
-maxC = [ sigmaSmaller for i in xrange(img.numDimensions())]
-
-def centerAt(p, minC, maxC):
-  """ Translate the minC, maxC coordinate bounds to the peak. """
-  return map(add, p, minC), map(add, p, maxC)
-
-def peakData():
-  """ A generator function that returns all peaks and their pixel sum, one by one. """
-  for peak in peaks:
-    peak.localize(p)
-    minCoords, maxCoords = centerAt(p, minC, maxC)
-    fov = Views.interval(img, minCoords, maxCoords)
-    s = sum(t.getInteger() for t in fov)
-    yield p, s
-
-# Save as CSV file
-with open('/tmp/peaks.csv', 'wb') as csvfile:
-  w = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-  w.writerow(['x', 'y', 'sum'])
-  for p, s in peakData():
-    w.writerow([p[0], p[1], s])
+# Save as CSV file, one row per peak
+writeMeasurementsCSV(measurements, '/tmp/peaks.csv', columns=['x', 'y', 'sum'])
 
 # Read the CSV file into an ROI
 roi = PointRoi(0, 0)
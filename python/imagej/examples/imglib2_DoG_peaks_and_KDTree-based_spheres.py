@@ -123,3 +123,15 @@ class Circles(RealRandomAccessible):
 # 'img' here is used as the Interval within which the RRA is defined
 circles = Views.interval(Views.raster(Circles()), img)
 IL.wrap(circles, "Circles").show()
+
+
+# Faster: paint each circle only over the pixels of its bounding box, in compiled code
+# and in parallel, rather than searching the KDTree for the nearest embryo at every pixel.
+# Pixels take the value of the nearest center, as above. With value=None instead,
+# each circle is painted with its own label (index in centers plus one), e.g. for measurements.
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.spheres import renderSpheres
+
+circlesR = renderSpheres(centers, [img.dimension(0), img.dimension(1)], radius, value=255)
+IL.wrap(circlesR, "Circles, rendered").show()
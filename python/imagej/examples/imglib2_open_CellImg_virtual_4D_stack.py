@@ -2,18 +2,20 @@
 
 from net.imglib2.img.cell import LazyCellImg, CellGrid, Cell
 from net.imglib2.img.display.imagej import ImageJFunctions as IL
-from net.imglib2.util import Intervals, IntervalIndexer
+from net.imglib2.util import Intervals
 from ij import IJ
 from net.imagej import ImgPlus
 
 # Cache
-import os
-from collections import OrderedDict
+import os, sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.cache import TimePointCache
+from lib.io import asShortArray
+from lib.ui import Stack4D
 
 # VirtualStack
 from net.imglib2.view import Views
 from net.imglib2.img.array import ArrayImgs
-from net.imglib2.img.basictypeaccess import ShortAccess
 from ij import VirtualStack, ImagePlus, CompositeImage
 from jarray import zeros, array
 
@@ -23,9 +25,6 @@ from ij.process import ShortProcessor
 
 #from net.imglib2.algorithm.math import ImgSource
 #from net.imglib2.algorithm.math.ImgMath import compute, into
-from fiji.scripting import Weaver
-from net.imglib2 import Cursor
-from net.imglib2.type.numeric.integer import UnsignedShortType
 
 from bdv.util import BdvFunctions
 
@@ -44,57 +43,27 @@ except:
   print "Could not import KLB file format reader."
   klb = None
 
-class Memoize:
-  def __init__(self, fn, maxsize=100):
-    self.fn = fn
-    self.m = OrderedDict()
-    self.maxsize = maxsize
-  def __call__(self, key):
-    o = self.m.get(key, None)
-    if o:
-      # Remove
-      self.m.pop(key)
-    else:
-      # Invoke the memoized function
-      o = self.fn(key)
-    # Store
-    self.m[key] = o
-    # Trim cache
-    if len(self.m) > self.maxsize:
-      # Remove first entry (the oldest)
-      self.m.popitem(last=False)
-    return o
-
 def openStack(filepath):
   if filepath.endswith(".klb"):
     return klb.readFull(filepath)
   else:
     return IJ.openImage(filepath)
 
-getStack = Memoize(openStack)
-
-class ProxyShortAccess(ShortAccess):
-  def __init__(self, rai, dimensions):
-    self.rai = rai
-    self.dimensions = dimensions
-    self.ra = rai.randomAccess()
-    self.position = zeros(rai.numDimensions(), 'l')
-    
-  def getValue(self, index):
-    IntervalIndexer.indexToPosition(index, self.dimensions, self.position)
-    self.ra.setPosition(self.position)
-    return self.ra.get().get() # a short int value if rai's type is UnsignedShortType
-    
-  def setValue(self, index, value):
-    pass
+def openAsShorts(filepath):
+  # Array-backed images are used as is, and any other, e.g. SCIFIO-wrapped, or a TIFF stack
+  # wrapped as a planar image, is copied into a short[] at native speed, in parallel over planes
+  img = openStack(filepath)
+  if isinstance(img, ImagePlus):
+    img = IL.wrap(img)
+  return ArrayImgs.unsignedShorts(asShortArray(img), Intervals.dimensionsAsLongArray(img))
+
+# Cache volumes, as ArrayImg of shorts, up to a fraction of the heap, loading and copying each
+# only once even when requested concurrently, and prefetching the next and previous time points for playback
+getStack = TimePointCache(openAsShorts, keys=timepoint_paths, prefetch=2)
 
 def extractDataAccess(img, dimensions):
-  if isinstance(img, ImgPlus):
-    return extractDataAccess(img.getImg(), dimensions)
-  try:
-    return img.update(None)
-  except:
-    return ProxyShortAccess(img, dimensions)
+  # The ShortArray of the cached ArrayImg, without copying
+  return img.update(None)
 
 def extractCalibration(img):
   # an ImgPlus has an axis(int dimension) method that returns a DefaultLinearAxis
@@ -141,38 +110,7 @@ print dimensions
 # Visualization option 2:
 # Create a 4D VirtualStack manually
 
-# Need a fast way to copy pixel-wise
-w = Weaver.method("""
-  static public final void copy(final Cursor src, final Cursor tgt) {
-    while (src.hasNext()) {
-      src.fwd();
-      tgt.fwd();
-      final UnsignedShortType t1 = (UnsignedShortType) src.get(),
-                              t2 = (UnsignedShortType) tgt.get();
-      t2.set(t1.get());
-    }
-  }
-""", [Cursor, UnsignedShortType])
-
-class Stack4D(VirtualStack):
-  def __init__(self, img4d):
-    super(VirtualStack, self).__init__(img4d.dimension(0), img4d.dimension(1), img4d.dimension(2) * img4d.dimension(3))
-    self.img4d = img4d
-    self.dimensions = array([img4d.dimension(0), img4d.dimension(1)], 'l')
-    
-  def getPixels(self, n):
-    # 'n' is 1-based
-    aimg = ArrayImgs.unsignedShorts(self.dimensions[0:2])
-    #computeInto(ImgSource(Views.hyperSlice(self.img4d, 2, n-1)), aimg)
-    nZ = self.img4d.dimension(2)
-    fixedT = Views.hyperSlice(self.img4d, 3, int((n-1) / nZ)) # Z blocks
-    fixedZ = Views.hyperSlice(fixedT, 2, (n-1) % nZ)
-    w.copy(fixedZ.cursor(), aimg.cursor())
-    return aimg.update(None).getCurrentStorageArray()
-    
-  def getProcessor(self, n):
-    return ShortProcessor(self.dimensions[0], self.dimensions[1], self.getPixels(n), None)
-
+# Planes are copied directly from the short[] of each time point's cell (see lib/ui.py)
 
 imp = ImagePlus("vol4d", Stack4D(vol4d))
 nChannels = 1
@@ -1,40 +1,15 @@
-from ij import IJ, ImagePlus, ImageStack
-from java.util.concurrent import Executors, Callable
-from java.lang import Thread
+from ij import IJ
 import sys
 sys.path.append("//home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
-from lib.util import Task, syncPrint
+from lib.hyperslice import HyperSlicer
 
 imp4D = IJ.getImage()
-stack = imp4D.getStack()
 
-# The selected stack slice
-slice_index = imp4D.getSlice()
-# The selected channel
-channel_index = imp4D.getChannel()
-
-stack2 = ImageStack(imp4D.width, imp4D.height)
-depth = imp4D.getNSlices()
-n_frames = imp4D.getNFrames()
-
-
-def getProcessor(frame_index):
-  syncPrint("getting %i" % frame_index)
-  stack_index = imp4D.getStackIndex(channel_index, slice_index, frame_index)
-  return stack.getProcessor(stack_index).convertToShort(False)
-
-exe = Executors.newFixedThreadPool(32)
-
-try:
-  futures = [exe.submit(Task(getProcessor, frame_index))
-             for frame_index in xrange(n_frames)]
-  imp2 = None
-  for f in futures:
-    stack2.addSlice(f.get())
-    if imp2 is None and stack2.size() > 1:
-      imp2 = ImagePlus("hyperslice at %i" % slice_index, stack2)
-      imp2.show()
-
-finally:
-  exe.shutdownNow()
+# "XY" for the plane at the selected stack slice,
+# or "XZ", "YZ" for the orthogonal plane at the center of the image (or at the given position)
+axis = "XY"
+position = None
 
+# Reuses the rows already read when extracting again from the same slicer
+slicer = HyperSlicer(imp4D)
+imp2 = slicer.extract(axis=axis, position=position, channel=imp4D.getChannel())
@@ -1,41 +1,98 @@
-from ini.trakem2.display import Display
+from ini.trakem2.display import Display, Patch
 from ini.trakem2.persistence import DownsamplerMipMaps
 from java.lang import System
+from java.lang.management import ManagementFactory, MemoryType
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.pyramid import integralPyramid
+from lib.util import newFixedThreadPool
+
+threads = ManagementFactory.getThreadMXBean()
+heap_pools = [pool for pool in ManagementFactory.getMemoryPoolMXBeans() if MemoryType.HEAP == pool.getType()]
+
+def allocatedBytes():
+  """ Bytes allocated so far by each live thread, including those of thread pools, if the JVM can tell. """
+  try:
+    ids = threads.getAllThreadIds()
+    return dict(zip(ids, threads.getThreadAllocatedBytes(ids)))
+  except:
+    return {}
+
+def heapUsed():
+  return sum(pool.getUsage().getUsed() for pool in heap_pools)
+
+def peakHeapUsed():
+  return sum(pool.getPeakUsage().getUsed() for pool in heap_pools)
 
 def timeIt(fn, n_iterations=10):
+  """ Measure the elapsed time, the bytes allocated by all threads, and the peak heap usage
+      above that at the start, of each call to fn. """
   elapsed_times = []
+  allocated = []
+  peaks = []
   for i in range(n_iterations):
+    System.gc()
+    for pool in heap_pools:
+      pool.resetPeakUsage()
+    h0 = heapUsed()
+    a0 = allocatedBytes()
     t0 = System.nanoTime()
     fn()
     t1 = System.nanoTime()
+    a1 = allocatedBytes()
+    # Threads that started during fn started from zero
+    allocated.append(sum(b - a0.get(tid, 0) for tid, b in a1.iteritems() if b >= 0))
+    peaks.append(peakHeapUsed() - h0)
     elapsed_times.append(t1 - t0)
 
-  smallest = min(elapsed_times)
-  largest =  max(elapsed_times)
-  average =  sum(elapsed_times) / float(n_iterations)
-  print "Elapsed time: min", smallest, "max", largest, "average", average
-  return elapsed_time
+  smallest = min(elapsed_times) / 1000000.0
+  largest =  max(elapsed_times) / 1000000.0
+  average =  sum(elapsed_times) / float(n_iterations) / 1000000.0
+  print "Elapsed time (ms): min", smallest, "max", largest, "average", average
+  print "Allocated by all threads (MB):", max(allocated) / 1048576.0
+  print "Peak heap above the starting usage (MB):", max(peaks) / 1048576.0
+  return average
 
 layer = Display.getFront().getLayer()
-patch = layer.getDisplayables().get(0)
+patch = layer.getDisplayables(Patch).get(0)
 print patch
 pai = patch.createTransformedImage()
 print pai
 print patch.hasCoordinateTransform()
 print patch.getImageProcessor()
 first_level_mipmaps_saved = 0
+n_pixels = pai.target.getWidth() * pai.target.getHeight()
 
 def testCascade():
-  global patch, pai, first_level_mipmaps_saved
-  print pai
-  b = DownsamplerMipMaps.create(
+  return DownsamplerMipMaps.create(
         patch,
         patch.getType(),
-		pai.target,
-		pai.mask,
-		pai.outside,
-		first_level_mipmaps_saved)
-  return b
+        pai.target,
+        pai.mask,
+        pai.outside,
+        first_level_mipmaps_saved)
+
+def testIntegral():
+  return integralPyramid(pai.target, mask=pai.mask, outside=pai.outside)
+
+exe = newFixedThreadPool(name="integral-pyramid")
+
+def testIntegralParallel():
+  return integralPyramid(pai.target, mask=pai.mask, outside=pai.outside, exe=exe)
 
+try:
+  for name, fn in (("DownsamplerMipMaps", testCascade),
+                   ("Integral images", testIntegral),
+                   ("Integral images, parallel", testIntegralParallel)):
+    print name
+    ms = timeIt(fn)
+    print "Throughput: %.1f megapixels/s" % (n_pixels / (ms * 1000.0))
 
-#timeIt(testCascade)
\ No newline at end of file
+  # Compare the levels: both are box means, except for rounding at each level of the cascade
+  cascade = testCascade()
+  levels = testIntegral()
+  for i, (bytes, (w, h, channels, alpha)) in enumerate(zip(cascade, levels)):
+    diffs = [abs((a & 0xff) - (b & 0xff)) for a, b in zip(bytes.c[0], channels[0])]
+    print "Level", i, w, "x", h, "max difference:", max(diffs) if diffs else 0
+finally:
+  exe.shutdown()
@@ -2,11 +2,26 @@
 # when the XMLfile of TrakEM2 specifies uncompressed MRCfiles.
 #
 # Variables imp and patch exist
+#
+# Decoded images can be cached on disk as raw 16-bit planes, up to CACHE_MAX_BYTES,
+# so that patches reloaded after being evicted from TrakEM2's cache are memory-mapped
+# rather than decompressed again. Files made of concatenated bzip2 streams, as written
+# by parallel compressors like pbzip2, are decompressed in parallel.
 
 import MRCBZIP2
 from ij import ImagePlus
+import os
+
+# The cache is stored in the project's storage folder, on disk:
+# avoid /tmp, which may be a RAM-backed tmpfs. Set CACHE_DIR to None to disable caching.
+CACHE_DIR = os.path.join(patch.getProject().getLoader().getStorageFolder(), "mrc-bzip2-cache")
+CACHE_MAX_BYTES = 10 * pow(1024, 3) # 10 GB: adjust to the free space of the disk of CACHE_DIR
 
-imp2 = MRCBZIP2.decompress16bit(patch.getImageFilePath() + ".bz2")
+path = patch.getImageFilePath() + ".bz2"
+if CACHE_DIR:
+  imp2 = MRCBZIP2.decompress16bitCached(path, CACHE_DIR, CACHE_MAX_BYTES)
+else:
+  imp2 = MRCBZIP2.decompress16bit(path)
 
 print "imp2: ", imp2
 
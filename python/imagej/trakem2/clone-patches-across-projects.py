@@ -1,5 +1,9 @@
 from ini.trakem2 import Project
 from ini.trakem2.display import Display
+import os
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.transfer import FileTransfer
 
 projects = Project.getProjects()
 
@@ -16,5 +20,23 @@ for display in Display.getDisplays():
     layer2 = display.getLayer()
 
 
+def maskPath(loader, patch):
+  return loader.getMasksFolder() \
+         + loader.createIdPath(str(patch.getAlphaMaskId()), str(patch.getId()), ".zip")
+
+# Clones share the image files of the original patches, but their alpha masks are read
+# from the masks folder of the new project: gather the copies of the mask files,
+# and run them concurrently once all patches are cloned.
+loader1 = original.getLoader()
+loader2 = new_project.getLoader()
+transfer = FileTransfer(manifest_path=os.path.join(loader2.getStorageFolder(), "cloned-masks-manifest.csv"))
+
 for patch in patches:
-  layer2.add(patch.clone(new_project, True))
\ No newline at end of file
+  clone = patch.clone(new_project, True)
+  layer2.add(clone)
+  if patch.hasAlphaMask():
+    source = maskPath(loader1, patch)
+    if os.path.exists(source):
+      transfer.add("copy", source, maskPath(loader2, clone))
+
+transfer.run()
@@ -1,11 +1,19 @@
 # copy original images for patches in layer
+# Copies run concurrently, and are recorded in a manifest so that re-running copies only
+# the images that are missing or whose original changed.
 from ini.trakem2.display import Display, Patch
-from shutil import copy
 from os import path
+import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.transfer import FileTransfer
 
 storage = "/mnt/ssd-512/0111-8/debug/original-images/"
 
+transfer = FileTransfer(manifest_path=path.join(storage, "manifest.csv"))
+
 for patch in Display.getFrontLayer().getDisplayables(Patch):
   filepath = patch.getImageFilePath()
-  print filepath
-  copy(filepath, storage)
+  # Patches sharing the same image file are copied once
+  transfer.add("copy", filepath, path.join(storage, path.basename(filepath)))
+
+transfer.run()
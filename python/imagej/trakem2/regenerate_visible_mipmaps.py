@@ -1,9 +1,129 @@
+# Regenerate the mipmaps of all visible patches, in parallel, starting from the layers
+# nearest to the layer shown in the front Display and moving away from it.
+#
+# Patches whose mipmaps are newer than their source image are skipped, unless skip_up_to_date
+# is False, as needed after changing e.g. their min and max, alpha masks or transforms.
+# The id of each patch whose mipmaps were regenerated is appended to a checkpoint file,
+# so that the script can be interrupted and resumed, skipping patches already done.
+# The checkpoint file is deleted once all patches are done without errors.
+#
+# Mipmaps are generated with Patch.updateMipMaps, which also decaches the patch's images,
+# and which runs on TrakEM2's own mipmap regeneration pool: its number of threads,
+# set in the project properties ("n_mipmap_threads"), is what bounds the work.
+# Here, the number of patches in flight is that same number, further bounded by the free heap.
+
 from ini.trakem2 import Project
-from ini.trakem2.display import Patch
+from ini.trakem2.display import Patch, Display
+from ini.trakem2.persistence import FSLoader
+from java.io import File
+from synchronize import make_synchronized
+import os
+import sys
+import traceback
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.util import BoundedScheduler
+
+skip_up_to_date = True
 
 project = Project.getProjects()[0]
+loader = project.getLoader()
+checkpoint_path = os.path.join(loader.getStorageFolder(), "regenerate_visible_mipmaps.checkpoint")
+
+# Extensions of the mipmap files, depending on the project's mipmap format
+MIPMAP_EXTENSIONS = (".jpg", ".png", ".tif", ".rag", ".raw")
+
+
+def mipMapFile(patch):
+  """ The level-zero mipmap file of the patch, as laid out by the FSLoader
+      in <mipmaps folder>/0/<id path><file name>.<ext>, or None if it doesn't exist. """
+  mipmaps_folder = loader.getMipMapsFolder()
+  source = loader.getAbsolutePath(patch)
+  if not mipmaps_folder or not source:
+    return None
+  for ext in MIPMAP_EXTENSIONS:
+    f = File(mipmaps_folder + "0/" + FSLoader.createIdPath(str(patch.getId()), File(source).getName(), ext))
+    if f.exists():
+      return f
+  return None
+
+
+def isUpToDate(patch):
+  """ Whether the patch's mipmaps are newer than its source image. """
+  mipmap = mipMapFile(patch)
+  if mipmap is None:
+    return False
+  source = File(loader.getAbsolutePath(patch))
+  return source.exists() and mipmap.lastModified() >= source.lastModified()
+
+
+class Checkpoint:
+  """ The ids of the patches whose mipmaps were regenerated, stored one per line in a file. """
+  def __init__(self, path):
+    self.path = path
+    self.done = set()
+    self.n_failed = 0
+    if os.path.exists(path):
+      with open(path, 'r') as f:
+        self.done = set(long(line) for line in f if line.strip())
+  def __contains__(self, patch):
+    return patch.getId() in self.done
+  @make_synchronized
+  def add(self, patch):
+    self.done.add(patch.getId())
+    with open(self.path, 'a') as f:
+      f.write("%i\n" % patch.getId())
+  @make_synchronized
+  def fail(self, patch):
+    self.n_failed += 1
+  def delete(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+checkpoint = Checkpoint(checkpoint_path)
+
+
+def regenerate(patch):
+  try:
+    if skip_up_to_date and isUpToDate(patch):
+      checkpoint.add(patch)
+      return
+    # Wait for TrakEM2's mipmap regeneration pool, so that this patch counts as in flight
+    if patch.updateMipMaps().get():
+      checkpoint.add(patch)
+    else:
+      print "Failed to regenerate the mipmaps of", patch
+      checkpoint.fail(patch)
+  except:
+    traceback.print_exc(file=sys.stdout)
+    checkpoint.fail(patch)
+
+
+# Layers sorted by their distance to the layer of the front Display, if any
+layers = list(project.getRootLayerSet().getLayers())
+front = Display.getFront()
+center = layers.index(front.getLayer()) if front and front.getLayer() in layers else 0
+layers = [layers[i] for i in sorted(xrange(len(layers)), key=lambda i: abs(i - center))]
+
+patches = [patch for layer in layers for patch in layer.getDisplayables(Patch)
+           if patch.isVisible() and patch not in checkpoint]
+print "Patches to check:", len(patches), "; already done:", len(checkpoint.done)
 
-for layer in project.getRootLayerSet().getLayers():
-  for patch in layer.getDisplayables(Patch):
-    if patch.isVisible():
-      patch.updateMipMaps()
\ No newline at end of file
+# Bound the number of patches in flight by the memory needed to generate the mipmaps of the largest one
+largest = max([patch.getOWidth() * patch.getOHeight() for patch in patches] or [0])
+n_mipmap_threads = int(project.getProperty("n_mipmap_threads") or 0) # 0 means as many as CPUs
+scheduler = BoundedScheduler(n_threads=n_mipmap_threads,
+                             bytes_per_task=largest * 8,
+                             n_tasks=len(patches),
+                             release=loader.releaseToFit,
+                             name="mipmap-regenerator")
+try:
+  for patch in patches:
+    scheduler.submit(regenerate, patch)
+  scheduler.awaitAll()
+  if 0 == checkpoint.n_failed:
+    checkpoint.delete()
+  else:
+    print "Failed patches:", checkpoint.n_failed, "; re-run to retry them."
+finally:
+  scheduler.shutdown()
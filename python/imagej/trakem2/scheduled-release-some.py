@@ -1,51 +1,144 @@
+# Keep the heap under a target by releasing just enough of the least recently used images
+# cached by the TrakEM2 Loader, as soon as the heap usage after a garbage collection
+# exceeds a threshold, rather than periodically releasing half of all cached images.
+# Images that are in use, i.e. recently accessed while browsing, are kept.
+#
+# Heap usage is watched with the JVM's memory pool notifications, and also checked
+# every CHECK_EVERY seconds in case the JVM's garbage collector doesn't support them.
+# Images released become garbage that only a collection of the old generation reclaims,
+# whereas young collections don't lower its usage: the bytes released are therefore
+# subtracted from the measured usage until it drops, so that the same excess isn't released twice.
+
 from java.util.concurrent import Executors, TimeUnit
-from java.lang import System
+from java.lang import System, Runtime, Runnable
+from java.lang.management import ManagementFactory, MemoryType, MemoryNotificationInfo
+from javax.management import NotificationListener
 from ini.trakem2.persistence import Loader
 from ini.trakem2 import Project
 from ini.trakem2.utils import CachingThread
+from synchronize import make_synchronized, apply_synchronized
 import sys, traceback
 
-# 4096x4096 RGBA
-IMAGE_SIZE = pow(4096, 2) * 4  # bytes
-RELEASE_EVERY = 60  # seconds
+THRESHOLD = 0.85  # fraction of the max heap above which to release images
+TARGET = 0.70     # fraction of the max heap to release images down to
+CHECK_EVERY = 10  # seconds
 
-exe = Executors.newScheduledThreadPool(1)
+
+def cacheOf(loader):
+  f = Loader.getDeclaredField("mawts")
+  f.setAccessible(True)
+  return f.get(loader)
+
+
+def lockOf(loader):
+  """ The lock that the Loader holds while accessing its cache. """
+  f = Loader.getDeclaredField("db_lock")
+  f.setAccessible(True)
+  return f.get(loader)
 
 
-def free():
-  #Loader.releaseAllCaches()
-  #System.out.println("Released all")
-  #
-  # Instead of releasing all, release half of all loaded images
+def cachedBytes(cache):
+  """ The number of bytes of the images in the cache, or None if unknown. """
   try:
-    image_n_bytes = IMAGE_SIZE
-    projects = Project.getProjects()
-    if 0 == projects.size():
-      return
-    loader = projects[0].getLoader()
-    f = Loader.getDeclaredField("mawts")
+    f = cache.getClass().getDeclaredField("bytes")
     f.setAccessible(True)
-    mawts = f.get(loader)
-    n_cached_images = mawts.size()
+    return f.getLong(cache)
+  except:
+    return None
+
+
+class CacheGovernor(NotificationListener, Runnable):
+  def __init__(self, threshold=THRESHOLD, target=TARGET):
+    self.threshold = threshold
+    self.target = target
+    self.memory = ManagementFactory.getMemoryMXBean()
+    self.max_bytes = Runtime.getRuntime().maxMemory()
+    self.last_used = 0 # the usage measured last time
+    self.n_released = 0 # bytes released since the measured usage last dropped
+    # Be notified when the usage of the heap pools, measured right after a garbage collection, exceeds the threshold
+    self.pools = [pool for pool in ManagementFactory.getMemoryPoolMXBeans()
+                  if MemoryType.HEAP == pool.getType() and pool.isCollectionUsageThresholdSupported()
+                  and pool.getUsage().getMax() > 0]
+    for pool in self.pools:
+      pool.setCollectionUsageThreshold(long(pool.getUsage().getMax() * threshold))
+    # The MemoryMXBean is also a javax.management.NotificationEmitter
+    self.memory.addNotificationListener(self, None, None)
+
+  def handleNotification(self, notification, handback):
+    if MemoryNotificationInfo.MEMORY_COLLECTION_THRESHOLD_EXCEEDED == notification.getType():
+      self.run()
+
+  def run(self):
+    try:
+      self.govern()
+    except:
+      traceback.print_exc(file=sys.stdout)
+
+  def used(self):
+    """ The bytes of the old generation in use as of its last garbage collection, so that
+        garbage not yet collected doesn't trigger releasing images, and so that the usage
+        of the young generation, which changes with every young collection, is ignored;
+        or else the current heap usage. """
+    heap = [pool for pool in ManagementFactory.getMemoryPoolMXBeans()
+            if MemoryType.HEAP == pool.getType() and pool.getCollectionUsage() is not None]
+    # Of the heap pools, only those of the old generation support usage thresholds
+    old = [pool for pool in heap if pool.isUsageThresholdSupported()]
+    usages = [pool.getCollectionUsage() for pool in (old if old else heap)]
+    if usages:
+      return sum(usage.getUsed() for usage in usages)
+    return self.memory.getHeapMemoryUsage().getUsed()
+
+  @make_synchronized
+  def govern(self):
+    measured = self.used()
+    if measured < self.last_used:
+      # A collection reclaimed old objects, including the images released so far
+      self.n_released = 0
+    self.last_used = measured
+    # Images released but not yet reclaimed don't count
+    used = measured - self.n_released
+    if used < self.max_bytes * self.threshold:
+      return
+    n_bytes_to_release = int(used - self.max_bytes * self.target)
     n_bytes_released = 0
-    if n_cached_images > 0:
-      n_bytes_to_release = int((n_cached_images * 0.5) * image_n_bytes)
-      n_bytes_released = loader.releaseMemory(n_bytes_to_release)
-      if 0 == n_bytes_released:
+    for project in Project.getProjects():
+      loader = project.getLoader()
+      cache = cacheOf(loader)
+      n_images = cache.size()
+      n_cached_bytes = cachedBytes(cache)
+      if 0 == n_images:
+        continue
+      # Least recently used images first, and only as many as needed
+      n_bytes = n_bytes_to_release - n_bytes_released
+      released = loader.releaseMemory(n_bytes)
+      if 0 == released:
         # There may be enough free memory so the loader refused to release anything,
-        # therefore ask the cache instance itself to actually remove the amount requested
-        n_bytes_released = mawts.removeAndFlushSome(n_bytes_to_release)
-      System.out.println("Released " + str(n_bytes_released) + " out of " + str(n_bytes_to_release))
-      loader.printCacheStatus()
+        # therefore ask the cache itself, holding the loader's lock, to remove the amount requested
+        released = apply_synchronized(lockOf(loader), cache.removeAndFlushSome, n_bytes)
+      n_bytes_released += released
+      per_image = (" (%i bytes per image on average)" % (n_cached_bytes / n_images)) if n_cached_bytes else ""
+      System.out.println("Released %i bytes from %i cached images of %s%s"
+                         % (released, n_images, project.getTitle(), per_image))
+      if n_bytes_released >= n_bytes_to_release:
+        break
+    self.n_released += n_bytes_released
     if 0 == n_bytes_released:
-       # All memory retained is in the form of native arrays stored for loading images later
+      # All memory retained is in the form of native arrays stored for loading images later
       CachingThread.releaseAll()
       System.out.println("Cleared CachingThread cache.")
-  except:
-    traceback.print_exc(file=sys.stdout)
+    System.out.println("Heap: %i MB used (%i MB measured) before releasing %i MB, target: %i MB"
+                       % (used / 1048576, measured / 1048576, n_bytes_released / 1048576, self.max_bytes * self.target / 1048576))
 
-exe.scheduleWithFixedDelay(free, 0, RELEASE_EVERY, TimeUnit.SECONDS)
+  def stop(self):
+    self.memory.removeNotificationListener(self)
+    for pool in self.pools:
+      pool.setCollectionUsageThreshold(0)
+
+
+governor = CacheGovernor()
+exe = Executors.newScheduledThreadPool(1)
+exe.scheduleWithFixedDelay(governor, 0, CHECK_EVERY, TimeUnit.SECONDS)
 
 # To cancel, call:
 #exe.shutdownNow()
-
+#governor.stop()
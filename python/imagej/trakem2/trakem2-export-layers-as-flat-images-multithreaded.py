@@ -9,10 +9,12 @@ from ij import ImagePlus
 from ij.io import FileSaver
 from java.awt import Color
 from java.awt.image import BufferedImage
+from ij.process import ByteProcessor
 from java.lang import Runnable, System
-from java.util.concurrent import Executors
 import os
 import sys
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.util import BoundedScheduler
 
 target_dir = "/home/albert/shares/cardona_nearline/Albert/0111-8_whole_L1_CNS/section-series-flat-images/"
 
@@ -50,10 +52,25 @@ class Exporter(Runnable):
       System.out.println("Error:" + str(e[0]) +"\n" + str(e[1]) + "\n" + str(e[2]))
 
 
-exporters2 = Executors.newFixedThreadPool(4)
 p = Project.getProjects()[0]
+layers = p.getRootLayerSet().getLayers()[1:] # the first layer is empty
 
-for k, lay in enumerate(p.getRootLayerSet().getLayers()):
-  if 0 == k:
-    continue
-  exporters2.submit(Exporter(lay, k, target_dir))
+# Each task holds the flat image of a layer as an AWT image, a BufferedImage and a ByteProcessor,
+# so bound the number of layers exported concurrently by the free heap for the largest layer,
+# asking the Loader to release cached images to make room before exporting the next layer.
+def area(layer):
+  b = layer.getMinimalBoundingBox(Patch, True)
+  return b.width * b.height if b else 0
+
+largest = max(area(layer) for layer in layers)
+scheduler = BoundedScheduler(n_threads=4,
+                             bytes_per_task=largest * 3,
+                             n_tasks=len(layers),
+                             release=p.getLoader().releaseToFit,
+                             name="flat-image-exporter")
+try:
+  for k, lay in enumerate(layers):
+    scheduler.submit(Exporter(lay, k + 1, target_dir).run)
+  scheduler.awaitAll()
+finally:
+  scheduler.shutdown()
@@ -1,36 +1,127 @@
-# Find out the 2D area of the largest section
-# and whether it is larger than 2 GB (for array indexing with signed int)
+# Export the flat image of each section as a 2D N5 dataset, rendering and writing
+# horizontal stripes one block tall, in parallel, rather than the whole section at once.
+# Sections of any size, including larger than 2 GB (beyond array indexing with signed int;
+# see trakem2-find-largest-layer-2D-area.py), are then exported with bounded memory.
+# Stripes wider than stripe_max_bytes are split into tiles, aligned to the block grid.
+#
+# Each section is stored as dataset "section-<index>", with its world bounds
+# in the "offset" attribute and its Z in the "z" attribute.
+# Re-running the script resumes the export, skipping the tiles whose blocks all exist already:
+# each block is written into a temporary file that is then renamed, so a block exists only once complete.
 #
 # While it doesn't require mipmaps, it will be much faster if mipmaps are available
 
 from ini.trakem2 import Project
 from ini.trakem2.display import Patch
 from ij import ImagePlus
-from ij.io import FileSaver
-from java.awt import Color
+from ij.process import ByteProcessor
+from java.awt import Color, Rectangle
 from java.awt.image import BufferedImage
+from java.awt.geom import AffineTransform
+from java.awt import Graphics2D, Image, Graphics
+from java.awt.image import ImageObserver
+from java.lang import System, Runtime
+from org.janelia.saalfeldlab.n5 import N5FSWriter, GzipCompression, DataType, ByteArrayDataBlock
+from com.google.gson import GsonBuilder
+from jarray import zeros
 import os
+import sys
+import traceback
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.util import BoundedScheduler
+from lib.io import n5BlockPath, writeN5Block
+
+target_dir = "/home/albert/shares/cardona_nearline/Albert/0111-8_whole_L1_CNS/section-series-flat-images.n5/"
 
-target_dir = "/home/albert/shares/cardona_nearline/Albert/0111-8_whole_L1_CNS/section-series-flat-images/"
+block_width, block_height = 1024, 1024
+n_threads = 8
+# Maximum size of the flat image of a stripe or tile, rendered at once
+stripe_max_bytes = 256 * 1024 * 1024
 
 p = Project.getProjects()[0]
+writer = N5FSWriter(target_dir, GsonBuilder())
+
+
+def renderFlat(layer, fov):
+  """ Return the flat image of the layer within the field of view, as a byte[]. """
+  drawImage = Graphics2D.getDeclaredMethod("drawImage", [Image, AffineTransform, ImageObserver])
+  drawImage.setAccessible(True)
+  dispose = Graphics.getDeclaredMethod("dispose", [])
+  dispose.setAccessible(True)
+  img = p.getLoader().getFlatAWTImage(layer, fov, 1.0, -1, ImagePlus.GRAY8, Patch, None, False, Color.black)
+  bi = BufferedImage(fov.width, fov.height, BufferedImage.TYPE_BYTE_GRAY)
+  g = bi.createGraphics()
+  # Necessary to bypass issues that result in only using 7-bits and with the ByteProcessor constructor
+  drawImage.invoke(g, [img, AffineTransform(), None])
+  dispose.invoke(g, [])
+  pixels = ByteProcessor(bi).getPixels()
+  bi.flush()
+  return pixels
+
 
-for i, layer in enumerate(p.getRootLayerSet().getLayers()):
+def exportTile(layer, dataset_name, attributes, bounds, fov):
+  """ Render the field of view of the layer, in world coordinates, and write it as blocks
+      of the dataset, whose origin is at the bounds' x, y.
+      The field of view is aligned to the block grid. """
+  try:
+    gx0 = (fov.x - bounds.x) / block_width
+    gy = (fov.y - bounds.y) / block_height
+    gxs = range(gx0, gx0 + (fov.width + block_width - 1) / block_width)
+    if all(os.path.exists(n5BlockPath(target_dir, dataset_name, [gx, gy])) for gx in gxs):
+      return
+    pixels = renderFlat(layer, fov)
+    for gx in gxs:
+      x = (gx - gx0) * block_width
+      width = min(block_width, fov.width - x)
+      block = zeros(width * fov.height, 'b')
+      for row in xrange(fov.height):
+        System.arraycopy(pixels, row * fov.width + x, block, row * width, width)
+      writeN5Block(target_dir, dataset_name, attributes,
+                   ByteArrayDataBlock([width, fov.height], [gx, gy], block))
+  except:
+    e = sys.exc_info()
+    System.out.println("Error:" + str(e[0]) +"\n" + str(e[1]) + "\n" + str(e[2]))
+    System.out.println(traceback.format_exception(e[0], e[1], e[2]))
+
+
+def tiles(bounds):
+  """ Generate the fields of view, in world coordinates, of the stripes one block tall,
+      split into tiles of as many blocks as fit in stripe_max_bytes. """
+  n_blocks = max(1, stripe_max_bytes / (block_width * block_height))
+  for y in xrange(bounds.y, bounds.y + bounds.height, block_height):
+    height = min(block_height, bounds.y + bounds.height - y)
+    for x in xrange(bounds.x, bounds.x + bounds.width, n_blocks * block_width):
+      yield Rectangle(x, y, min(n_blocks * block_width, bounds.x + bounds.width - x), height)
+
+
+layers = p.getRootLayerSet().getLayers()
+sections = []
+for i, layer in enumerate(layers):
   if 0 == i:
     continue
   bounds = layer.getMinimalBoundingBox(Patch, True)
-  img = p.getLoader().getFlatAWTImage(layer, bounds, 1.0, -1, ImagePlus.GRAY8, Patch, None, False, Color.black)
-  bi = BufferedImage(img.getWidth(None), img.getHeight(None), BufferedImage.TYPE_BYTE_GRAY)
-  g = bi.createGraphics()
-  g.drawImage(img, 0, 0, None)
-  g.dispose()
-  g = None
-  imp = ImagePlus(str(layer.getZ()), ByteProcessor(bi))
-  filepath = os.path.join(target_dir, "section-" + str(i).zfill(5) + "-[x=" + str(bounds.x) + "-y=" + str(bounds.y) + "-width=" + str(bounds.width) + "-height=" + str(bounds.height) + "].zip")
-  FileSaver(imp).saveAsZip(filepath)
-  bi.flush()
-  bi = None
-  imp.flush()
-  imp = None
-  ip = None
-  print "Saved layer", i
+  if bounds is None:
+    continue # an empty layer
+  dataset_name = "section-" + str(i).zfill(5)
+  if not writer.datasetExists(dataset_name):
+    writer.createDataset(dataset_name, [bounds.width, bounds.height], [block_width, block_height],
+                         DataType.UINT8, GzipCompression())
+    writer.setAttribute(dataset_name, "offset", [bounds.x, bounds.y])
+    writer.setAttribute(dataset_name, "z", layer.getZ())
+  sections.append((layer, dataset_name, writer.getDatasetAttributes(dataset_name), bounds))
+
+# Tiles are rendered in parallel, within the free heap, releasing cached images as needed
+n_tiles = sum(sum(1 for fov in tiles(bounds)) for _, _, _, bounds in sections)
+scheduler = BoundedScheduler(n_threads=n_threads,
+                             bytes_per_task=stripe_max_bytes * 3,
+                             n_tasks=n_tiles,
+                             release=p.getLoader().releaseToFit,
+                             name="flat-image-exporter")
+try:
+  for layer, dataset_name, attributes, bounds in sections:
+    for fov in tiles(bounds):
+      scheduler.submit(exportTile, layer, dataset_name, attributes, bounds, fov)
+    print "Submitted", dataset_name
+  scheduler.awaitAll()
+finally:
+  scheduler.shutdown()
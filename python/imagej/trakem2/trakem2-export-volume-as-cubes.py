@@ -1,24 +1,51 @@
-# Export as cubes of about 1 MB each for later inserting into N5
+# Export as cubes of about 1 MB each, written directly as the blocks of an N5 dataset
+# whose block grid matches the cube grid: one file per non-empty cube, compressed,
+# written concurrently, with no second pass needed to insert cubes into an N5 container.
+# Cubes that would be empty are not written at all: N5 readers return zeros for missing blocks.
+# This includes cubes that intersect a patch's bounding box but only its empty corners, e.g. when rotated,
+# which are rendered but found to be all black (and rendered again when resuming).
+# Re-running the script resumes the export, skipping the cubes whose block exists already:
+# each block is written into a temporary file that is then renamed, so a block exists only once complete.
+#
+# For each range of layers as deep as a cube, each layer is rendered once as a flat image
+# of a strip as tall as a cube and many cubes wide, rather than once per cube:
+# patches overlapping several cubes are then loaded and transformed once per strip.
+# Strips are as wide as fits within strip_max_bytes for all layers of the range.
+#
+# Only the cubes that intersect the bounding box of at least one visible Patch are enumerated,
+# from a grid hash of the patches of each layer into the cube grid, so that the work
+# and the number of files scale with the volume of the tissue rather than with max_bounds.
 
 from ini.trakem2 import Project
 from ini.trakem2.display import Patch
-from ini.trakem2.utils import Utils
 from ij import ImagePlus
-from ij.io import FileSaver
+from ij.process import ByteProcessor
 from java.awt import Color, Rectangle
 from java.awt.image import BufferedImage
-from java.lang import Runnable, System
-from java.util.concurrent import Executors
+from java.lang import System, Runtime
 from java.awt.geom import AffineTransform
 from java.awt import Graphics2D, Image, Graphics
 from java.awt.image import ImageObserver
 from java.lang.reflect import Method
+from org.janelia.saalfeldlab.n5 import N5FSWriter, GzipCompression, DataType, ByteArrayDataBlock
+from com.google.gson import GsonBuilder
+from jarray import zeros
+from collections import defaultdict
+from java.util import Arrays
 import os
 import sys
 import traceback
+sys.path.append("/home/albert/lab/scripts/python/imagej/IsoView-GCaMP/")
+from lib.util import BoundedScheduler
+from lib.io import n5BlockPath, writeN5Block
 
 
-target_dir = "/home/albert/shares/cardona_nearline/Albert/0111-8_whole_L1_CNS/cubes/"
+target_dir = "/home/albert/shares/cardona_nearline/Albert/0111-8_whole_L1_CNS/n5/"
+dataset_name = "0111-8_whole_L1_CNS"
+
+n_threads = 24
+# Maximum size of the flat images of the layers of a strip, rendered at once
+strip_max_bytes = Runtime.getRuntime().maxMemory() / 4
 
 
 p = Project.getProjects()[0]
@@ -34,122 +61,190 @@ cube_width, cube_height, cube_depth = dimensions
 
 # Exclude first layer, which is empty
 layers = p.getRootLayerSet().getLayers()[1:]
-bounds = [layer.getMinimalBoundingBox(Patch, True) for layer in layers]
-
-# For writing zero-padded file names
-n_digits = len(str(max_bounds.width / dimensions[0])), \
-                 len(str(max_bounds.height / dimensions[1])), \
-                 len(str(len(layers)))
 
-class CubeExporter(Runnable):
-  def __init__(self, coords, dimensions, layers, bounds, target_dir, n_digits):
+# The number of cubes along X and Y
+n_cols = (max_bounds.width + cube_width - 1) / cube_width
+n_rows = (max_bounds.height + cube_height - 1) / cube_height
+
+def occupiedCubes(layers):
+  """ Return a dictionary of the Z index of each range of layers vs the set of the (column, row)
+      grid positions of the cubes that intersect the bounding box of at least one visible Patch
+      in any layer of the range. """
+  occupied = defaultdict(set)
+  for i, layer in enumerate(layers):
+    cells = occupied[i / cube_depth]
+    for patch in layer.getDisplayables(Patch, True):
+      b = patch.getBoundingBox()
+      col0 = max(0, (b.x - max_bounds.x) / cube_width)
+      col1 = min(n_cols - 1, (b.x + b.width - 1 - max_bounds.x) / cube_width)
+      row0 = max(0, (b.y - max_bounds.y) / cube_height)
+      row1 = min(n_rows - 1, (b.y + b.height - 1 - max_bounds.y) / cube_height)
+      for row in xrange(row0, row1 + 1):
+        for col in xrange(col0, col1 + 1):
+          cells.add((col, row))
+  return occupied
+
+def runs(cols, max_length):
+  """ Split the sorted column indices into runs of consecutive columns, each at most max_length long. """
+  run = []
+  for col in cols:
+    if run and (col != run[-1] + 1 or len(run) == max_length):
+      yield run
+      run = []
+    run.append(col)
+  if run:
+    yield run
+
+# The N5 dataset spans the max_bounds over all layers, with one block per cube.
+# An existing dataset is reused, for resuming an interrupted export.
+writer = N5FSWriter(target_dir, GsonBuilder())
+if not writer.datasetExists(dataset_name):
+  writer.createDataset(dataset_name,
+                       [max_bounds.width, max_bounds.height, len(layers)],
+                       list(dimensions),
+                       DataType.UINT8,
+                       GzipCompression())
+attributes = writer.getDatasetAttributes(dataset_name)
+
+
+def renderLayer(layer, fov):
+  """ Return the flat image of the layer within the field of view, as a byte[]. """
+  drawImage = Graphics2D.getDeclaredMethod("drawImage", [Image, AffineTransform, ImageObserver])
+  drawImage.setAccessible(True)
+  dispose = Graphics.getDeclaredMethod("dispose", [])
+  dispose.setAccessible(True)
+  img = layer.getProject().getLoader().getFlatAWTImage(layer, fov, 1.0, -1, ImagePlus.GRAY8, Patch, None, False, Color.black)
+  bi = BufferedImage(fov.width, fov.height, BufferedImage.TYPE_BYTE_GRAY)
+  g = bi.createGraphics()
+  aff = AffineTransform(1, 0, 0, 1, 0, 0)
+  #g.drawImage(img, aff, None) # Necessary to bypass issues that result in only using 7-bits and with the ByteProcessor constructor
+  drawImage.invoke(g, [img, aff, None])
+  #g.dispose()
+  dispose.invoke(g, [])
+  pixels = ByteProcessor(bi).getPixels()
+  bi.flush()
+  return pixels
+
+
+class Cube:
+  def __init__(self, coords, dimensions, layers, writer, attributes):
     self.dimensions = dimensions
     self.coords = coords
     self.layers = layers
-    self.bounds = bounds
-    self.target_dir = target_dir
-    self.n_digits = n_digits
-    
-  def makeFilePath(self):
+    self.writer = writer
+    self.attributes = attributes
+
+  def gridPosition(self):
     x, y, k = self.coords
-    xd, yd, kd = self.n_digits # for zero-padding
-    xs, ys, ks = str(x).zfill(xd), str(y).zfill(yd), str(k).zfill(kd)
-    return self.target_dir + "%s/%s/%s.zip" % (ks, ys, xs)
+    width, height, n_layers = self.dimensions
+    return [(x - max_bounds.x) / width, (y - max_bounds.y) / height, k / n_layers]
 
-  def isEmpty(self):
-     # Check if the cube would have any data
-      x, y, k = self.coords
-      width, height, n_layers = self.dimensions
-      # Cube's field of view in XY
-      fov = Rectangle(x, y, width, height)
-
-      # Join the bounds of the layers
-      r = None
-      for b in self.bounds[k : min(k + n_layers, len(bounds))]:
-        if r is None and b is not None: # can be none when the Layer is empty
-          r = Rectangle(b.x, b.y, b.width, b.height)
-        elif b is not None:
-          r.add(b)
-      
-      # Return True if not intersecting
-      return r is None or not fov.intersects(r)
-
-  def run(self):
+  def blockPath(self):
+    return n5BlockPath(target_dir, dataset_name, self.gridPosition())
+
+  def blockDimensions(self):
+    # Blocks at the end of each dimension are cropped to the dataset's dimensions
+    x, y, k = self.coords
+    width, height, n_layers = self.dimensions
+    return [min(width, max_bounds.x + max_bounds.width - x),
+            min(height, max_bounds.y + max_bounds.height - y),
+            min(n_layers, len(self.layers) - k)]
+
+  def isPending(self):
+    """ Whether the cube hasn't been written yet. """
+    return not os.path.exists(self.blockPath())
+
+  def write(self, strip_pixels, strip_fov):
+    """ Copy the cube's pixels from the flat images of its layers within a strip,
+        in N5's order: X first, then Y, then Z, and write them as a compressed block. """
     try:
-      filepath = self.makeFilePath()
-      if os.path.exists(filepath):
-        return
-      
       x, y, k = self.coords
-      width, height, n_layers = self.dimensions
-      
-      # Cube's field of view in XY
-      fov = Rectangle(x, y, width, height)
-
-      # Join the bounds of the layers
-      r = None
-      for b in self.bounds[k : min(k + n_layers, len(bounds))]:
-        if r is None:
-          r = Rectangle(b.x, b.y, b.width, b.height)
-        else:
-          r.add(b)
-
-      if not fov.intersects(r):
-        # Would be empty
+      width, height, n_layers = self.blockDimensions()
+      pixels = zeros(width * height * n_layers, 'b')
+      for i, layer_pixels in enumerate(strip_pixels):
+        for row in xrange(height):
+          System.arraycopy(layer_pixels, row * strip_fov.width + x - strip_fov.x,
+                           pixels, (i * height + row) * width, width)
+      # Cubes under the empty corners of e.g. rotated patches are all black: N5 readers return zeros
+      # for missing blocks, so don't write them
+      if Arrays.equals(pixels, zeros(len(pixels), 'b')):
         return
-
-      drawImage = Graphics2D.getDeclaredMethod("drawImage", [Image, AffineTransform, ImageObserver])
-      drawImage.setAccessible(True)
-      dispose = Graphics.getDeclaredMethod("dispose", [])
-      dispose.setAccessible(True)
-    
-      # Populate and write cube
-      stack = ImageStack(width, height)
-      for layer in self.layers[k : min(k + n_layers, len(self.layers))]:
-        img = layer.getProject().getLoader().getFlatAWTImage(layer, fov, 1.0, -1, ImagePlus.GRAY8, Patch, None, False, Color.black)
-        bi = BufferedImage(img.getWidth(None), img.getHeight(None), BufferedImage.TYPE_BYTE_GRAY)
-        g = bi.createGraphics()
-        aff = AffineTransform(1, 0, 0, 1, 0, 0)
-       #g.drawImage(img, aff, None) # Necessary to bypass issues that result in only using 7-bits and with the ByteProcessor constructor
-        drawImage.invoke(g, [img, aff, None])
-        #g.dispose()
-        dispose.invoke(g, [])
-        g = None
-        img = None
-        stack.addSlice("", ByteProcessor(bi))
-        bi.flush()
-        bi = None
-
-      imp = ImagePlus("x=%s y=%s k=%s" % (x, y, k), stack)
-      Utils.ensure(filepath)
-      FileSaver(imp).saveAsZip(filepath)
-      imp.flush()
-      imp = None
+      block = ByteArrayDataBlock([width, height, n_layers], self.gridPosition(), pixels)
+      writeN5Block(target_dir, dataset_name, self.attributes, block)
     except:
       e = sys.exc_info()
       System.out.println("Error:" + str(e[0]) +"\n" + str(e[1]) + "\n" + str(e[2]))
       System.out.println(traceback.format_exception(e[0], e[1], e[2]))
 
-exporters = Executors.newFixedThreadPool(24)
 
 print "Max bounds:", max_bounds
 
-futures = []
+# The number of cubes per strip, so that the flat images of all layers of a strip fit in strip_max_bytes
+strip_n_cubes = max(1, strip_max_bytes / (cube_width * cube_height * cube_depth))
+
+occupied = occupiedCubes(layers)
+n_cubes = sum(len(cells) for cells in occupied.itervalues())
+print "Cubes intersecting patches:", n_cubes, "of", n_cols * n_rows * len(occupied)
+
+def strips():
+  """ Generate the strips to export, as the first layer index, the Y and the list of column indices
+      of each run of contiguous cubes, so that no flat image is rendered where there aren't any patches. """
+  for gk in sorted(occupied.iterkeys()):
+    cols_by_row = defaultdict(list)
+    for col, row in occupied[gk]:
+      cols_by_row[row].append(col)
+    for row in sorted(cols_by_row.iterkeys()):
+      for run in runs(sorted(cols_by_row[row]), strip_n_cubes):
+        yield gk * cube_depth, max_bounds.y + row * cube_height, run
+
+def newCube(col, y, k):
+  return Cube((max_bounds.x + col * cube_width, y, k), dimensions, layers, writer, attributes)
+
+def pendingStrips():
+  """ Generate, for each strip, the first layer index, the Y, the number of cubes
+      and the list of column indices of the cubes whose block doesn't exist yet. """
+  for k, y, run in strips():
+    yield k, y, len(run), [col for col in run if newCube(col, y, k).isPending()]
+
+# One task per layer of each strip with cubes left to write, and one per such cube,
+# so that the progress and ETA of a resumed export only count the work left
+pending = list(pendingStrips())
+n_tasks = sum(len(layers[k : k + cube_depth]) + len(cols) for k, y, n, cols in pending if cols)
+
+# Bound the number of tasks in flight by the free heap, estimating each task's footprint
+# as the flat image of a layer's strip in its AWT, BufferedImage and byte[] forms,
+# and ask the Loader to release cached images to make room before each task, if needed.
+scheduler = BoundedScheduler(n_threads=n_threads,
+                             bytes_per_task=strip_n_cubes * cube_width * cube_height * 6,
+                             n_tasks=n_tasks,
+                             release=p.getLoader().releaseToFit,
+                             name="cube-exporter")
+
 count = 0
 
-for k in xrange(0, len(layers), cube_depth):
-  for x in xrange(max_bounds.x, max_bounds.x + max_bounds.width, cube_width):
-    for y in xrange(max_bounds.y, max_bounds.y + max_bounds.height, cube_height):
-      cube = CubeExporter((x, y, k), dimensions, layers, bounds, target_dir, n_digits)
-      fu = exporters.submit(cube)
-      count += 1 # 0 if cube.isEmpty() else 1
-      if 0 == count % 1000:
-        print "Completed:", count
-      futures.append(fu)
-      # after submitting 200, wait for the first 100 to complete
-      if 200 == len(futures):
-        Utils.waitIfAlive(futures[0:101], True)
-        futures = futures[101:]
+try:
+  for k, y, n, cols in pending:
+    slab = layers[k : k + cube_depth]
+    count += n
+    if 0 == len(cols):
+      continue
+    cubes = [newCube(col, y, k) for col in cols]
+    # A strip spanning from the first to the last cube to write
+    first, last = cubes[0].coords[0], cubes[-1].coords[0]
+    strip_fov = Rectangle(first, y,
+                          min(last + cube_width, max_bounds.x + max_bounds.width) - first,
+                          min(cube_height, max_bounds.y + max_bounds.height - y))
+    # Render each layer of the strip once, in parallel over layers
+    futures = [scheduler.submit(renderLayer, layer, strip_fov) for layer in slab]
+    strip_pixels = [f.get() for f in futures]
+    # Write all cubes of the strip in parallel
+    futures = [scheduler.submit(cube.write, strip_pixels, strip_fov) for cube in cubes]
+    for f in futures:
+      f.get()
+    strip_pixels = None
+  scheduler.awaitAll()
+finally:
+  scheduler.shutdown()
 
 print "Max bounds:", max_bounds
-print "Completed:", count
\ No newline at end of file
+print "Completed:", count